@@ -0,0 +1,120 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+# Compares the hOCR and TSV parsers of djpdf.hocr with a parser that builds
+# the complete ElementTree. Without files, a synthetic dense page is used.
+#
+# Usage: python3 benchmarks/hocr.py [--words N] [HOCR_FILE [TSV_FILE]]
+
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from xml.etree.ElementTree import ElementTree
+
+from djpdf.hocr import (_line_textangle, _word_text, extract_text,
+                        extract_text_tsv)
+
+WORDS_PER_LINE = 12
+
+
+def extract_text_tree(hocr_filename):
+    hocr = ElementTree()
+    hocr.parse(hocr_filename)
+    texts = []
+    for line in hocr.iter():
+        if line.attrib.get("class") != "ocr_line":
+            continue
+        textangle = _line_textangle(line)
+        for word in line.iter():
+            if word.attrib.get("class") != "ocrx_word":
+                continue
+            text = _word_text(word, textangle)
+            if text is not None:
+                texts.append(text)
+    return texts
+
+
+def write_synthetic_page(hocr_filename, tsv_filename, words):
+    with open(hocr_filename, "w") as hocr, open(tsv_filename, "w") as tsv:
+        hocr.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml"><body>\n'
+            "<div class='ocr_page' id='page_1' "
+            "title='bbox 0 0 5000 7000'>\n")
+        tsv.write("level\tpage_num\tblock_num\tpar_num\tline_num\t"
+                  "word_num\tleft\ttop\twidth\theight\tconf\ttext\n")
+        for i in range(words):
+            line, word = divmod(i, WORDS_PER_LINE)
+            x, y = 10 + word * 400, 10 + line * 40
+            if word == 0:
+                if line > 0:
+                    hocr.write("</span>\n")
+                hocr.write("<span class='ocr_line' id='line_%d' "
+                           "title='bbox 10 %d 4810 %d; baseline 0 -5; "
+                           "textangle 0; x_size 30'>\n" % (line, y, y + 30))
+                tsv.write("4\t1\t1\t1\t%d\t0\t10\t%d\t4800\t30\t-1\t\n" % (
+                    line, y))
+            hocr.write("<span class='ocrx_word' id='word_%d' "
+                       "title='bbox %d %d %d %d; x_wconf 95'>"
+                       "word%d</span>\n" % (i, x, y, x + 300, y + 30, i))
+            tsv.write("5\t1\t1\t1\t%d\t%d\t%d\t%d\t300\t30\t95\tword%d\n" % (
+                line, word, x, y, i))
+        if words:
+            hocr.write("</span>\n")
+        hocr.write("</div>\n</body></html>\n")
+
+
+def measure(name, func, filename):
+    tracemalloc.start()
+    start = time.perf_counter()
+    texts = func(filename)
+    duration = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print("%-12s %8.3f s %10.1f MiB %8d words" % (
+        name, duration, peak / (1 << 20), len(texts)))
+    return texts
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--words", type=int, default=50000,
+                        help="words of the synthetic page "
+                             "(default: %(default)d)")
+    parser.add_argument("HOCR_FILE", nargs="?")
+    parser.add_argument("TSV_FILE", nargs="?")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix="djpdf-") as temp_dir:
+        hocr_filename, tsv_filename = args.HOCR_FILE, args.TSV_FILE
+        if hocr_filename is None:
+            hocr_filename = os.path.join(temp_dir, "page.hocr")
+            tsv_filename = os.path.join(temp_dir, "page.tsv")
+            write_synthetic_page(hocr_filename, tsv_filename, args.words)
+        tree_texts = measure("tree", extract_text_tree, hocr_filename)
+        texts = measure("iterparse", extract_text, hocr_filename)
+        if texts != tree_texts:
+            print("iterparse result differs", file=sys.stderr)
+            sys.exit(1)
+        if tsv_filename is not None:
+            measure("tsv", extract_text_tsv, tsv_filename)
+
+
+if __name__ == "__main__":
+    main()
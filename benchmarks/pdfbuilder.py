@@ -0,0 +1,116 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+# Builds a synthetic document with PdfBuilder once for every number of
+# threads and reports the wall time, the CPU utilisation of all cores
+# (including external programs) and how long the event loop was blocked.
+# Requires qpdf (unless --no-linearize is used) and, with --image,
+# ImageMagick.
+#
+# Usage: python3 benchmarks/pdfbuilder.py [--pages N] [--image FILE]
+#                                         [--no-linearize] [THREADS ...]
+
+import asyncio
+import os
+import resource
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+
+from djpdf.djpdf import DEFAULT_THREADS, PdfBuilder
+from djpdf.util import MemoryBoundedSemaphore
+
+WORDS_PER_PAGE = 2000
+TICK = 0.01
+
+
+def make_recipe(pages, image_filename, temp_dir):
+    recipe_pages = []
+    for i in range(pages):
+        page = {
+            "width": 595,
+            "height": 842,
+            "text": [{"x": 10 + (j % 20) * 28, "y": 10 + (j // 20) * 8,
+                      "width": 26, "height": 7, "text": "word%d" % j}
+                     for j in range(WORDS_PER_PAGE)]
+        }
+        if image_filename is not None:
+            # Every page gets its own image
+            filename = os.path.join(temp_dir, "image.%d%s" % (
+                i, os.path.splitext(image_filename)[1]))
+            shutil.copyfile(image_filename, filename)
+            page["background"] = {"compression": "jpeg",
+                                  "filename": filename}
+        recipe_pages.append(page)
+    return {"pages": recipe_pages}
+
+
+def cpu_time():
+    usage = (resource.getrusage(resource.RUSAGE_SELF),
+             resource.getrusage(resource.RUSAGE_CHILDREN))
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+async def measure(recipe, threads, outfile, linearize):
+    psem = MemoryBoundedSemaphore()
+    blocked = 0
+    max_lag = 0
+
+    async def ticker():
+        nonlocal blocked, max_lag
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lag = max(0, time.perf_counter() - start - TICK)
+            blocked += lag
+            max_lag = max(max_lag, lag)
+    ticker_task = asyncio.ensure_future(ticker())
+    start_cpu, start = cpu_time(), time.perf_counter()
+    try:
+        await PdfBuilder(recipe, threads=threads).write(
+            outfile, psem, linearize=linearize)
+    finally:
+        ticker_task.cancel()
+    duration = time.perf_counter() - start
+    utilisation = (cpu_time() - start_cpu) / duration / psem.jobs
+    print("threads %3d: %8.2f s, %5.1f%% of %d cores, event loop blocked "
+          "%6.2f s (max %.3f s)" % (threads, duration, utilisation * 100,
+                                    psem.jobs, blocked, max_lag))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument("--pages", type=int, default=500,
+                        help="pages of the document (default: %(default)d)")
+    parser.add_argument("--image", metavar="FILE",
+                        help="use FILE as background of every page")
+    parser.add_argument("--no-linearize", action="store_true",
+                        help="write the PDF without the qpdf post-pass")
+    parser.add_argument("THREADS", type=int, nargs="*",
+                        default=[0, DEFAULT_THREADS])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix="djpdf-") as temp_dir:
+        recipe = make_recipe(args.pages, args.image, temp_dir)
+        for threads in args.THREADS:
+            asyncio.run(measure(recipe, threads,
+                                os.path.join(temp_dir, "out.pdf"),
+                                not args.no_linearize))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import copy
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from os import path
+
+from djpdf.diskcache import DiskCache, _link_or_copy
+
+CHECKPOINT_VERSION = 1
+MANIFEST_FILENAME = "manifest.json"
+PAGE_FILENAME = "page.json"
+
+
+def _write_json(filename, data):
+    with open(filename, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _page_images(page_json):
+    # The image recipes of a djpdf page that reference files
+    images = [page_json.get("thumbnail"), page_json.get("background"),
+              *page_json.get("foreground", ())]
+    return [image for image in images if image is not None]
+
+
+class Checkpoint:
+    """Finished pages of a job, that survive crashes of the process.
+
+    The djpdf page recipe of every finished page is stored together with
+    the images it references. The encoded images are stored in
+    ``disk_cache``. The manifest lists the pages of the job, pages of
+    other jobs are removed when a job is started. Encoded images that
+    were not used by a job are removed when it's finished.
+    """
+
+    def __init__(self, directory):
+        self._directory = path.abspath(directory)
+        self._pages_dir = path.join(self._directory, "pages")
+        os.makedirs(self._pages_dir, exist_ok=True)
+        # Never evicts anything of the job
+        self.disk_cache = DiskCache(path.join(self._directory, "cache"),
+                                    sys.maxsize)
+
+    def page_key(self, page):
+        digest = self.disk_cache.file_digest(page["filename"])
+        return self.disk_cache.make_key("Page", {**page, "filename": digest})
+
+    def start(self, pages):
+        keys = [self.page_key(page) for page in pages]
+        key_set = set(keys)
+        for name in os.listdir(self._pages_dir):
+            if name not in key_set:
+                shutil.rmtree(path.join(self._pages_dir, name),
+                              ignore_errors=True)
+        manifest_filename = path.join(self._directory, MANIFEST_FILENAME)
+        _write_json(manifest_filename + ".tmp",
+                    {"version": CHECKPOINT_VERSION, "pages": keys})
+        os.replace(manifest_filename + ".tmp", manifest_filename)
+
+    def finish(self):
+        # Must be called after the PDF was built successfully. The encoded
+        # images of the job were used to build it.
+        self.disk_cache.remove_unpinned()
+
+    def stored_keys(self):
+        return {name for name in os.listdir(self._pages_dir)
+                if not name.startswith(".")}
+
+    def load(self, page):
+        return self.load_by_key(self.page_key(page), page["filename"])
+
+    def load_by_key(self, key, filename=None):
+        # Like load with the key of the page, that is expensive to compute
+        page_dir = path.join(self._pages_dir, key)
+        try:
+            with open(path.join(page_dir, PAGE_FILENAME)) as f:
+                page_json = json.load(f)
+        except (OSError, ValueError):
+            return None
+        for image in _page_images(page_json):
+            image["filename"] = path.join(page_dir, image["filename"])
+            if not path.isfile(image["filename"]):
+                return None
+        logging.debug("Page restored from checkpoint: %s", filename or key)
+        return page_json
+
+    def store(self, page, page_json):
+        page_dir = path.join(self._pages_dir, self.page_key(page))
+        temp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self._pages_dir)
+        try:
+            page_json = copy.deepcopy(page_json)
+            for i, image in enumerate(_page_images(page_json)):
+                name = "image.%d%s" % (i, path.splitext(image["filename"])[1])
+                _link_or_copy(image["filename"], path.join(temp_dir, name))
+                image["filename"] = name
+            _write_json(path.join(temp_dir, PAGE_FILENAME), page_json)
+            shutil.rmtree(page_dir, ignore_errors=True)
+            try:
+                os.rename(temp_dir, page_dir)
+            except OSError:
+                # Stored concurrently by another process
+                stored_page_json = self.load(page)
+                if stored_page_json is None:
+                    raise
+                return stored_page_json
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        for image in _page_images(page_json):
+            image["filename"] = path.join(page_dir, image["filename"])
+        return page_json
@@ -0,0 +1,171 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from os import path
+
+# Increment when the format of cached results changes
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE = 10 << 30
+META_FILENAME = "meta.json"
+
+
+class CacheEntry(namedtuple("CacheEntry", ["path", "meta"])):
+    __slots__ = ()
+
+    def filename(self, name):
+        return path.join(self.path, name)
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _entry_size(entry_path):
+    size = 0
+    for name in os.listdir(entry_path):
+        with contextlib.suppress(OSError):
+            size += os.stat(path.join(entry_path, name)).st_size
+    return size
+
+
+class DiskCache:
+    """Persistent content-addressed cache for results of pipeline stages.
+
+    Entries are directories named after a hash of the input file contents
+    and the settings of the stage. The least recently used entries are
+    removed when the total size exceeds ``max_size``. Entries that were
+    used by this instance are never removed by it, because the files are
+    handed out directly.
+    """
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        if max_size < 0:
+            raise ValueError("max_size must be >= 0")
+        self._directory = path.abspath(directory)
+        self._max_size = max_size
+        self._size = None
+        self._pinned = set()
+        self._digests = {}
+        os.makedirs(self._directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        data = json.dumps([CACHE_VERSION, *parts], sort_keys=True)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+    def file_digest(self, filename):
+        st = os.stat(filename)
+        stat_key = (path.abspath(filename), st.st_size, st.st_mtime_ns)
+        digest = self._digests.get(stat_key)
+        if digest is None:
+            h = hashlib.sha256()
+            with open(filename, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            digest = self._digests[stat_key] = h.hexdigest()
+        return digest
+
+    def _entry_path(self, key):
+        return path.join(self._directory, key[:2], key)
+
+    def lookup(self, key):
+        entry_path = self._entry_path(key)
+        meta_filename = path.join(entry_path, META_FILENAME)
+        try:
+            with open(meta_filename) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._pinned.add(key)
+        # The modification time of the meta file tracks the last use
+        with contextlib.suppress(OSError):
+            os.utime(meta_filename)
+        logging.debug("Cache hit: %s", key)
+        return CacheEntry(entry_path, meta)
+
+    def store(self, key, meta, files=None):
+        entry_path = self._entry_path(key)
+        os.makedirs(path.dirname(entry_path), exist_ok=True)
+        temp_path = tempfile.mkdtemp(prefix=".tmp-", dir=self._directory)
+        try:
+            for name, filename in (files or {}).items():
+                _link_or_copy(filename, path.join(temp_path, name))
+            with open(path.join(temp_path, META_FILENAME), "w") as f:
+                json.dump(meta, f)
+            size = _entry_size(temp_path)
+            try:
+                os.rename(temp_path, entry_path)
+            except OSError:
+                # Stored concurrently by another process
+                entry = self.lookup(key)
+                if entry is None:
+                    raise
+                return entry
+        finally:
+            shutil.rmtree(temp_path, ignore_errors=True)
+        self._pinned.add(key)
+        if self._size is not None:
+            self._size += size
+        if self._size is None or self._size > self._max_size:
+            self._evict()
+        return CacheEntry(entry_path, meta)
+
+    def _entry_paths(self):
+        for prefix in os.listdir(self._directory):
+            prefix_path = path.join(self._directory, prefix)
+            if prefix.startswith(".") or not path.isdir(prefix_path):
+                continue
+            for key in os.listdir(prefix_path):
+                yield key, path.join(prefix_path, key)
+
+    def remove_unpinned(self):
+        """Removes all entries that were not used by this instance."""
+        for key, entry_path in self._entry_paths():
+            if key not in self._pinned:
+                logging.debug("Cache remove: %s", key)
+                shutil.rmtree(entry_path, ignore_errors=True)
+        self._size = None
+
+    def _evict(self):
+        entries = []
+        for key, entry_path in self._entry_paths():
+            with contextlib.suppress(OSError):
+                mtime = os.stat(path.join(
+                    entry_path, META_FILENAME)).st_mtime
+                entries.append((mtime, key, entry_path,
+                                _entry_size(entry_path)))
+        self._size = sum(entry[3] for entry in entries)
+        entries.sort()
+        for _, key, entry_path, size in entries:
+            if self._size <= self._max_size:
+                break
+            if key in self._pinned:
+                continue
+            logging.debug("Cache evict: %s", key)
+            shutil.rmtree(entry_path, ignore_errors=True)
+            self._size -= size
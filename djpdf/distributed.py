@@ -0,0 +1,373 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+# Pages are distributed over a spool directory on a shared filesystem:
+#   jobs/KEY.json          pages (recipe, index and settings) waiting for
+#                          a worker
+#   claimed/KEY.ID.json    pages processed by the worker ID
+#   failed/KEY.json        errors of failed pages
+#   inputs/KEY.EXT         input images of the pages
+#   pages/, cache/         results of finished pages (see Checkpoint)
+# Files are moved between the directories with atomic renames.
+
+import asyncio
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import sys
+import time
+import traceback
+import uuid
+from argparse import ArgumentParser
+from os import path
+
+from djpdf.checkpoint import Checkpoint
+from djpdf.diskcache import _link_or_copy
+from djpdf import util
+from djpdf.djpdf import (DEFAULT_JBIG2_CHUNK_SIZE, LINEARIZE_PDF, PdfBuilder,
+                         encode_images)
+from djpdf.ocrpool import OcrWorkerPool
+from djpdf.scans2pdf import (DEFAULT_OCR_ENGINE, DEFAULT_SEPARATION_ENGINE,
+                             OCR_ENGINES, SEPARATION_ENGINES, RecipeFactory,
+                             _make_page_json, _release_page_obj)
+from djpdf.util import (MemoryBoundedSemaphore, cli_add_resource_arguments,
+                        cli_apply_resource_arguments, cli_set_verbosity,
+                        cli_setup, set_big_temp_dir)
+
+POLL_INTERVAL = 1
+# Claimed jobs of workers that didn't show signs of life for this many
+# seconds are given to other workers
+JOB_TIMEOUT = 600
+
+
+class PageFailedError(Exception):
+    pass
+
+
+def _write_json_atomic(filename, data):
+    temp_filename = "%s.%s.tmp" % (filename, uuid.uuid4().hex)
+    with open(temp_filename, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_filename, filename)
+
+
+class _Spool:
+    def __init__(self, directory):
+        self.directory = path.abspath(directory)
+        self.jobs_dir = path.join(self.directory, "jobs")
+        self.claimed_dir = path.join(self.directory, "claimed")
+        self.failed_dir = path.join(self.directory, "failed")
+        self.inputs_dir = path.join(self.directory, "inputs")
+        for directory in (self.jobs_dir, self.claimed_dir, self.failed_dir,
+                          self.inputs_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.checkpoint = Checkpoint(self.directory)
+
+
+async def build_pdf_distributed(pages, pdf_filename, spool_dir,
+                                process_semaphore=None, progress_cb=None,
+                                local_workers=0,
+                                separation_engine=DEFAULT_SEPARATION_ENGINE,
+                                ocr_engine=DEFAULT_OCR_ENGINE,
+                                job_timeout=JOB_TIMEOUT,
+                                poll_interval=POLL_INTERVAL,
+                                linearize=LINEARIZE_PDF,
+                                jbig2_chunk_size=DEFAULT_JBIG2_CHUNK_SIZE):
+    """Coordinator that lets workers process the pages and builds the PDF.
+
+    Workers (see ``run_worker``) must use the same ``spool_dir``. With
+    ``local_workers``, worker processes are started on this host, they
+    use ``separation_engine`` and ``ocr_engine``. The jobs of
+    ``process_semaphore`` are split among them, its memory settings apply
+    to each of them.
+    Finished pages are kept in ``spool_dir`` and are not processed again,
+    when the same pages are submitted later. Only one coordinator can use
+    a spool directory at the same time.
+    """
+    if process_semaphore is None:
+        process_semaphore = MemoryBoundedSemaphore()
+    spool = _Spool(spool_dir)
+    checkpoint = spool.checkpoint
+    # The input files are hashed without blocking the event loop, the
+    # checkpoint remembers the digests
+    await asyncio.get_running_loop().run_in_executor(
+        None, checkpoint.start, pages)
+    keys = [checkpoint.page_key(page) for page in pages]
+    key_set = set(keys)
+    djpdf_pages = [checkpoint.load_by_key(key, page["filename"])
+                   for page, key in zip(pages, keys)]
+    # Remove jobs of other runs
+    for name in os.listdir(spool.jobs_dir):
+        if name.split(".", 1)[0] not in key_set:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path.join(spool.jobs_dir, name))
+    # Submit the missing pages
+    for page_index, (page, key, page_json) in enumerate(zip(
+            pages, keys, djpdf_pages)):
+        if page_json is not None:
+            continue
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path.join(spool.failed_dir, key + ".json"))
+        input_name = key + path.splitext(page["filename"])[1]
+        input_filename = path.join(spool.inputs_dir, input_name)
+        if not path.exists(input_filename):
+            _link_or_copy(page["filename"], input_filename + ".tmp")
+            os.replace(input_filename + ".tmp", input_filename)
+        # The index orders the commands of the workers by page (see
+        # scheduler)
+        _write_json_atomic(path.join(spool.jobs_dir, key + ".json"), {
+            "page_index": page_index,
+            "page": {**page, "filename": path.join("inputs", input_name)},
+            "jbig2_chunk_size": jbig2_chunk_size})
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(
+        target=_run_local_worker, daemon=True, args=(
+            spool.directory, process_semaphore.settings(local_workers),
+            separation_engine, ocr_engine, job_timeout, poll_interval,
+            util.big_temp_dir))
+        for _ in range(local_workers)]
+    for worker in workers:
+        worker.start()
+    try:
+        while True:
+            missing = 0
+            # Only files that exist are opened
+            stored_keys = checkpoint.stored_keys()
+            failed_names = set(os.listdir(spool.failed_dir))
+            for i, (page, key) in enumerate(zip(pages, keys)):
+                if djpdf_pages[i] is not None:
+                    continue
+                if key in stored_keys:
+                    djpdf_pages[i] = checkpoint.load_by_key(
+                        key, page["filename"])
+                    if djpdf_pages[i] is not None:
+                        continue
+                missing += 1
+                if key + ".json" not in failed_names:
+                    continue
+                try:
+                    with open(path.join(spool.failed_dir,
+                                        key + ".json")) as f:
+                        error = json.load(f)["error"]
+                except (OSError, ValueError):
+                    continue
+                raise PageFailedError("Processing of page %d (%s) failed: "
+                                      "%s" % (i + 1, page["filename"], error))
+            if progress_cb:
+                progress_cb((len(pages) - missing) / len(pages) * 0.5)
+            if missing == 0:
+                break
+            _requeue_stale_jobs(spool, job_timeout)
+            if workers and not any(worker.is_alive() for worker in workers):
+                raise Exception("All local workers exited")
+            await asyncio.sleep(poll_interval)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+    # The input images are not needed anymore
+    for name in os.listdir(spool.inputs_dir):
+        if name.split(".", 1)[0] in key_set:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path.join(spool.inputs_dir, name))
+    pdf_builder = PdfBuilder({"pages": djpdf_pages}, checkpoint.disk_cache,
+                             jbig2_chunk_size=jbig2_chunk_size)
+    try:
+        await pdf_builder.write(
+            pdf_filename, process_semaphore,
+            lambda f: progress_cb(0.5 + f * 0.5) if progress_cb else None,
+            linearize=linearize)
+    finally:
+        await process_semaphore.memory_profile.flush()
+    checkpoint.finish()
+
+
+def _requeue_stale_jobs(spool, job_timeout):
+    now = time.time()
+    for name in os.listdir(spool.claimed_dir):
+        claimed_filename = path.join(spool.claimed_dir, name)
+        with contextlib.suppress(FileNotFoundError):
+            if now - os.stat(claimed_filename).st_mtime < job_timeout:
+                continue
+            key = name.split(".", 1)[0]
+            logging.warning("Worker timed out, resubmitting page: %s", key)
+            os.replace(claimed_filename,
+                       path.join(spool.jobs_dir, key + ".json"))
+
+
+def _claim_job(spool, worker_id):
+    for name in sorted(os.listdir(spool.jobs_dir)):
+        if not name.endswith(".json") or name.count(".") != 1:
+            continue
+        key = name[:-len(".json")]
+        claimed_filename = path.join(spool.claimed_dir,
+                                     "%s.%s.json" % (key, worker_id))
+        try:
+            os.rename(path.join(spool.jobs_dir, name), claimed_filename)
+        except FileNotFoundError:
+            # Claimed by another worker
+            continue
+        # The modification time tracks the last sign of life
+        os.utime(claimed_filename)
+        return key, claimed_filename
+    return None, None
+
+
+async def _process_job(spool, factory, key, claimed_filename, psem,
+                       job_timeout):
+    async def keep_alive():
+        while True:
+            await asyncio.sleep(job_timeout / 4)
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(claimed_filename)
+    keep_alive_task = asyncio.ensure_future(keep_alive())
+    try:
+        with open(claimed_filename) as f:
+            job = json.load(f)
+        page = job["page"]
+        page["filename"] = path.join(spool.directory, page["filename"])
+        checkpoint = spool.checkpoint
+        if await asyncio.get_running_loop().run_in_executor(
+                None, checkpoint.load, page) is None:
+            page_obj, page_json = await _make_page_json(
+                factory, job["page_index"], page, psem, None)
+            try:
+                await encode_images({"pages": [page_json]}, psem,
+                                    checkpoint.disk_cache,
+                                    jbig2_chunk_size=job["jbig2_chunk_size"])
+                # The coordinator takes the page as finished, when it's
+                # stored
+                checkpoint.store(page, page_json)
+            finally:
+                _release_page_obj(page_obj)
+    except Exception as e:
+        logging.error("Processing of page failed: %s", key)
+        logging.debug("Exception occurred:\n%s" % traceback.format_exc())
+        _write_json_atomic(path.join(spool.failed_dir, key + ".json"),
+                           {"error": "%s: %s" % (type(e).__name__, e)})
+    finally:
+        keep_alive_task.cancel()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(claimed_filename)
+
+
+async def run_worker(spool_dir, process_semaphore=None,
+                     separation_engine=DEFAULT_SEPARATION_ENGINE,
+                     ocr_engine=DEFAULT_OCR_ENGINE, pages=None,
+                     job_timeout=JOB_TIMEOUT, poll_interval=POLL_INTERVAL):
+    """Processes pages submitted to ``spool_dir`` until cancelled.
+
+    At most ``pages`` pages are processed at the same time, by default
+    as many as jobs of ``process_semaphore``.
+    """
+    if process_semaphore is None:
+        process_semaphore = MemoryBoundedSemaphore()
+    if ocr_engine not in OCR_ENGINES:
+        raise ValueError("Unsupported OCR engine: %s" % ocr_engine)
+    ocr_pool = None
+    if ocr_engine == "tesserocr":
+        ocr_pool = OcrWorkerPool(process_semaphore.jobs)
+    spool = _Spool(spool_dir)
+    worker_id = "%s-%d-%s" % (socket.gethostname().replace(".", "-"),
+                              os.getpid(), uuid.uuid4().hex[:8])
+    if pages is None:
+        pages = process_semaphore.jobs
+    page_semaphore = asyncio.Semaphore(pages)
+    tasks = set()
+
+    async def process_job(factory, key, claimed_filename):
+        try:
+            await _process_job(spool, factory, key, claimed_filename,
+                               process_semaphore, job_timeout)
+        finally:
+            factory.cleanup()
+            page_semaphore.release()
+
+    try:
+        while True:
+            await page_semaphore.acquire()
+            key, claimed_filename = _claim_job(spool, worker_id)
+            if key is None:
+                page_semaphore.release()
+                # Measurements are saved, when the worker is idle
+                if not tasks:
+                    await process_semaphore.memory_profile.flush()
+                await asyncio.sleep(poll_interval)
+                continue
+            logging.info("Processing page: %s", key)
+            # Pages of different jobs don't share intermediate results
+            factory = RecipeFactory(None, separation_engine, ocr_pool,
+                                    ocr_engine)
+            task = asyncio.ensure_future(
+                process_job(factory, key, claimed_filename))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if ocr_pool is not None:
+            ocr_pool.close()
+        await process_semaphore.memory_profile.flush()
+
+
+def _run_local_worker(spool_dir, semaphore_settings, separation_engine,
+                      ocr_engine, job_timeout, poll_interval, temp_dir):
+    # The process is spawned, settings of the parent are not inherited
+    set_big_temp_dir(temp_dir)
+    asyncio.run(run_worker(
+        spool_dir, MemoryBoundedSemaphore(**semaphore_settings),
+        separation_engine=separation_engine, ocr_engine=ocr_engine,
+        job_timeout=job_timeout, poll_interval=poll_interval))
+
+
+def main():
+    cli_setup()
+    parser = ArgumentParser(
+        description="process pages submitted by scans2pdf --spool-dir")
+    parser.add_argument("-v", "--verbose", help="increase output verbosity",
+                        action="store_true")
+    parser.add_argument("--separation-engine", choices=SEPARATION_ENGINES,
+                        default=DEFAULT_SEPARATION_ENGINE,
+                        help="engine used to separate foreground, "
+                             "background and OCR layers "
+                             "(default: %(default)s)")
+    parser.add_argument("--ocr-engine", choices=OCR_ENGINES,
+                        default=DEFAULT_OCR_ENGINE,
+                        help="engine used for OCR (default: %(default)s)")
+    parser.add_argument("--pages", metavar="PAGES", type=int,
+                        help="process at most PAGES pages at the same time "
+                             "(default: number of jobs)")
+    cli_add_resource_arguments(parser)
+    parser.add_argument("SPOOL_DIR")
+    args = parser.parse_args()
+    cli_set_verbosity(args.verbose)
+    if args.pages is not None and args.pages < 1:
+        parser.error("argument --pages: must be >= 1")
+    process_semaphore = cli_apply_resource_arguments(parser, args)
+    try:
+        asyncio.run(run_worker(args.SPOOL_DIR, process_semaphore,
+                               separation_engine=args.separation_engine,
+                               ocr_engine=args.ocr_engine, pages=args.pages))
+    except Exception:
+        logging.debug("Exception occurred:\n%s" % traceback.format_exc())
+        logging.fatal("Operation failed")
+        sys.exit(1)
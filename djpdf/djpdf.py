@@ -17,6 +17,7 @@
 
 import asyncio
 import contextlib
+import functools
 import json
 import logging
 import math
@@ -27,14 +28,20 @@ import tempfile
 import traceback
 import zlib
 from argparse import ArgumentParser
-from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from os import path
 
 from libxmp import XMPMeta
 from libxmp.consts import XMP_NS_PDFA_ID
 
-from djpdf.util import (AsyncCache, MemoryBoundedSemaphore, cli_set_verbosity,
+from djpdf.diskcache import DEFAULT_CACHE_SIZE, DiskCache
+from djpdf.imageinfo import (image_pixels, is_bilevel_image,
+                             is_unchanged_compatible, read_image_stream)
+from djpdf.scheduler import set_page
+from djpdf.util import (AsyncCache, BigTemporaryDirectory,
+                        MemoryBoundedSemaphore, cli_add_resource_arguments,
+                        cli_apply_resource_arguments, cli_set_verbosity,
                         cli_setup, format_number, run_command)
 
 if sys.version_info < (3, 9):
@@ -45,17 +52,22 @@ else:
 # pdfrw tampers with logging
 _orig_basic_config = logging.basicConfig
 logging.basicConfig = lambda *args, **kwargs: None
-from pdfrw import PdfReader, PdfWriter
 from pdfrw.objects import PdfArray, PdfDict, PdfName, PdfObject, PdfString
 logging.basicConfig = _orig_basic_config
+from djpdf.pdfwriter import FileStream, StreamingPdfWriter
 
 CONVERT_CMD = "convert"
 JBIG2_CMD = "jbig2"
 QPDF_CMD = "qpdf"
 PDF_DECIMAL_PLACES = 3
-# Don't share JBIG2Globals between multiple images, because
-# Poppler as of version 0.36  has problems showing the images
-SHARE_JBIG2_GLOBALS = False
+# Same size as the thumbnails of ImageMagick's PDF writer
+THUMBNAIL_GEOMETRY = "106x106>"
+# Lossy JBIG2 images with the same settings can share one symbol
+# dictionary (JBIG2Globals) in chunks of consecutive images. Small chunks
+# keep the dictionaries small for viewers. Sharing is disabled by
+# default, because Poppler as of version 0.36 has problems showing the
+# images.
+DEFAULT_JBIG2_CHUNK_SIZE = 1
 LINEARIZE_PDF = True
 COMPRESS_PAGE_CONTENTS = True
 FONT_RESOURCE = importlib_resources.files("djpdf").joinpath(
@@ -64,21 +76,20 @@ UNICODE_CMAP_RESOURCE = importlib_resources.files("djpdf").joinpath(
     "to-unicode.cmap")
 SRGB_ICC_RESOURCE = importlib_resources.files("djpdf").joinpath(
     "argyllcms-srgb.icm")
-PARALLEL_JOBS = os.cpu_count() or 1
-JOB_MEMORY = 1 << 30
-RESERVED_MEMORY = 1 << 30
+# Threads for parsing and compressing PDF data in Python, 0 runs the work
+# directly on the event loop
+DEFAULT_THREADS = os.cpu_count() or 1
 
-big_temp_dir = tempfile.gettempdir()
-if big_temp_dir == "/tmp":
-    with contextlib.suppress(OSError):
-        with tempfile.NamedTemporaryFile(dir="/var/tmp"):
-            big_temp_dir = "/var/tmp"
 
-
-def BigTemporaryDirectory(*args, dir=None, **kwargs):
-    if dir is None:
-        dir = big_temp_dir
-    return tempfile.TemporaryDirectory(*args, dir=dir, **kwargs)
+def _qpdf_command(linearize=LINEARIZE_PDF):
+    cmd = [QPDF_CMD,
+           "--stream-data=preserve",
+           "--object-streams=preserve",
+           "--normalize-content=n",
+           "--newline-before-endstream"]
+    if linearize:
+        cmd.extend(["--linearize"])
+    return cmd
 
 
 def _pdf_format_number(f, decimal_places=PDF_DECIMAL_PLACES):
@@ -156,20 +167,51 @@ class PdfNumber(PdfObject):
 
 
 class RecipeFactory:
-    def __init__(self):
-        self._cache = []
-        self._cache_lock = asyncio.Lock()
+    def __init__(self, disk_cache=None, threads=DEFAULT_THREADS,
+                 jbig2_chunk_size=DEFAULT_JBIG2_CHUNK_SIZE):
+        if threads < 0:
+            raise ValueError("threads must be >= 0")
+        if jbig2_chunk_size < 1:
+            raise ValueError("jbig2_chunk_size must be >= 1")
+        self._cache = {}
+        self.disk_cache = disk_cache
+        self.jbig2_chunk_size = jbig2_chunk_size
+        self._threads = threads
+        self._executor = None
+        self._temp_dir = None
+        # Jbig2Chunks that are filled by new Jbig2Images
+        self._jbig2_chunks = {}
         self._jbig2_warning = True
         self.BLACK = Color(self, (0x00, 0x00, 0x00))
         self.WHITE = Color(self, (0xff, 0xff, 0xff))
 
     def _from_cache(self, obj):
-        try:
-            index = self._cache.index(obj)
-            obj = self._cache[index]
-        except ValueError:
-            self._cache.append(obj)
-        return obj
+        return self._cache.setdefault(obj.cache_key(), obj)
+
+    async def run_in_executor(self, func, *args):
+        # Keeps the event loop free to start external programs
+        if self._threads == 0:
+            return func(*args)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self._threads, thread_name_prefix="djpdf")
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args)
+
+    def temp_dir(self):
+        # Keeps files until the PDF is written, e.g. stream data that is
+        # read by the PDF writer
+        if self._temp_dir is None:
+            self._temp_dir = BigTemporaryDirectory(prefix="djpdf-")
+        return self._temp_dir.name
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._temp_dir is not None:
+            self._temp_dir.cleanup()
+            self._temp_dir = None
 
     def _make_mask(self, recipe):
         assert recipe.get("compression") in ("fax", "jbig2"), (
@@ -178,7 +220,23 @@ class RecipeFactory:
             image = ImageMagickImage(self, recipe, image_mask=True)
         elif recipe["compression"] == "jbig2":
             image = Jbig2Image(self, recipe, image_mask=True)
-        return self._from_cache(image)
+        image = self._from_cache(image)
+        if isinstance(image, Jbig2Image) and image.chunk is None:
+            self._add_to_jbig2_chunk(image)
+        return image
+
+    def _add_to_jbig2_chunk(self, image):
+        # Images are assigned in the order of the pages. Lossless images
+        # don't share symbols and get their own chunk.
+        if image.jbig2_threshold == 1:
+            Jbig2Chunk(self, image.jbig2_threshold).add(image)
+            return
+        key = (image.compression, image.jbig2_threshold)
+        chunk = self._jbig2_chunks.get(key)
+        if chunk is None or len(chunk.images) >= self.jbig2_chunk_size:
+            chunk = self._jbig2_chunks[key] = Jbig2Chunk(
+                self, image.jbig2_threshold)
+        chunk.add(image)
 
     def _make_masked_image(self, recipe, mask):
         assert recipe.get("compression") in ("auto", "deflate", "jp2",
@@ -229,6 +287,9 @@ class Color:
                 self._g == other._g and
                 self._b == other._b)
 
+    def __hash__(self):
+        return hash((self._r, self._g, self._b))
+
 
 class Text:
     def __init__(self, factory, recipe):
@@ -275,8 +336,6 @@ class Text:
 
 
 class ImageMagickImage:
-    _CacheContent = namedtuple("CacheContent", ["image", "thumbnail"])
-
     def __init__(self, factory, recipe, image_mask=False, mask=None):
         assert isinstance(recipe.get("compression"), str)
         assert recipe["compression"] in ("auto", "deflate", "fax", "jp2",
@@ -285,104 +344,156 @@ class ImageMagickImage:
             "Can't have mask and be image mask itself")
         assert mask is None or mask._image_mask, (
             "Mask must be image mask")
+        self._factory = factory
         self.compression = recipe["compression"]
         if self.compression in ("jp2", "jpeg"):
             if recipe.get("quality") is not None:
                 assert isinstance(recipe["quality"], int)
                 self.quality = recipe["quality"]
+                assert (1 <= self.quality and
+                        self.quality <= 100), "Invalid quality value"
             else:
-                self.quality = 100
-            assert (1 <= self.quality and
-                    self.quality <= 100), "Invalid quality value"
+                # Files that are already compressed like this are embedded
+                # unchanged, others are compressed with quality 100
+                self.quality = None
         else:
             self.quality = None
         assert isinstance(recipe.get("filename"), str)
         self.filename = recipe["filename"]
         self._cache = AsyncCache()
+        self._thumbnail_cache = AsyncCache()
         self._mask = mask
         self._image_mask = image_mask
 
+    def cache_key(self):
+        # Hashable key, equal for images that produce the same result
+        return (ImageMagickImage, self.compression, self.quality,
+                self.filename, self._mask, self._image_mask)
+
     def __eq__(self, other):
         if not isinstance(other, ImageMagickImage):
             return False
-        return (self.compression == other.compression and
-                self.quality == other.quality and
-                self.filename == other.filename and
-                self._mask == other._mask and
-                self._image_mask == other._image_mask)
+        return self.cache_key() == other.cache_key()
+
+    def __hash__(self):
+        return hash(self.cache_key())
 
     async def pdf_image(self, psem):
-        return (await self._cache.get(self._pdf_image(psem))).image
+        return await self._cache.get(self._pdf_image(psem))
 
     async def pdf_thumbnail(self, psem):
-        thumbnail = (await self._cache.get(self._pdf_image(psem))).thumbnail
+        return await self._thumbnail_cache.get(
+            self._pdf_image(psem, thumbnail=True))
+
+    async def _encode(self, psem, thumbnail):
+        # Returns the file with the encoded image. The file is kept until
+        # the PDF is written.
+        if (self.compression in ("jp2", "jpeg") and self.quality is None or
+                self.compression == "fax"):
+            if not thumbnail and await self._factory.run_in_executor(
+                    is_unchanged_compatible, self.filename, self.compression):
+                return self.filename
+        quality = 100 if self.quality is None else self.quality
+        cmd = [CONVERT_CMD, path.abspath(self.filename),
+               "-alpha", "remove",
+               "-alpha", "off"]
+        if thumbnail:
+            cmd.extend(["-thumbnail", THUMBNAIL_GEOMETRY])
+        if self._image_mask:
+            cmd.extend(["-colorspace", "gray",
+                        "-threshold", "50%"])
+        if self.compression in ("auto", "deflate"):
+            # Maximum zlib level with adaptive PNG filters
+            cmd.extend(["-quality", "95"])
+            name = "image.png"
+            output = "png:"
+        elif self.compression == "fax":
+            cmd.extend(["-compress", "Group4"])
+            name = "image.tif"
+            output = "tiff:"
+        elif self.compression == "jp2":
+            cmd.extend(["-quality", "%d" % quality])
+            name = "image.jp2"
+            output = "jp2:"
+        elif self.compression == "jpeg":
+            cmd.extend(["-quality", "%d" % quality])
+            name = "image.jpg"
+            output = "jpeg:"
+        else:
+            raise ValueError("Invalid compression")
+        output_dir = tempfile.mkdtemp(prefix="image-",
+                                      dir=self._factory.temp_dir())
+        filename = path.join(output_dir, name)
+        cmd.append(output + filename)
+        operation = "encode-%s%s" % (self.compression,
+                                     "-thumbnail" if thumbnail else "")
+        pixels = await self._factory.run_in_executor(image_pixels,
+                                                     self.filename)
+        disk_cache = self._factory.disk_cache
+        if disk_cache is None:
+            await run_command(cmd, psem, operation=operation, pixels=pixels)
+            return filename
+        key = disk_cache.make_key(
+            "ImageMagickImage", self.compression, self.quality,
+            self._image_mask, thumbnail, name,
+            await self._factory.run_in_executor(disk_cache.file_digest,
+                                                self.filename))
+        entry = disk_cache.lookup(key)
+        if entry is None:
+            await run_command(cmd, psem, operation=operation, pixels=pixels)
+            entry = disk_cache.store(key, {}, {name: filename})
+        return entry.filename(name)
+
+    async def _pdf_image(self, psem, thumbnail=False):
+        # The output of the encoder is embedded without decoding it
+        async def get_mask(psem):
+            if self._mask is None or thumbnail:
+                return None
+            return await self._mask.pdf_image(psem)
+        filename, pdf_mask = await asyncio.gather(
+            self._encode(psem, thumbnail), get_mask(psem))
+        image_stream = await self._factory.run_in_executor(
+            read_image_stream, filename)
+        pdf_image = PdfDict()
+        pdf_image.indirect = True
         if not thumbnail:
-            raise NotImplementedError(
-                "thumbnails not supported for image type")
-        return thumbnail
-
-    async def _pdf_image(self, psem):
-        with BigTemporaryDirectory(prefix="djpdf-") as temp_dir:
-            cmd = [CONVERT_CMD]
-            if self._image_mask or self.compression in ("jp2", "jpeg"):
-                cmd.extend(["-alpha", "remove",
-                            "-alpha", "off"])
-            if self._image_mask:
-                cmd.extend(["-colorspace", "gray",
-                            "-threshold", "50%"])
-            if self.compression == "auto":
-                pass
-            elif self.compression == "deflate":
-                cmd.extend(["-compress", "zip"])
-            elif self.compression == "fax":
-                cmd.extend(["-compress", "fax"])
-            elif self.compression == "jp2":
-                cmd.extend(["-compress", "jpeg2000",
-                            "-quality", "%d" % self.quality])
-            elif self.compression == "jpeg":
-                cmd.extend(["-compress", "jpeg",
-                            "-quality", "%d" % self.quality])
-            else:
-                raise ValueError("Invalid compression")
-            cmd.extend([path.abspath(self.filename),
-                        path.abspath(path.join(temp_dir, "image.pdf"))])
-
-            # Prepare everything in parallel
-            async def get_mask(psem):
-                if self._mask is None:
-                    return None
-                return await self._mask.pdf_image(psem)
-            _, pdf_mask = await asyncio.gather(run_command(cmd, psem),
-                                               get_mask(psem))
-            pdf_reader = PdfReader(path.join(temp_dir, "image.pdf"))
-            assert len(pdf_reader.pages[0].Resources.XObject) == 1, (
-                "Expected exactly one image from ImageMagick")
-            pdf_image = pdf_reader.pages[0].Resources.XObject.Im0
-            pdf_image.indirect = True
-            del pdf_image[PdfName.Name]
-            pdf_image.Length.indirect = False
-            pdf_image.ColorSpace.indirect = False
-            if self._image_mask:
-                pdf_image.ImageMask = PdfBool(True)
-                del pdf_image[PdfName.ColorSpace]
-                assert int(pdf_image.BitsPerComponent) == 1, (
-                    "Expected bitonal image from ImageMagick")
-            if pdf_mask is not None:
-                pdf_image.Mask = pdf_mask
-            pdf_thumbnail = pdf_reader.pages[0].Thumb
-            if not pdf_thumbnail:
-                pdf_thumbnail = None
-            else:
-                pdf_thumbnail.indirect = True
-                pdf_thumbnail.Length.indirect = False
-                pdf_thumbnail.ColorSpace.indirect = False
-        return self._CacheContent(pdf_image, pdf_thumbnail)
+            pdf_image.Type = PdfName.XObject
+            pdf_image.Subtype = PdfName.Image
+        pdf_image.Width = image_stream.width
+        pdf_image.Height = image_stream.height
+        if self._image_mask:
+            assert (image_stream.components == 1 and
+                    image_stream.bits_per_component == 1), (
+                "Expected bitonal image from ImageMagick")
+            pdf_image.ImageMask = PdfBool(True)
+        elif image_stream.palette is not None:
+            pdf_image.ColorSpace = PdfArray([
+                PdfName.Indexed, PdfName.DeviceRGB,
+                len(image_stream.palette) // 3 - 1,
+                PdfString.from_bytes(image_stream.palette,
+                                     bytes_encoding="hex")])
+        elif image_stream.components == 1:
+            pdf_image.ColorSpace = PdfName.DeviceGray
+        else:
+            pdf_image.ColorSpace = PdfName.DeviceRGB
+        pdf_image.BitsPerComponent = image_stream.bits_per_component
+        pdf_image.Filter = [PdfName(image_stream.filter)]
+        if image_stream.decode_parms is not None:
+            decode_parms = PdfDict()
+            for key, value in image_stream.decode_parms.items():
+                if isinstance(value, bool):
+                    value = PdfBool(value)
+                decode_parms[PdfName(key)] = value
+            pdf_image.DecodeParms = [decode_parms]
+        if pdf_mask is not None:
+            pdf_image.Mask = pdf_mask
+        pdf_image.stream = FileStream(filename, image_stream.ranges)
+        return pdf_image
 
 
 class Jbig2Image:
     def __init__(self, factory, recipe, image_mask=False, mask=None):
         self._factory = factory
-        self._cache_lock_acquired = False
         assert isinstance(recipe.get("compression"), str)
         assert recipe["compression"] == "jbig2", "Invalid compression"
         assert not image_mask or mask is None, (
@@ -409,6 +520,8 @@ class Jbig2Image:
         self._cache = AsyncCache()
         self._mask = mask
         self._image_mask = image_mask
+        # Jbig2Chunk, assigned by the factory when the recipe is built
+        self.chunk = None
         if (self.compression == "jbig2" and self.jbig2_threshold != 1 and
                 self._factory._jbig2_warning):
             self._factory._jbig2_warning = False
@@ -418,138 +531,165 @@ class Jbig2Image:
                             "get replaced)")
 
     async def pdf_image(self, psem):
-        # Multiple JBIG2Images can share one symbol dictionary. They have to be
-        # handled at once. _pdf_image searches the factory cache for all images
-        # it handles.
-        # The factory cache lock needs to be held until futures for the caches
-        # of all handled JBIG2Images are installed. This prevents calling
-        # _pdf_image multiple times for the same set of images.
-        # The lock will be released by _pdf_image if it's not already in the
-        # cache.
-        await self._factory._cache_lock.acquire()
-        self._cache_lock_acquired = True
-        try:
-            return await self._cache.get(self._pdf_image(psem))
-        finally:
-            if self._cache_lock_acquired:
-                self._factory._cache_lock.release()
-                self._cache_lock_acquired = False
+        return await self._cache.get(self._pdf_image(psem))
 
     async def pdf_thumbnail(self, psem):
         raise NotImplementedError("thumbnails not supported for jbig2 images")
 
     async def _pdf_image(self, psem):
-        with BigTemporaryDirectory(prefix="djpdf-") as temp_dir:
-            # JBIG2Globals are only used in symbol mode
-            # In symbol mode jbig2 writes output to files otherwise
-            # it's written to stdout
-            symbol_mode = self.jbig2_threshold != 1
-            images_with_shared_globals = []
-            if symbol_mode and SHARE_JBIG2_GLOBALS:
-                # Find all Jbig2Images that share the same symbol dictionary
-                for obj in self._factory._cache:
-                    if (isinstance(obj, Jbig2Image) and
-                            self.compression == obj.compression and
-                            self.jbig2_threshold == obj.jbig2_threshold):
-                        images_with_shared_globals.append(obj)
-            else:
-                # The symbol dictionary is not shared with other Jbig2Images
-                images_with_shared_globals.append(self)
-            # Promise all handled Jbig2Images the finished image
-            image_futures = []
-            my_image_future = None
-            for image in images_with_shared_globals:
-                future = asyncio.Future()
-                asyncio.ensure_future(image._cache.get(future))
-                image_futures.append(future)
-                if image is self:
-                    my_image_future = future
-            # All futures are in place, the lock can be released
-            self._factory._cache_lock.release()
-            self._cache_lock_acquired = False
-
-            # Prepare everything in parallel
-            async def get_jbig2_images(psem):
-                # Convert images with ImageMagick to bitonal png in parallel
-                await asyncio.gather(*[
-                    run_command([
-                        CONVERT_CMD,
-                        "-alpha", "remove",
-                        "-alpha", "off",
-                        "-colorspace", "gray",
-                        "-threshold", "50%",
-                        path.abspath(image.filename),
-                        path.abspath(path.join(temp_dir,
-                                               "input.%d.png" % i))], psem)
-                    for i, image in enumerate(images_with_shared_globals)])
-                cmd = [JBIG2_CMD, "-p"]
-                if symbol_mode:
-                    cmd.extend(["-s", "-t",
-                                format_number(self.jbig2_threshold, 4)])
-                for i, _ in enumerate(images_with_shared_globals):
-                    cmd.append(path.abspath(path.join(temp_dir,
-                                                      "input.%d.png" % i)))
-                jbig2_images = []
-                jbig2_globals = None
-                if symbol_mode:
-                    await run_command(cmd, psem, cwd=temp_dir)
-                    jbig2_globals = PdfDict()
-                    jbig2_globals.indirect = True
-                    with open(path.join(temp_dir, "output.sym"), "rb") as f:
-                        jbig2_globals.stream = f.read().decode("latin-1")
-                    for i, _ in enumerate(images_with_shared_globals):
-                        with open(path.join(temp_dir,
-                                  "output.%04d" % i), "rb") as f:
-                            jbig2_images.append(f.read())
-                else:
-                    jbig2_images.append(
-                        await run_command(cmd, psem, cwd=temp_dir))
-                return jbig2_images, jbig2_globals
-
-            async def get_image_mask(image, psem):
-                if image._mask is None:
-                    return None
-                return await image._mask.pdf_image(psem)
-            (jbig2_images, jbig2_globals), image_masks = await asyncio.gather(
-                get_jbig2_images(psem),
-                asyncio.gather(*[get_image_mask(image, psem)
-                                 for image in images_with_shared_globals]))
-
-            for image, jbig2_image, image_mask, image_future in zip(
-                    images_with_shared_globals, jbig2_images, image_masks,
-                    image_futures):
-                width, height, xres, yres = struct.unpack(
-                    '>IIII', jbig2_image[11:27])
-                pdf_image = PdfDict()
-                pdf_image.indirect = True
-                pdf_image.Type = PdfName.XObject
-                pdf_image.Subtype = PdfName.Image
-                pdf_image.Width = width
-                pdf_image.Height = height
-                if image._image_mask:
-                    pdf_image.ImageMask = PdfBool(True)
-                else:
-                    # NOTE: DefaultGray color space is required for PDF/A
-                    pdf_image.ColorSpace = PdfName.DeviceGray
-                if image_mask is not None:
-                    pdf_image.Mask = image_mask
-                pdf_image.BitsPerComponent = 1
-                pdf_image.Filter = [PdfName.JBIG2Decode]
-                if symbol_mode:
-                    pdf_image.DecodeParms = [{
-                        PdfName.JBIG2Globals: jbig2_globals}]
-                pdf_image.stream = jbig2_image.decode("latin-1")
-                image_future.set_result(pdf_image)
-        return my_image_future.result()
+        async def get_mask(psem):
+            if self._mask is None:
+                return None
+            return await self._mask.pdf_image(psem)
+        (jbig2_images, jbig2_globals), pdf_mask = await asyncio.gather(
+            self.chunk.jbig2_streams(psem), get_mask(psem))
+        jbig2_image = jbig2_images[self.chunk.index(self)]
+        with open(jbig2_image.filename, "rb") as f:
+            width, height, xres, yres = struct.unpack(
+                '>IIII', f.read(27)[11:27])
+        pdf_image = PdfDict()
+        pdf_image.indirect = True
+        pdf_image.Type = PdfName.XObject
+        pdf_image.Subtype = PdfName.Image
+        pdf_image.Width = width
+        pdf_image.Height = height
+        if self._image_mask:
+            pdf_image.ImageMask = PdfBool(True)
+        else:
+            # NOTE: DefaultGray color space is required for PDF/A
+            pdf_image.ColorSpace = PdfName.DeviceGray
+        if pdf_mask is not None:
+            pdf_image.Mask = pdf_mask
+        pdf_image.BitsPerComponent = 1
+        pdf_image.Filter = [PdfName.JBIG2Decode]
+        if jbig2_globals is not None:
+            pdf_image.DecodeParms = [{
+                PdfName.JBIG2Globals: jbig2_globals}]
+        pdf_image.stream = jbig2_image
+        return pdf_image
+
+    def cache_key(self):
+        # Hashable key, equal for images that produce the same result
+        return (Jbig2Image, self.compression, self.jbig2_threshold,
+                self.filename, self._mask, self._image_mask)
 
     def __eq__(self, other):
         if not isinstance(other, Jbig2Image):
             return False
-        return (self.compression == other.compression and
-                self.jbig2_threshold == other.jbig2_threshold and
-                self.filename == other.filename and
-                self._mask == other._mask and
-                self._image_mask == other._image_mask)
+        return self.cache_key() == other.cache_key()
+
+    def __hash__(self):
+        return hash(self.cache_key())
+
+
+class Jbig2Chunk:
+    """Jbig2Images that are encoded by one jbig2 process
+
+    In symbol mode the images share one symbol dictionary (JBIG2Globals).
+    """
+
+    def __init__(self, factory, jbig2_threshold):
+        self._factory = factory
+        self.jbig2_threshold = jbig2_threshold
+        self.images = []
+        self._cache = AsyncCache()
+
+    def add(self, image):
+        self.images.append(image)
+        image.chunk = self
+
+    def index(self, image):
+        return next(i for i, obj in enumerate(self.images) if obj is image)
+
+    async def jbig2_streams(self, psem):
+        # Returns the FileStreams of the images and the JBIG2Globals or
+        # None
+        return await self._cache.get(self._jbig2_streams(psem))
+
+    async def _jbig2_streams(self, psem):
+        # JBIG2Globals are only used in symbol mode
+        # In symbol mode jbig2 writes output to files otherwise
+        # it's written to stdout
+        symbol_mode = self.jbig2_threshold != 1
+        disk_cache = self._factory.disk_cache
+        disk_cache_key = None
+        if disk_cache is not None:
+            disk_cache_key = disk_cache.make_key(
+                "Jbig2Image", self.jbig2_threshold,
+                *await asyncio.gather(*[
+                    self._factory.run_in_executor(disk_cache.file_digest,
+                                                  image.filename)
+                    for image in self.images]))
+            entry = disk_cache.lookup(disk_cache_key)
+            if entry is not None:
+                return self._read_jbig2_streams(entry.path)
+        with BigTemporaryDirectory(prefix="djpdf-") as temp_dir:
+            async def get_bitonal_filename(i, image, psem):
+                # Black and white files are read by jbig2 as they are
+                if await self._factory.run_in_executor(is_bilevel_image,
+                                                       image.filename):
+                    return path.abspath(image.filename)
+                filename = path.abspath(path.join(temp_dir,
+                                                  "input.%d.png" % i))
+                await run_command([
+                    CONVERT_CMD,
+                    "-alpha", "remove",
+                    "-alpha", "off",
+                    "-colorspace", "gray",
+                    "-threshold", "50%",
+                    path.abspath(image.filename), filename], psem,
+                    operation="threshold",
+                    pixels=await self._factory.run_in_executor(
+                        image_pixels, image.filename))
+                return filename
+            # Convert images with ImageMagick to bitonal png in parallel
+            input_filenames = await asyncio.gather(*[
+                get_bitonal_filename(i, image, psem)
+                for i, image in enumerate(self.images)])
+            cmd = [JBIG2_CMD, "-p"]
+            if symbol_mode:
+                cmd.extend(["-s", "-t",
+                            format_number(self.jbig2_threshold, 4)])
+            cmd.extend(input_filenames)
+            operation = "symbol" if symbol_mode else "generic"
+            pixel_counts = await asyncio.gather(*[
+                self._factory.run_in_executor(image_pixels, image.filename)
+                for image in self.images])
+            pixels = None if None in pixel_counts else sum(pixel_counts)
+            if symbol_mode:
+                await run_command(cmd, psem, cwd=temp_dir,
+                                  operation=operation, pixels=pixels)
+            else:
+                with open(path.join(temp_dir, "output.0000"), "wb") as f:
+                    f.write(await run_command(
+                        cmd, psem, cwd=temp_dir, operation=operation,
+                        pixels=pixels))
+            names = ["output.%04d" % i for i, _ in enumerate(self.images)]
+            if symbol_mode:
+                names.append("output.sym")
+            if disk_cache_key is not None:
+                entry = disk_cache.store(disk_cache_key, {}, {
+                    name: path.join(temp_dir, name) for name in names})
+                return self._read_jbig2_streams(entry.path)
+            # The output is read when the PDF is written
+            output_dir = tempfile.mkdtemp(
+                prefix="jbig2-", dir=self._factory.temp_dir())
+            for name in names:
+                os.rename(path.join(temp_dir, name),
+                          path.join(output_dir, name))
+            return self._read_jbig2_streams(output_dir)
+
+    def _read_jbig2_streams(self, output_dir):
+        jbig2_globals = None
+        if self.jbig2_threshold != 1:
+            jbig2_globals = PdfDict()
+            jbig2_globals.indirect = True
+            jbig2_globals.stream = FileStream(
+                path.join(output_dir, "output.sym"))
+        jbig2_images = [
+            FileStream(path.join(output_dir, "output.%04d" % i))
+            for i, _ in enumerate(self.images)]
+        return jbig2_images, jbig2_globals
 
 
 class MaskImage:
@@ -607,9 +747,42 @@ class Page:
             self.text = ()
 
 
+def _compress(data):
+    return zlib.compress(data, 9)
+
+
+def _cid_to_gid_map_data():
+    # Map everything to glyph 1
+    return b"\0\1" * (1 << 16)
+
+
+def _xmp_metadata_data():
+    xmp = XMPMeta()
+    xmp.set_property(XMP_NS_PDFA_ID, "part", "2")
+    xmp.set_property(XMP_NS_PDFA_ID, "conformance", "A")
+    return xmp.serialize_to_str().encode("utf-8")
+
+
+@functools.lru_cache(maxsize=None)
+def _static_stream(make_data):
+    # The streams that are the same in every document are only built and
+    # compressed once per process
+    data = make_data()
+    return _compress(data), len(data)
+
+
+def _static_stream_dict(make_data):
+    pdf_stream = PdfDict()
+    pdf_stream.indirect = True
+    pdf_stream.Filter = [PdfName.FlateDecode]
+    pdf_stream.stream, pdf_stream.Length1 = _static_stream(make_data)
+    return pdf_stream
+
+
 class PdfBuilder:
-    def __init__(self, recipe):
-        self._factory = RecipeFactory()
+    def __init__(self, recipe, disk_cache=None, threads=DEFAULT_THREADS,
+                 jbig2_chunk_size=DEFAULT_JBIG2_CHUNK_SIZE):
+        self._factory = RecipeFactory(disk_cache, threads, jbig2_chunk_size)
         try:
             self._pages = tuple(map(self._factory.make_page, recipe["pages"]))
         except Exception as e:
@@ -617,13 +790,7 @@ class PdfBuilder:
 
     @staticmethod
     def _build_font():
-        embedded_font_stream = FONT_RESOURCE.read_bytes()
-        embedded_font = PdfDict()
-        embedded_font.indirect = True
-        embedded_font.Filter = [PdfName.FlateDecode]
-        embedded_font.stream = zlib.compress(embedded_font_stream, 9).decode(
-            "latin-1")
-        embedded_font.Length1 = len(embedded_font_stream)
+        embedded_font = _static_stream_dict(FONT_RESOURCE.read_bytes)
 
         font_descriptor = PdfDict()
         font_descriptor.indirect = True
@@ -638,14 +805,7 @@ class PdfBuilder:
         font_descriptor.StemV = 80
         font_descriptor.Type = PdfName.FontDescriptor
 
-        # Map everything to glyph 1
-        cid_to_gid_map_stream = b"\0\1" * (1 << 16)
-        cid_to_gid_map = PdfDict()
-        cid_to_gid_map.indirect = True
-        cid_to_gid_map.Filter = [PdfName.FlateDecode]
-        cid_to_gid_map.stream = zlib.compress(
-            cid_to_gid_map_stream, 9).decode("latin-1")
-        cid_to_gid_map.Length1 = len(cid_to_gid_map_stream)
+        cid_to_gid_map = _static_stream_dict(_cid_to_gid_map_data)
 
         cid_system_info = PdfDict()
         cid_system_info.Ordering = PdfString.from_unicode("Identity")
@@ -662,12 +822,7 @@ class PdfBuilder:
         cid_font.Type = PdfName.Font
         cid_font.DW = 500
 
-        unicode_cmap_stream = UNICODE_CMAP_RESOURCE.read_bytes()
-        unicode_cmap = PdfDict()
-        unicode_cmap.indirect = True
-        unicode_cmap.Filter = [PdfName.FlateDecode]
-        unicode_cmap.stream = zlib.compress(unicode_cmap_stream, 9).decode(
-            "latin-1")
+        unicode_cmap = _static_stream_dict(UNICODE_CMAP_RESOURCE.read_bytes)
 
         font = PdfDict()
         font.indirect = True
@@ -680,8 +835,68 @@ class PdfBuilder:
 
         return font
 
-    async def write(self, outfile, psem, progress_cb=None):
-        pdf_writer = PdfWriter(version="1.5")
+    @staticmethod
+    def _build_text(texts):
+        text = ""
+        for t in texts:
+            if not t.text:
+                continue
+            matrix = TransformationMatrix()
+            # Glyph size is 0.5 x 1
+            matrix.scale(2 / len(t.text), 1)
+            matrix.translate(-0.5, -0.5)
+            if t.direction == "ltr":
+                pass
+            elif t.direction == "rtl":
+                matrix.translate(0, -1)
+            elif t.direction == "ttb":
+                matrix.rotate(90)
+            matrix.rotate(-t.rotation)
+            matrix.translate(0.5, 0.5)
+            matrix.scale(t.width, t.height)
+            matrix.translate(t.x, t.y)
+            text += "%s Tm %s Tj\n" % (
+                matrix.to_pdf(),
+                PdfString().from_bytes(
+                    t.text.encode("utf-16-be"), bytes_encoding="hex"))
+        return text
+
+    async def write(self, outfile, psem, progress_cb=None,
+                    linearize=LINEARIZE_PDF, page_done_cb=None):
+        try:
+            await self._write(outfile, psem, progress_cb, linearize,
+                              page_done_cb)
+        finally:
+            self._factory.shutdown()
+
+    async def _write(self, outfile, psem, progress_cb, linearize,
+                     page_done_cb):
+        # Linearization is a post-pass with qpdf, otherwise the objects are
+        # written directly to the output file as soon as they are complete
+        with contextlib.ExitStack() as stack:
+            if linearize:
+                temp_dir = stack.enter_context(
+                    BigTemporaryDirectory(prefix="djpdf-"))
+                pdf_filename = path.join(temp_dir, "temp.pdf")
+            else:
+                pdf_filename = outfile
+            try:
+                with open(pdf_filename, "wb") as f:
+                    await self._write_pdf(f, psem, progress_cb,
+                                          page_done_cb)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(pdf_filename)
+                raise
+            if linearize:
+                cmd = _qpdf_command(linearize)
+                cmd.extend([path.abspath(pdf_filename),
+                            path.abspath(outfile)])
+                await run_command(cmd, psem, operation="linearize")
+
+    async def _write_pdf(self, f, psem, progress_cb, page_done_cb):
+        run_in_executor = self._factory.run_in_executor
+        pdf_writer = StreamingPdfWriter(f)
 
         pdf_group = PdfDict()
         pdf_group.indirect = True
@@ -691,29 +906,36 @@ class PdfBuilder:
 
         pdf_font_mapping = PdfDict()
         pdf_font_mapping.indirect = True
-        pdf_font_mapping.F1 = self._build_font()
+        pdf_font_mapping.F1 = await run_in_executor(self._build_font)
 
+        pdf_page_tree = PdfDict()
+        pdf_page_tree.indirect = True
+        pdf_page_tree.Type = PdfName.Pages
+        pdf_page_tree.Count = len(self._pages)
+        pdf_pages = []
         for _ in self._pages:
             pdf_page = PdfDict()
+            pdf_page.indirect = True
             pdf_page.Type = PdfName.Page
-            pdf_writer.addpage(pdf_page)
-        # pdfrw makes a internal copy of the pages
-        # use the copy so that references to pages in links are correct
-        pdf_pages = list(pdf_writer.pagearray)
-
-        srgb_colorspace = PdfDict()
-        srgb_colorspace.indirect = True
+            pdf_page.Parent = pdf_page_tree
+            pdf_pages.append(pdf_page)
+        pdf_page_tree.Kids = PdfArray(pdf_pages)
+        # Pages are written as soon as they are finished, references
+        # to the page tree and to other pages (links) are resolved later
+        pdf_writer.reserve(pdf_page_tree)
+        for pdf_page in pdf_pages:
+            pdf_writer.reserve(pdf_page)
+
+        srgb_colorspace = await run_in_executor(
+            _static_stream_dict, SRGB_ICC_RESOURCE.read_bytes)
         srgb_colorspace.N = 3  # Number of components (red, green, blue)
-        srgb_colorspace_stream = SRGB_ICC_RESOURCE.read_bytes()
-        srgb_colorspace.Filter = [PdfName.FlateDecode]
-        srgb_colorspace.stream = zlib.compress(
-            srgb_colorspace_stream, 9).decode("latin-1")
-        srgb_colorspace.Length1 = len(srgb_colorspace_stream)
         default_rgb_colorspace = PdfArray([PdfName.ICCBased, srgb_colorspace])
         default_rgb_colorspace.indirect = True
 
         # Handle all pages in parallel
-        async def make_page(page, pdf_page, psem):
+        async def make_page(page_index, page, pdf_page, psem):
+            set_page(page_index)
+
             # Prepare everything in parallel
             async def get_pdf_thumbnail(psem):
                 if page.thumbnail is None:
@@ -737,6 +959,9 @@ class PdfBuilder:
                                      for fg in page.foreground]),
                     asyncio.gather(*[get_pdf_mask(fg, psem)
                                      for fg in page.foreground])))
+            # The image files of the page are no longer needed
+            if page_done_cb:
+                page_done_cb(page_index)
             pdf_page.MediaBox = PdfArray([0, 0,
                                           PdfNumber(page.width),
                                           PdfNumber(page.height)])
@@ -788,28 +1013,9 @@ class PdfBuilder:
             before_text = ("BT\n" +
                            "/F1 1 Tf 3 Tr\n")
             after_text = "\nET\n"
-            text = ""
+            text = await run_in_executor(self._build_text, page.text)
             pdf_annots = []
             for t in page.text:
-                if t.text:
-                    matrix = TransformationMatrix()
-                    # Glyph size is 0.5 x 1
-                    matrix.scale(2 / len(t.text), 1)
-                    matrix.translate(-0.5, -0.5)
-                    if t.direction == "ltr":
-                        pass
-                    elif t.direction == "rtl":
-                        matrix.translate(0, -1)
-                    elif t.direction == "ttb":
-                        matrix.rotate(90)
-                    matrix.rotate(-t.rotation)
-                    matrix.translate(0.5, 0.5)
-                    matrix.scale(t.width, t.height)
-                    matrix.translate(t.x, t.y)
-                    text += "%s Tm %s Tj\n" % (
-                        matrix.to_pdf(),
-                        PdfString().from_bytes(
-                            t.text.encode("utf-16-be"), bytes_encoding="hex"))
                 if t.external_link is not None or t.internal_link is not None:
                     pdf_annot = PdfDict()
                     pdf_annots.append(pdf_annot)
@@ -846,17 +1052,17 @@ class PdfBuilder:
                 pdf_page.Contents = pdf_contents
                 if COMPRESS_PAGE_CONTENTS:
                     pdf_contents.Filter = [PdfName.FlateDecode]
-                    pdf_contents.stream = zlib.compress(
-                        contents.encode("latin-1"),
-                        9).decode("latin-1")
+                    pdf_contents.stream = await run_in_executor(
+                        _compress, contents.encode("latin-1"))
                 else:
-                    pdf_contents.stream = contents
+                    pdf_contents.stream = contents.encode("latin-1")
             if pdf_annots:
                 pdf_page.Annots = pdf_annots
             if pdf_xobject:
                 pdf_resources.XObject = pdf_xobject
             if pdf_resources:
                 pdf_page.Resources = pdf_resources
+            await run_in_executor(pdf_writer.write, pdf_page)
             # Report progress
             nonlocal finished_pages
             finished_pages += 1
@@ -864,56 +1070,76 @@ class PdfBuilder:
                 progress_cb(finished_pages / len(self._pages))
         finished_pages = 0
         await asyncio.gather(
-            *[make_page(page, pdf_page, psem)
-              for page, pdf_page in zip(self._pages, pdf_pages)])
+            *[make_page(page_index, page, pdf_page, psem)
+              for page_index, (page, pdf_page) in enumerate(
+                  zip(self._pages, pdf_pages))])
 
-        trailer = pdf_writer.trailer
+        await run_in_executor(pdf_writer.write, pdf_page_tree)
 
-        document_id = PdfString().from_bytes(os.urandom(16))
-        trailer.ID = [document_id, document_id]
+        root = PdfDict()
+        root.indirect = True
+        root.Type = PdfName.Catalog
+        root.Pages = pdf_page_tree
 
         mark_info = PdfDict()
         mark_info.Marked = PdfBool(True)
-        trailer.Root.MarkInfo = mark_info
+        root.MarkInfo = mark_info
 
         struct_tree_root = PdfDict()
         struct_tree_root.Type = PdfName.StructTreeRoot
-        trailer.Root.StructTreeRoot = struct_tree_root
+        root.StructTreeRoot = struct_tree_root
 
-        metadata = PdfDict()
-        metadata.indirect = True
+        metadata = await run_in_executor(_static_stream_dict,
+                                         _xmp_metadata_data)
         metadata.Type = PdfName.Metadata
         metadata.Subtype = PdfName.XML
-        xmp = XMPMeta()
-        xmp.set_property(XMP_NS_PDFA_ID, "part", "2")
-        xmp.set_property(XMP_NS_PDFA_ID, "conformance", "A")
-        metadata_stream = xmp.serialize_to_str().encode("utf-8")
-        metadata.Filter = [PdfName.FlateDecode]
-        metadata.stream = zlib.compress(metadata_stream, 9).decode("latin-1")
-        metadata.Length1 = len(metadata_stream)
-        trailer.Root.Metadata = metadata
+        root.Metadata = metadata
 
-        with BigTemporaryDirectory(prefix="djpdf-") as temp_dir:
-            pdf_writer.write(path.join(temp_dir, "temp.pdf"))
-            cmd = [QPDF_CMD,
-                   "--stream-data=preserve",
-                   "--object-streams=preserve",
-                   "--normalize-content=n",
-                   "--newline-before-endstream"]
-            if LINEARIZE_PDF:
-                cmd.extend(["--linearize"])
-            cmd.extend([path.abspath(path.join(temp_dir, "temp.pdf")),
-                        path.abspath(outfile)])
-            await run_command(cmd, psem)
+        document_id = PdfString().from_bytes(os.urandom(16))
+        await run_in_executor(pdf_writer.close, root, document_id)
+
+
+async def concatenate_pdfs(pdf_filenames, outfile, psem,
+                           linearize=LINEARIZE_PDF):
+    # The document catalog (e.g. metadata) of the first file is kept
+    cmd = _qpdf_command(linearize)
+    cmd.extend([path.abspath(pdf_filenames[0]), "--pages",
+                *map(path.abspath, pdf_filenames), "--",
+                path.abspath(outfile)])
+    await run_command(cmd, psem, operation="concatenate")
+
+
+async def encode_images(recipe, psem, disk_cache, threads=DEFAULT_THREADS,
+                        jbig2_chunk_size=DEFAULT_JBIG2_CHUNK_SIZE):
+    # Stores the encoded images of the pages in the disk cache, where they
+    # are found when the recipe is built later. JBIG2 images that share
+    # their symbol dictionary with other pages are skipped.
+    factory = RecipeFactory(disk_cache, threads, jbig2_chunk_size)
+    # The warning is shown when the recipe is built
+    factory._jbig2_warning = False
+    for page_recipe in recipe["pages"]:
+        factory.make_page(page_recipe)
+    try:
+        await asyncio.gather(*[
+            image.pdf_image(psem) for image in factory._cache.values()
+            if not (isinstance(image, Jbig2Image) and
+                    image.jbig2_threshold != 1 and jbig2_chunk_size > 1)])
+    finally:
+        factory.shutdown()
 
 
 async def build_pdf(recipe, pdf_filename, process_semaphore=None,
-                    progress_cb=None):
+                    progress_cb=None, disk_cache=None,
+                    threads=DEFAULT_THREADS, linearize=LINEARIZE_PDF,
+                    jbig2_chunk_size=DEFAULT_JBIG2_CHUNK_SIZE):
     if process_semaphore is None:
-        process_semaphore = MemoryBoundedSemaphore(
-            PARALLEL_JOBS, JOB_MEMORY, RESERVED_MEMORY)
-    pdf_builder = PdfBuilder(recipe)
-    await pdf_builder.write(pdf_filename, process_semaphore, progress_cb)
+        process_semaphore = MemoryBoundedSemaphore()
+    pdf_builder = PdfBuilder(recipe, disk_cache, threads, jbig2_chunk_size)
+    try:
+        await pdf_builder.write(pdf_filename, process_semaphore, progress_cb,
+                                linearize=linearize)
+    finally:
+        await process_semaphore.memory_profile.flush()
 
 
 def main():
@@ -921,17 +1147,51 @@ def main():
     parser = ArgumentParser()
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
                         action="store_true")
+    parser.add_argument("--cache-dir", metavar="DIRECTORY",
+                        help="reuse results of previous runs from the "
+                             "persistent cache in DIRECTORY")
+    parser.add_argument("--cache-size", metavar="MIB", type=int,
+                        default=DEFAULT_CACHE_SIZE >> 20,
+                        help="maximum size of the persistent cache "
+                             "(default: %(default)d)")
+    parser.add_argument("--threads", metavar="NUMBER", type=int,
+                        default=DEFAULT_THREADS,
+                        help="threads for parsing and compressing PDF data, "
+                             "0 disables them (default: %(default)d)")
+    parser.add_argument("--no-linearize", action="store_true",
+                        help="write the PDF directly without optimizing it "
+                             "for fast web view")
+    parser.add_argument("--jbig2-chunk-size", metavar="IMAGES", type=int,
+                        default=DEFAULT_JBIG2_CHUNK_SIZE,
+                        help="lossy JBIG2 images that share one symbol "
+                             "dictionary and are encoded by one process. "
+                             "Some viewers (e.g. Poppler 0.36) can't show "
+                             "shared dictionaries, 1 disables sharing "
+                             "(default: %(default)d)")
+    cli_add_resource_arguments(parser)
     parser.add_argument("OUTFILE")
     args = parser.parse_args()
     cli_set_verbosity(args.verbose)
+    if args.threads < 0:
+        parser.error("argument --threads: must be >= 0")
+    if args.jbig2_chunk_size < 1:
+        parser.error("argument --jbig2-chunk-size: must be >= 1")
+    process_semaphore = cli_apply_resource_arguments(parser, args)
 
     def progress_cb(fraction):
         json.dump({"fraction": fraction}, sys.stdout)
         print()
         sys.stdout.flush()
     try:
+        disk_cache = None
+        if args.cache_dir is not None:
+            disk_cache = DiskCache(args.cache_dir, args.cache_size << 20)
         recipe = json.load(sys.stdin)
-        asyncio.run(build_pdf(recipe, args.OUTFILE, progress_cb=progress_cb))
+        asyncio.run(build_pdf(recipe, args.OUTFILE, process_semaphore,
+                              progress_cb=progress_cb,
+                              disk_cache=disk_cache, threads=args.threads,
+                              linearize=not args.no_linearize,
+                              jbig2_chunk_size=args.jbig2_chunk_size))
     except Exception:
         logging.debug("Exception occurred:\n%s" % traceback.format_exc())
         logging.fatal("Operation failed")
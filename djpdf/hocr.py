@@ -15,13 +15,14 @@
 
 # Copyright 2015, 2017 Unrud <unrud@outlook.com>
 
+import contextlib
 import json
 import logging
 import re
 import sys
 import traceback
 from argparse import ArgumentParser
-from xml.etree.ElementTree import ElementTree
+from xml.etree.ElementTree import iterparse
 
 from djpdf.util import cli_set_verbosity, cli_setup
 
@@ -33,57 +34,116 @@ else:
     HAS_PIL = True
 
 
+BBOX_REGEX = re.compile(r"bbox((\s+\d+){4})")
+TEXTANGLE_REGEX = re.compile(r"textangle(\s+\d+)")
+TEXTDIRECTIONS = ("ltr", "rtl", "ttb")
+# Columns of tesseract's TSV output
+TSV_COLUMNS = ("level", "page_num", "block_num", "par_num", "line_num",
+               "word_num", "left", "top", "width", "height", "conf", "text")
+TSV_WORD_LEVEL = "5"
+
+
+def _line_textangle(line):
+    try:
+        textangle = TEXTANGLE_REGEX.search(line.attrib["title"]).group(1)
+    except Exception:
+        logging.info("Can't extract textangle from ocr_line: %s" %
+                     line.attrib.get("title"))
+        logging.debug("Exception occurred:\n%s" % traceback.format_exc())
+        textangle = 0
+    return int(textangle)
+
+
+def _word_text(word, textangle):
+    text = ""
+    # Sometimes word has children like "<strong>text</strong>"
+    for e in word.iter():
+        if e.text:
+            text += e.text
+    text = text.strip()
+    if not text:
+        logging.info("ocrx_word with empty text found")
+        return None
+    try:
+        box = BBOX_REGEX.search(word.attrib["title"]).group(1).split()
+    except Exception:
+        logging.info("Can't extract bbox from ocrx_word: %s" %
+                     word.attrib.get("title"))
+        logging.debug(
+            "Exception occurred:\n%s" % traceback.format_exc())
+        return None
+    box = [int(i) for i in box]
+    textdirection = word.get("dir", "ltr")
+    if textdirection not in TEXTDIRECTIONS:
+        logging.info("ocrx_word with unknown textdirection found: %s" %
+                     textdirection)
+        textdirection = "ltr"
+    return {
+        "x": box[0],
+        "y": box[1],
+        "width": box[2] - box[0],
+        "height": box[3] - box[1],
+        "rotation": textangle,
+        "text": text,
+        "direction": textdirection
+    }
+
+
 def extract_text(hocr_filename):
-    bbox_regex = re.compile(r"bbox((\s+\d+){4})")
-    textangle_regex = re.compile(r"textangle(\s+\d+)")
-    hocr = ElementTree()
-    hocr.parse(hocr_filename)
+    # Words are handled when their end tag is parsed and are discarded
+    # afterwards, the document is never held in memory completely
+    textangles = []
     texts = []
-    for line in hocr.iter():
-        if line.attrib.get("class") != "ocr_line":
-            continue
-        try:
-            textangle = textangle_regex.search(line.attrib["title"]).group(1)
-        except Exception:
-            logging.info("Can't extract textangle from ocr_line: %s" %
-                         line.attrib.get("title"))
-            logging.debug("Exception occurred:\n%s" % traceback.format_exc())
-            textangle = 0
-        textangle = int(textangle)
-        for word in line.iter():
-            if word.attrib.get("class") != "ocrx_word":
+    for event, elem in iterparse(hocr_filename, events=("start", "end")):
+        cls = elem.get("class")
+        if cls == "ocr_line":
+            if event == "start":
+                textangles.append(_line_textangle(elem))
+            else:
+                textangles.pop()
+                elem.clear()
+        elif cls == "ocrx_word" and event == "end" and textangles:
+            text = _word_text(elem, textangles[-1])
+            if text is not None:
+                texts.append(text)
+            elem.clear()
+    return texts
+
+
+def extract_text_tsv(tsv_file):
+    """Extract words from the TSV output of tesseract.
+
+    ``tsv_file`` is a filename or a text file object. The TSV format
+    doesn't contain the text angle and direction of lines, they are always
+    0 and "ltr".
+    """
+    texts = []
+    if hasattr(tsv_file, "read"):
+        context = contextlib.nullcontext(tsv_file)
+    else:
+        context = open(tsv_file, encoding="utf-8")
+    with context as f:
+        header = f.readline().rstrip("\r\n").split("\t")
+        if tuple(header) != TSV_COLUMNS:
+            raise ValueError("Unsupported TSV header: %r" % header)
+        for line in f:
+            if not line.startswith(TSV_WORD_LEVEL + "\t"):
                 continue
-            text = ""
-            # Sometimes word has children like "<strong>text</strong>"
-            for e in word.iter():
-                if e.text:
-                    text += e.text
-            text = text.strip()
-            if not text:
-                logging.info("ocrx_word with empty text found")
+            cols = line.rstrip("\r\n").split("\t", len(TSV_COLUMNS) - 1)
+            if len(cols) != len(TSV_COLUMNS):
+                logging.info("Can't extract word from TSV line: %r" % line)
                 continue
-            try:
-                box = bbox_regex.search(word.attrib["title"]).group(1).split()
-            except Exception:
-                logging.info("Can't extract bbox from ocrx_word: %s" %
-                             word.attrib.get("title"))
-                logging.debug(
-                    "Exception occurred:\n%s" % traceback.format_exc())
+            text = cols[11].strip()
+            if not text:
                 continue
-            box = [int(i) for i in box]
-            textdirection = word.get("dir", "ltr")
-            if textdirection not in ("ltr", "rtl", "ttb"):
-                logging.info("ocrx_word with unknown textdirection found: %s" %
-                             textdirection)
-                textdirection = "ltr"
             texts.append({
-                "x": box[0],
-                "y": box[1],
-                "width": box[2] - box[0],
-                "height": box[3] - box[1],
-                "rotation": textangle,
+                "x": int(cols[6]),
+                "y": int(cols[7]),
+                "width": int(cols[8]),
+                "height": int(cols[9]),
+                "rotation": 0,
                 "text": text,
-                "direction": textdirection
+                "direction": "ltr"
             })
     return texts
 
@@ -107,12 +167,18 @@ def main():
     parser = ArgumentParser()
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
                         action="store_true")
+    parser.add_argument("--format", choices=("hocr", "tsv"), default="hocr",
+                        help="format of the tesseract output on stdin "
+                             "(default: %(default)s)")
     if HAS_PIL:
         parser.add_argument('--image', metavar='IMAGE_FILE', action="store")
     args = parser.parse_args()
     cli_set_verbosity(args.verbose)
     try:
-        texts = extract_text(sys.stdin)
+        if args.format == "tsv":
+            texts = extract_text_tsv(sys.stdin)
+        else:
+            texts = extract_text(sys.stdin.buffer)
         print(json.dumps(texts))
         if HAS_PIL and args.image is not None:
             _draw_image(args.image, texts)
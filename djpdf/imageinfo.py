@@ -0,0 +1,741 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import os
+import re
+import struct
+import zlib
+from collections import namedtuple
+
+# dpi is None, if the file doesn't specify the resolution
+ImageInfo = namedtuple("ImageInfo", ["format", "width", "height", "dpi"])
+
+INCH_PER_METER = 0.0254
+INCH_PER_CENTIMETER = 2.54
+# Stop searching for metadata after this many bytes
+MAX_HEADER_SIZE = 1 << 20
+DECOMPRESS_SIZE = 1 << 20
+
+
+class ImageInfoError(ValueError):
+    pass
+
+
+def _read_png(f):
+    f.seek(8)
+    width = height = dpi = None
+    while f.tell() < MAX_HEADER_SIZE:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"IHDR":
+            width, height = struct.unpack(">II", f.read(8))
+            length -= 8
+        elif chunk_type == b"pHYs":
+            x, y, unit = struct.unpack(">IIB", f.read(9))
+            length -= 9
+            if unit == 1:
+                dpi = x * INCH_PER_METER, y * INCH_PER_METER
+        elif chunk_type in (b"IDAT", b"IEND"):
+            break
+        f.seek(length + 4, 1)  # skip data and CRC
+    if width is None:
+        raise ImageInfoError("IHDR chunk missing")
+    return ImageInfo("png", width, height, dpi)
+
+
+def _read_jpeg(f):
+    f.seek(2)
+    width = height = dpi = None
+    while width is None and f.tell() < MAX_HEADER_SIZE:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            break
+        if marker[1] == 0xff:
+            # Fill byte
+            f.seek(-1, 1)
+            continue
+        if 0xd0 <= marker[1] <= 0xd9 or marker[1] == 0x01:
+            # Markers without payload
+            continue
+        length, = struct.unpack(">H", f.read(2))
+        segment = f.read(length - 2)
+        if marker[1] == 0xe0 and segment.startswith(b"JFIF\0"):
+            unit, x, y = struct.unpack(">BHH", segment[7:12])
+            if unit == 1 and x and y:
+                dpi = float(x), float(y)
+            elif unit == 2 and x and y:
+                dpi = x * INCH_PER_CENTIMETER, y * INCH_PER_CENTIMETER
+        elif (0xc0 <= marker[1] <= 0xcf and
+              marker[1] not in (0xc4, 0xc8, 0xcc)):
+            height, width = struct.unpack(">HH", segment[1:5])
+    if width is None:
+        raise ImageInfoError("SOF marker missing")
+    return ImageInfo("jpeg", width, height, dpi)
+
+
+_TIFF_TYPE_FORMATS = {3: "H", 4: "I", 5: "II"}
+
+
+def _read_tiff(f):
+    byte_order = {b"II": "<", b"MM": ">"}[f.read(2)]
+    magic, offset = struct.unpack(byte_order + "HI", f.read(6))
+    if magic != 42:
+        raise ImageInfoError("Unsupported TIFF variant")
+    f.seek(offset)
+    count, = struct.unpack(byte_order + "H", f.read(2))
+    tags = {}
+    for _ in range(count):
+        tag, value_type, value_count, value = struct.unpack(
+            byte_order + "HHI4s", f.read(12))
+        if (tag not in (256, 257, 282, 283, 296) or value_count != 1 or
+                value_type not in _TIFF_TYPE_FORMATS):
+            continue
+        fmt = byte_order + _TIFF_TYPE_FORMATS[value_type]
+        if value_type == 5:
+            # Rationals don't fit into the entry and are stored at offset
+            entry_position = f.tell()
+            f.seek(struct.unpack(byte_order + "I", value)[0])
+            numerator, denominator = struct.unpack(fmt, f.read(8))
+            f.seek(entry_position)
+            tags[tag] = numerator / denominator if denominator else 0
+        else:
+            tags[tag] = struct.unpack_from(fmt, value)[0]
+    if 256 not in tags or 257 not in tags:
+        raise ImageInfoError("Image dimensions missing")
+    dpi = None
+    unit = tags.get(296, 2)
+    if tags.get(282) and tags.get(283) and unit in (2, 3):
+        factor = 1 if unit == 2 else INCH_PER_CENTIMETER
+        dpi = tags[282] * factor, tags[283] * factor
+    return ImageInfo("tiff", tags[256], tags[257], dpi)
+
+
+def _read_jp2_resolution(data):
+    # Prefer capture resolution over default display resolution
+    boxes = {}
+    while len(data) >= 8:
+        length, box_type = struct.unpack(">I4s", data[:8])
+        if length < 8:
+            break
+        boxes[box_type] = data[8:length]
+        data = data[length:]
+    box = boxes.get(b"resc", boxes.get(b"resd"))
+    if box is None or len(box) < 10:
+        return None
+    vn, vd, hn, hd, ve, he = struct.unpack(">HHHHbb", box[:10])
+    if not (vn and vd and hn and hd):
+        return None
+    return (hn / hd * 10 ** he * INCH_PER_METER,
+            vn / vd * 10 ** ve * INCH_PER_METER)
+
+
+def _read_jp2(f):
+    f.seek(0)
+    width = height = dpi = None
+    while f.tell() < MAX_HEADER_SIZE:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, box_type = struct.unpack(">I4s", header)
+        if length == 1:
+            length, = struct.unpack(">Q", f.read(8))
+            length -= 8
+        if box_type == b"jp2h":
+            data = f.read(length - 8)
+            while len(data) >= 8:
+                sub_length, sub_type = struct.unpack(">I4s", data[:8])
+                if sub_length < 8:
+                    break
+                if sub_type == b"ihdr":
+                    height, width = struct.unpack(">II", data[8:16])
+                elif sub_type == b"res ":
+                    dpi = _read_jp2_resolution(data[8:sub_length])
+                data = data[sub_length:]
+            break
+        if length < 8:
+            break
+        f.seek(length - 8, 1)
+    if width is None:
+        raise ImageInfoError("ihdr box missing")
+    return ImageInfo("jp2", width, height, dpi)
+
+
+def _read_pnm(f):
+    # Comments can appear between the fields of the header
+    fields = re.sub(rb"#[^\n]*", b"", f.read(1024)).split(None, 3)
+    if len(fields) < 3 or not fields[1].isdigit() or not fields[2].isdigit():
+        raise ImageInfoError("Invalid PNM header")
+    # The format can't store the resolution
+    return ImageInfo("pnm", int(fields[1]), int(fields[2]), None)
+
+
+def read_image_info(filename):
+    """Returns ImageInfo or None if the format is not supported.
+
+    Raises ImageInfoError or OSError if the file is damaged.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(12)
+        f.seek(0)
+        try:
+            if magic.startswith(b"\x89PNG\r\n\x1a\n"):
+                return _read_png(f)
+            if magic.startswith(b"\xff\xd8"):
+                return _read_jpeg(f)
+            if magic[:4] in (b"II*\0", b"MM\0*"):
+                return _read_tiff(f)
+            if magic == b"\0\0\0\x0cjP  \r\n\x87\n":
+                return _read_jp2(f)
+            if re.match(rb"P[1-6]\s", magic):
+                return _read_pnm(f)
+        except (struct.error, KeyError, ZeroDivisionError) as e:
+            raise ImageInfoError("Damaged %s" % filename) from e
+    return None
+
+
+def _png_unfilter(filter_type, data, prev, bpp):
+    row = bytearray(data)
+    if filter_type == 0:
+        pass
+    elif filter_type == 1:
+        for i in range(bpp, len(row)):
+            row[i] = (row[i] + row[i - bpp]) & 0xff
+    elif filter_type == 2:
+        for i in range(len(row)):
+            row[i] = (row[i] + prev[i]) & 0xff
+    elif filter_type == 3:
+        for i in range(len(row)):
+            left = row[i - bpp] if i >= bpp else 0
+            row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xff
+    elif filter_type == 4:
+        for i in range(len(row)):
+            a = row[i - bpp] if i >= bpp else 0
+            b = prev[i]
+            c = prev[i - bpp] if i >= bpp else 0
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            if pa <= pb and pa <= pc:
+                predictor = a
+            elif pb <= pc:
+                predictor = b
+            else:
+                predictor = c
+            row[i] = (row[i] + predictor) & 0xff
+    else:
+        raise ImageInfoError("Invalid PNG filter type")
+    return bytes(row)
+
+
+def _png_filter(filter_type, row, prev, bpp):
+    # Inverse of _png_unfilter
+    filtered = bytearray(len(row))
+    for i in range(len(row)):
+        a = row[i - bpp] if i >= bpp else 0
+        b = prev[i]
+        c = prev[i - bpp] if i >= bpp else 0
+        if filter_type == 0:
+            predictor = 0
+        elif filter_type == 1:
+            predictor = a
+        elif filter_type == 2:
+            predictor = b
+        elif filter_type == 3:
+            predictor = (a + b) >> 1
+        else:
+            p = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            if pa <= pb and pa <= pc:
+                predictor = a
+            elif pb <= pc:
+                predictor = b
+            else:
+                predictor = c
+        filtered[i] = (row[i] - predictor) & 0xff
+    return bytes(filtered)
+
+
+def _png_expected_row(width, bit_depth, color_type, palette, color):
+    # Returns the raw row of an image that only contains color, or None if
+    # the color can't be represented
+    r, g, b = color
+    if color_type == 3:
+        indices = [i for i, entry in enumerate(palette) if entry == color]
+        if len(indices) != 1:
+            return None
+        samples = [indices[0]]
+    elif color_type == 0:
+        maximum = (1 << bit_depth) - 1
+        if not (r == g == b) or (r * maximum) % 0xff != 0:
+            return None
+        samples = [r * maximum // 0xff]
+    elif color_type == 2:
+        samples = [r, g, b]
+        if bit_depth == 16:
+            samples = [v * 0x101 for v in samples]
+    else:
+        return None
+    if bit_depth == 16:
+        return b"".join(struct.pack(">H", v) for v in samples) * width
+    if bit_depth == 8:
+        return bytes(samples) * width
+    # Pack samples into bytes, the unused bits at the end of the row are zero
+    bits = "".join(format(samples[0], "0%db" % bit_depth) * width)
+    bits += "0" * (-len(bits) % 8)
+    return int(bits, 2).to_bytes(len(bits) // 8, "big")
+
+
+def is_plain_color_png(filename, color):
+    """Checks if all pixels of a PNG file have the RGB color.
+
+    Stops reading at the first row with a different pixel. Returns None if
+    the PNG variant is not supported.
+    """
+    with open(filename, "rb") as f:
+        if f.read(8) != b"\x89PNG\r\n\x1a\n":
+            return None
+        decompressor = zlib.decompressobj()
+        palette = []
+        expected_row = expected_filtered = bpp = row_size = None
+        prev = buffer = b""
+        rows = 0
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ImageInfoError("Truncated PNG")
+            length, chunk_type = struct.unpack(">I4s", header)
+            data = f.read(length)
+            f.seek(4, 1)  # CRC
+            if chunk_type == b"IHDR":
+                (width, height, bit_depth, color_type, _, _,
+                 interlace) = struct.unpack(">IIBBBBB", data)
+                if interlace != 0 or color_type not in (0, 2, 3):
+                    return None
+                channels = 3 if color_type == 2 else 1
+                bpp = max(1, channels * bit_depth // 8)
+                row_size = (width * channels * bit_depth + 7) // 8
+                prev = bytes(row_size)
+            elif chunk_type == b"PLTE":
+                # Only a suggested palette for other color types
+                if color_type == 3:
+                    palette = [tuple(data[i:i + 3])
+                               for i in range(0, len(data) - 2, 3)]
+            elif chunk_type == b"tRNS":
+                return None
+            elif chunk_type == b"IDAT":
+                if expected_row is None and len(palette) == 1:
+                    # All pixels must use the only entry
+                    return palette[0] == tuple(color)
+                if expected_row is None:
+                    expected_row = _png_expected_row(
+                        width, bit_depth, color_type, palette, tuple(color))
+                    if expected_row is None:
+                        return False
+                    # Filtered rows of the plain image for every filter type,
+                    # for the first and for all following rows
+                    expected_filtered = {
+                        (filter_type, first): _png_filter(
+                            filter_type, expected_row,
+                            bytes(row_size) if first else expected_row, bpp)
+                        for filter_type in range(5) for first in (True, False)}
+                while data:
+                    # Plain images compress well, limit the decompressed size
+                    buffer += decompressor.decompress(data, DECOMPRESS_SIZE)
+                    data = decompressor.unconsumed_tail
+                    offset = 0
+                    while len(buffer) - offset > row_size and rows < height:
+                        filter_type = buffer[offset]
+                        filtered = buffer[offset + 1:offset + row_size + 1]
+                        offset += row_size + 1
+                        if prev == expected_row or rows == 0:
+                            if filtered == expected_filtered.get(
+                                    (filter_type, rows == 0)):
+                                prev = expected_row
+                                rows += 1
+                                continue
+                        row = _png_unfilter(filter_type, filtered, prev, bpp)
+                        if not _png_rows_equal(row, expected_row, width,
+                                               channels * bit_depth):
+                            return False
+                        prev = row
+                        rows += 1
+                    buffer = buffer[offset:]
+            elif chunk_type == b"IEND":
+                return rows == height
+
+
+def _png_rows_equal(row, expected_row, width, bits_per_pixel):
+    # Ignore the unused bits at the end of the row
+    used_bits = width * bits_per_pixel
+    if used_bits % 8 == 0:
+        return row == expected_row
+    full_bytes = used_bits // 8
+    mask = (0xff << (8 - used_bits % 8)) & 0xff
+    return (row[:full_bytes] == expected_row[:full_bytes] and
+            row[full_bytes] & mask == expected_row[full_bytes] & mask)
+
+
+# Encoded image data that can be embedded in a PDF as it is. ranges are the
+# (offset, length) pairs of the stream data in the file. palette contains
+# the RGB entries of indexed images or is None.
+ImageStream = namedtuple("ImageStream", [
+    "filter", "decode_parms", "width", "height", "components",
+    "bits_per_component", "palette", "ranges"])
+
+
+def _png_stream(f, file_size):
+    # The IDAT chunks are deflate data with PNG predictors
+    f.seek(8)
+    header = palette = None
+    ranges = []
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise ImageInfoError("Truncated PNG")
+        length, chunk_type = struct.unpack(">I4s", chunk_header)
+        if chunk_type == b"IHDR":
+            header = struct.unpack(">IIBBBBB", f.read(13))
+            length -= 13
+        elif chunk_type == b"PLTE":
+            palette = f.read(length)
+            length = 0
+        elif chunk_type == b"IDAT":
+            ranges.append((f.tell(), length))
+        elif chunk_type == b"IEND":
+            break
+        f.seek(length + 4, 1)  # skip data and CRC
+    if header is None or not ranges or ranges[-1][0] + ranges[-1][1] > (
+            file_size):
+        raise ImageInfoError("Damaged PNG")
+    width, height, bit_depth, color_type, _, _, interlace = header
+    if interlace != 0 or color_type not in (0, 2, 3):
+        raise ImageInfoError("Unsupported PNG variant")
+    if color_type == 3 and palette is None:
+        raise ImageInfoError("PLTE chunk missing")
+    components = 3 if color_type == 2 else 1
+    decode_parms = {"Predictor": 15, "Colors": components,
+                    "BitsPerComponent": bit_depth, "Columns": width}
+    return ImageStream("FlateDecode", decode_parms, width, height,
+                       components, bit_depth,
+                       palette if color_type == 3 else None, ranges)
+
+
+def _jpeg_stream(f, file_size):
+    f.seek(2)
+    while f.tell() < MAX_HEADER_SIZE:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            break
+        if marker[1] == 0xff:
+            # Fill byte
+            f.seek(-1, 1)
+            continue
+        if 0xd0 <= marker[1] <= 0xd9 or marker[1] == 0x01:
+            # Markers without payload
+            continue
+        length, = struct.unpack(">H", f.read(2))
+        segment = f.read(length - 2)
+        if (0xc0 <= marker[1] <= 0xcf and
+                marker[1] not in (0xc4, 0xc8, 0xcc)):
+            precision, height, width, components = struct.unpack(
+                ">BHHB", segment[:6])
+            if components not in (1, 3) or precision != 8:
+                raise ImageInfoError("Unsupported JPEG variant")
+            return ImageStream("DCTDecode", None, width, height, components,
+                               precision, None, [(0, file_size)])
+    raise ImageInfoError("SOF marker missing")
+
+
+def _jp2_stream(f, file_size):
+    f.seek(0)
+    while f.tell() < MAX_HEADER_SIZE:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, box_type = struct.unpack(">I4s", header)
+        if length == 1:
+            length, = struct.unpack(">Q", f.read(8))
+            length -= 8
+        if box_type == b"jp2h":
+            data = f.read(length - 8)
+            while len(data) >= 8:
+                sub_length, sub_type = struct.unpack(">I4s", data[:8])
+                if sub_length < 8:
+                    break
+                if sub_type == b"ihdr":
+                    height, width, components, bits = struct.unpack(
+                        ">IIHB", data[8:19])
+                    if components not in (1, 3) or bits & 0x80:
+                        raise ImageInfoError(
+                            "Unsupported JPEG 2000 variant")
+                    return ImageStream("JPXDecode", None, width, height,
+                                       components, (bits & 0x7f) + 1, None,
+                                       [(0, file_size)])
+                data = data[sub_length:]
+            break
+        if length < 8:
+            break
+        f.seek(length - 8, 1)
+    raise ImageInfoError("ihdr box missing")
+
+
+_TIFF_TYPE_SIZES = {3: 2, 4: 4}
+
+
+def _read_tiff_tags(f):
+    # Returns the tags of the first image with integer values as tuples
+    byte_order = {b"II": "<", b"MM": ">"}[f.read(2)]
+    magic, offset = struct.unpack(byte_order + "HI", f.read(6))
+    if magic != 42:
+        raise ImageInfoError("Unsupported TIFF variant")
+    f.seek(offset)
+    count, = struct.unpack(byte_order + "H", f.read(2))
+    tags = {}
+    for _ in range(count):
+        tag, value_type, value_count, value = struct.unpack(
+            byte_order + "HHI4s", f.read(12))
+        if value_type not in _TIFF_TYPE_SIZES:
+            continue
+        fmt = byte_order + "HI"[value_type == 4] * value_count
+        if value_count * _TIFF_TYPE_SIZES[value_type] > 4:
+            # Values that don't fit into the entry are stored at offset
+            entry_position = f.tell()
+            f.seek(struct.unpack(byte_order + "I", value)[0])
+            tags[tag] = struct.unpack(fmt, f.read(struct.calcsize(fmt)))
+            f.seek(entry_position)
+        else:
+            tags[tag] = struct.unpack_from(fmt, value)
+    return tags
+
+
+def _is_bilevel_tiff(tags):
+    # Black and white without palette or extra samples
+    return (tags.get(258, (1,)) == (1,) and tags.get(277, (1,)) == (1,) and
+            tags.get(262) in ((0,), (1,)) and 338 not in tags)
+
+
+def _g4_tiff_stream(f, file_size):
+    tags = _read_tiff_tags(f)
+    width, = tags[256]
+    height, = tags[257]
+    if (tags.get(259) != (4,) or not _is_bilevel_tiff(tags) or
+            tags.get(266, (1,)) != (1,)):
+        raise ImageInfoError("Unsupported TIFF variant")
+    if len(tags[273]) != 1:
+        # CCITT strips can't be concatenated
+        raise ImageInfoError("TIFF with multiple strips")
+    ranges = [(tags[273][0], tags[279][0])]
+    if ranges[0][0] + ranges[0][1] > file_size:
+        raise ImageInfoError("Damaged TIFF")
+    decode_parms = {"K": -1, "Columns": width, "Rows": height,
+                    "BlackIs1": tags[262] == (1,)}
+    return ImageStream("CCITTFaxDecode", decode_parms, width, height, 1, 1,
+                       None, ranges)
+
+
+def read_image_stream(filename):
+    """Returns ImageStream for PNG, JPEG, JPEG 2000 and CCITT Group 4 TIFF
+    files.
+
+    Raises ImageInfoError if the format or variant is not supported.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(12)
+        file_size = os.fstat(f.fileno()).st_size
+        f.seek(0)
+        try:
+            if magic.startswith(b"\x89PNG\r\n\x1a\n"):
+                return _png_stream(f, file_size)
+            if magic.startswith(b"\xff\xd8"):
+                return _jpeg_stream(f, file_size)
+            if magic[:4] in (b"II*\0", b"MM\0*"):
+                return _g4_tiff_stream(f, file_size)
+            if magic == b"\0\0\0\x0cjP  \r\n\x87\n":
+                return _jp2_stream(f, file_size)
+        except ImageInfoError:
+            raise
+        except (struct.error, KeyError, ValueError) as e:
+            raise ImageInfoError("Damaged %s" % filename) from e
+    raise ImageInfoError("Unsupported format: %s" % filename)
+
+
+def _is_srgb_icc_profile(data):
+    # Profiles are identified by their description, e.g. "sRGB IEC61966-2.1"
+    count, = struct.unpack(">I", data[128:132])
+    for i in range(count):
+        signature, offset, size = struct.unpack(
+            ">4sII", data[132 + i * 12:144 + i * 12])
+        if signature == b"desc":
+            # ASCII in version 2 profiles, UTF-16 in version 4 profiles
+            description = data[offset:offset + size]
+            return (b"sRGB" in description or
+                    "sRGB".encode("utf-16-be") in description)
+    return False
+
+
+def _is_unchanged_jpeg(f):
+    f.seek(2)
+    icc_profile = b""
+    while f.tell() < MAX_HEADER_SIZE:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+            break
+        if marker[1] == 0xff:
+            # Fill byte
+            f.seek(-1, 1)
+            continue
+        if 0xd0 <= marker[1] <= 0xd9 or marker[1] == 0x01:
+            # Markers without payload
+            continue
+        length, = struct.unpack(">H", f.read(2))
+        segment = f.read(length - 2)
+        if marker[1] == 0xe2 and segment.startswith(b"ICC_PROFILE\0"):
+            # The profile can be split into multiple segments
+            icc_profile += segment[14:]
+        elif marker[1] in (0xc0, 0xc1, 0xc2):
+            # Baseline, extended sequential and progressive Huffman coding
+            precision, _, _, components = struct.unpack(">BHHB",
+                                                        segment[:6])
+            if precision != 8 or components != 3:
+                return False
+        elif 0xc3 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8,
+                                                             0xcc):
+            return False
+        elif marker[1] == 0xda:
+            # Start of scan, all frame headers were read
+            return not icc_profile or _is_srgb_icc_profile(icc_profile)
+    return False
+
+
+def _is_unchanged_jp2(f):
+    f.seek(0)
+    while f.tell() < MAX_HEADER_SIZE:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, box_type = struct.unpack(">I4s", header)
+        if length == 1:
+            length, = struct.unpack(">Q", f.read(8))
+            length -= 8
+        if box_type == b"jp2h":
+            data = f.read(length - 8)
+            components = colorspace = None
+            while len(data) >= 8:
+                sub_length, sub_type = struct.unpack(">I4s", data[:8])
+                if sub_length < 8:
+                    break
+                if sub_type == b"ihdr":
+                    components, bits = struct.unpack(">HB", data[16:19])
+                    if bits != 7:
+                        return False
+                elif sub_type == b"colr" and colorspace is None:
+                    method, = struct.unpack(">B", data[8:9])
+                    if method == 1:
+                        colorspace, = struct.unpack(">I", data[11:15])
+                elif sub_type == b"cdef":
+                    # Channel definitions, e.g. for alpha channels
+                    return False
+                data = data[sub_length:]
+            return components == 3 and colorspace == 16  # sRGB
+        if length < 8:
+            break
+        f.seek(length - 8, 1)
+    return False
+
+
+def _is_unchanged_g4_tiff(f, file_size):
+    try:
+        _g4_tiff_stream(f, file_size)
+    except (ImageInfoError, KeyError, ValueError):
+        return False
+    return True
+
+
+def is_unchanged_compatible(filename, compression):
+    """Checks if the file is a JPEG ("jpeg") or JPEG 2000 ("jp2") file with
+    8-bit sRGB colors or a CCITT Group 4 TIFF file ("fax"), that can be
+    embedded in the PDF as it is.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(12)
+        file_size = os.fstat(f.fileno()).st_size
+        f.seek(0)
+        try:
+            if compression == "jpeg" and magic.startswith(b"\xff\xd8"):
+                return _is_unchanged_jpeg(f)
+            if (compression == "jp2" and
+                    magic == b"\0\0\0\x0cjP  \r\n\x87\n"):
+                return _is_unchanged_jp2(f)
+            if compression == "fax" and magic[:4] in (b"II*\0", b"MM\0*"):
+                return _is_unchanged_g4_tiff(f, file_size)
+        except struct.error:
+            return False
+    return False
+
+
+def _is_bilevel_png(f):
+    f.seek(12)
+    if f.read(4) != b"IHDR":
+        return False
+    bit_depth, color_type = struct.unpack(">8xBB3x", f.read(13))
+    if bit_depth != 1 or color_type != 0:
+        return False
+    f.seek(4, 1)  # CRC
+    while f.tell() < MAX_HEADER_SIZE:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"tRNS":
+            # Transparent pixels are replaced with the background color
+            return False
+        if chunk_type in (b"IDAT", b"IEND"):
+            return True
+        f.seek(length + 4, 1)  # skip data and CRC
+    return False
+
+
+def is_bilevel_image(filename):
+    """Checks if the file is a black and white TIFF, PNG or PBM file.
+
+    The pixels of these files are only black or white without decoding
+    them.
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(12)
+        f.seek(0)
+        try:
+            if magic.startswith(b"\x89PNG\r\n\x1a\n"):
+                return _is_bilevel_png(f)
+            if magic[:4] in (b"II*\0", b"MM\0*"):
+                return _is_bilevel_tiff(_read_tiff_tags(f))
+            return re.match(rb"P[14]\s", magic) is not None
+        except (struct.error, KeyError):
+            return False
+
+
+def image_pixels(filename):
+    """Returns the number of pixels of the image or None if it's not
+    known."""
+    try:
+        info = read_image_info(filename)
+    except (ImageInfoError, OSError):
+        return None
+    if info is None:
+        return None
+    return info.width * info.height
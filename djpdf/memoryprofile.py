@@ -0,0 +1,222 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import tempfile
+from os import path
+
+import psutil
+
+# Path of the profile file, an empty value disables the file
+PROFILE_ENV = "DJPDF_MEMORY_PROFILE"
+PROFILE_VERSION = 1
+# Memory of a program that processes no pixels
+BASE_MEMORY = 32 << 20
+# Initial bytes per pixel by program, before anything was measured.
+# ImageMagick uses 8 bytes per pixel for each copy of an image.
+DEFAULT_BYTES_PER_PIXEL = {
+    "convert": 24,
+    "identify": 8,
+    "jbig2": 2,
+    "tesseract": 8,
+}
+# Initial duration of commands in seconds per pixel
+DEFAULT_SECONDS_PER_PIXEL = 1e-7
+# Estimates follow higher peaks immediately and decay slowly towards
+# lower ones. Durations are averaged.
+DECAY = 0.9
+SAFETY_FACTOR = 1.25
+# Estimates are only written when they changed by more than this
+SAVE_THRESHOLD = 0.05
+
+
+def default_profile_filename():
+    filename = os.environ.get(PROFILE_ENV)
+    if filename is not None:
+        return filename or None
+    cache_home = os.environ.get("XDG_CACHE_HOME") or path.join(
+        path.expanduser("~"), ".cache")
+    return path.join(cache_home, "djpdf", "memory-profile.json")
+
+
+def peak_memory(pid):
+    """Highest resident memory of the running process ``pid`` so far or
+    its current resident memory, where the peak isn't known."""
+    with contextlib.suppress(OSError, ValueError):
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) << 10
+    with contextlib.suppress(psutil.Error):
+        return psutil.Process(pid).memory_info().rss
+    return None
+
+
+def _changed(old, value):
+    return old is None or abs(value - old) > old * SAVE_THRESHOLD
+
+
+class MemoryProfile:
+    """Estimates the peak memory and the duration of external programs.
+
+    Commands are identified by the program and an operation. The memory
+    is modeled as ``BASE_MEMORY`` plus bytes per processed pixel, or as a
+    constant when the number of pixels is unknown. Durations are modeled
+    in the same way without a base. The estimates are refined with the
+    measured peak memory and duration of commands. The changed estimates
+    are merged into ``filename`` by ``flush``.
+    """
+
+    def __init__(self, filename=None):
+        self._filename = filename
+        self._entries = {}
+        self._durations = {}
+        # Keys of the estimates that changed since the last flush by name
+        self._changed_keys = {"estimates": set(), "durations": set()}
+        if filename is not None:
+            self._entries, self._durations = self._read()
+
+    @classmethod
+    def default(cls):
+        return cls(default_profile_filename())
+
+    @staticmethod
+    def _key(program, operation, pixels):
+        return "%s %s %s" % (path.basename(program), operation or "-",
+                             "pixel" if pixels else "constant")
+
+    def _read(self):
+        entries, durations = {}, {}
+        try:
+            with open(self._filename) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return entries, durations
+        except (OSError, ValueError) as e:
+            logging.warning("Failed to read memory profile %r: %s",
+                            self._filename, e)
+            return entries, durations
+        if (not isinstance(data, dict) or
+                data.get("version") != PROFILE_VERSION):
+            return entries, durations
+        for name, values in [("estimates", entries),
+                             ("durations", durations)]:
+            for key, value in data.get(name, {}).items():
+                if isinstance(value, (int, float)) and value >= 0:
+                    values[key] = value
+        return entries, durations
+
+    def _take_changes(self):
+        changes = {
+            "estimates": {key: self._entries[key]
+                          for key in self._changed_keys["estimates"]},
+            "durations": {key: self._durations[key]
+                          for key in self._changed_keys["durations"]}}
+        for keys in self._changed_keys.values():
+            keys.clear()
+        return changes
+
+    def _save(self, changes):
+        # Other processes can update the profile at the same time, their
+        # estimates are kept
+        entries, durations = self._read()
+        entries.update(changes["estimates"])
+        durations.update(changes["durations"])
+        directory = path.dirname(path.abspath(self._filename))
+        data = {"version": PROFILE_VERSION, "estimates": entries,
+                "durations": durations}
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, temp_filename = tempfile.mkstemp(
+                dir=directory, prefix=".memory-profile-")
+            try:
+                with open(fd, "w") as f:
+                    json.dump(data, f, indent=1, sort_keys=True)
+                os.replace(temp_filename, self._filename)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(temp_filename)
+                raise
+        except OSError as e:
+            logging.warning("Failed to write memory profile %r: %s",
+                            self._filename, e)
+
+    async def flush(self):
+        """Merges the changed estimates into the profile file. The file is
+        written in the default executor of the running loop."""
+        if self._filename is None or not any(self._changed_keys.values()):
+            return
+        changes = self._take_changes()
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._save, changes)
+
+    def estimate(self, program, operation=None, pixels=None):
+        """Estimated peak memory of the command in bytes or None, if
+        nothing is known about it."""
+        key = self._key(program, operation, pixels)
+        value = self._entries.get(key)
+        if pixels:
+            if value is None:
+                value = DEFAULT_BYTES_PER_PIXEL.get(path.basename(program))
+                if value is None:
+                    return None
+            return int(BASE_MEMORY + value * pixels * SAFETY_FACTOR)
+        if value is None:
+            return None
+        return int(value * SAFETY_FACTOR)
+
+    def estimate_duration(self, program, operation=None, pixels=None):
+        """Estimated duration of the command in seconds, 0 if nothing is
+        known about it."""
+        value = self._durations.get(self._key(program, operation, pixels))
+        if pixels:
+            if value is None:
+                value = DEFAULT_SECONDS_PER_PIXEL
+            return value * pixels
+        return value or 0
+
+    def record(self, program, operation, pixels, memory, duration=None):
+        """Refines the estimates of the command with its measured peak
+        memory (None if unknown) and duration. The file isn't written."""
+        key = self._key(program, operation, pixels)
+        if memory is not None:
+            if pixels:
+                observed = max(0, memory - BASE_MEMORY) / pixels
+            else:
+                observed = memory
+            old = self._entries.get(key)
+            if old is None:
+                value = observed
+            else:
+                value = max(observed, old * DECAY + observed * (1 - DECAY))
+            self._entries[key] = value
+            if _changed(old, value):
+                self._changed_keys["estimates"].add(key)
+        if duration is not None:
+            observed = duration / pixels if pixels else duration
+            old = self._durations.get(key)
+            if old is None:
+                value = observed
+            else:
+                value = old * DECAY + observed * (1 - DECAY)
+            self._durations[key] = value
+            if _changed(old, value):
+                self._changed_keys["durations"].add(key)
@@ -0,0 +1,191 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import asyncio
+import contextlib
+import importlib.util
+import logging
+import multiprocessing
+import os
+
+# tesserocr is only imported by the worker processes, after the thread
+# limit is set
+HAS_TESSEROCR = importlib.util.find_spec("tesserocr") is not None
+WORKER_JOIN_TIMEOUT = 5
+
+
+class OcrWorkerError(Exception):
+    pass
+
+
+def _worker_main(conn, language):
+    os.environ["OMP_THREAD_LIMIT"] = "1"
+    try:
+        import tesserocr
+        api = tesserocr.PyTessBaseAPI(lang=language)
+    except Exception as e:
+        conn.send((False, "%s: %s" % (type(e).__name__, e)))
+        return
+    with api:
+        conn.send((True, None))
+        while True:
+            try:
+                job = conn.recv()
+            except EOFError:
+                break
+            if job is None:
+                break
+            filename, dpi = job
+            try:
+                api.SetImageFile(filename)
+                api.SetSourceResolution(dpi)
+                result = (True, api.GetHOCRText(0))
+            except Exception as e:
+                result = (False, "%s: %s" % (type(e).__name__, e))
+            conn.send(result)
+
+
+class _Worker:
+    def __init__(self, context, language):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, language), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self._ready = False
+
+    def _recv(self):
+        try:
+            return self.conn.recv()
+        except (EOFError, OSError) as e:
+            raise OcrWorkerError("OCR worker exited unexpectedly") from e
+
+    def wait_ready(self):
+        # Blocks until the language data is loaded
+        if not self._ready:
+            ok, error = self._recv()
+            if not ok:
+                raise OcrWorkerError(error)
+            self._ready = True
+
+    def hocr(self, filename, dpi):
+        self.wait_ready()
+        self.conn.send((filename, dpi))
+        ok, result = self._recv()
+        if not ok:
+            raise OcrWorkerError(result)
+        return result
+
+    def close(self, kill=False):
+        if kill:
+            self.process.kill()
+        else:
+            with contextlib.suppress(OSError):
+                self.conn.send(None)
+        self.process.join(WORKER_JOIN_TIMEOUT)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class OcrWorkerPool:
+    """Long-lived tesseract engines, each worker loads one language.
+
+    Loading the language data is done once per worker instead of once per
+    page. Workers are started on demand and their processes are accounted
+    for by the process semaphore while they recognize a page. At most
+    ``max_workers`` workers exist, idle workers of other languages are
+    stopped to make room for new ones.
+    """
+
+    def __init__(self, max_workers):
+        if max_workers < 1:
+            raise ValueError("max_workers must be >= 1")
+        self._context = multiprocessing.get_context("spawn")
+        self._max_workers = max_workers
+        self._idle = {}
+        self._worker_count = 0
+        self._unavailable = {}
+        self._condition = asyncio.Condition()
+
+    async def _get_worker(self, language):
+        async with self._condition:
+            while True:
+                if language in self._unavailable:
+                    raise OcrWorkerError(self._unavailable[language])
+                idle = self._idle.setdefault(language, [])
+                if idle:
+                    return idle.pop()
+                if self._worker_count >= self._max_workers:
+                    self._stop_idle_worker()
+                if self._worker_count < self._max_workers:
+                    self._worker_count += 1
+                    logging.debug("Starting OCR worker: %s", language)
+                    return _Worker(self._context, language)
+                await self._condition.wait()
+
+    def _stop_idle_worker(self):
+        for workers in self._idle.values():
+            if workers:
+                # Idle workers don't process anything
+                workers.pop().close(kill=True)
+                self._worker_count -= 1
+                return
+
+    async def _put_worker(self, language, worker, failed):
+        async with self._condition:
+            if failed:
+                self._worker_count -= 1
+            else:
+                self._idle[language].append(worker)
+            self._condition.notify_all()
+
+    async def hocr(self, filename, dpi, language, psem):
+        loop = asyncio.get_running_loop()
+        async with psem:
+            worker = await self._get_worker(language)
+            failed = True
+            psem.add_pid(worker.process.pid)
+            try:
+                try:
+                    await loop.run_in_executor(None, worker.wait_ready)
+                except OcrWorkerError as e:
+                    logging.warning("Can't load OCR language %r: %s",
+                                    language, e)
+                    self._unavailable[language] = str(e)
+                    raise
+                try:
+                    result = await loop.run_in_executor(
+                        None, worker.hocr, filename, dpi)
+                except OcrWorkerError as e:
+                    logging.warning("OCR worker failed: %s", e)
+                    raise
+                failed = False
+            finally:
+                psem.remove_pid(worker.process.pid)
+                if failed:
+                    worker.close(kill=True)
+                await self._put_worker(language, worker, failed)
+        return result
+
+    def close(self):
+        for workers in self._idle.values():
+            for worker in workers:
+                worker.close()
+        self._idle.clear()
+        self._worker_count = 0
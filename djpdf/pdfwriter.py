@@ -0,0 +1,264 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import os
+import threading
+import zlib
+
+from pdfrw.objects import PdfArray, PdfDict, PdfName, PdfString
+
+PDF_VERSION = "1.5"
+OBJECTS_PER_STREAM = 100
+# Arrays and dictionaries that are longer are split into multiple lines
+MAX_LINE_LENGTH = 70
+COPY_BUFFER_SIZE = 1 << 20
+
+
+def _format_number(f):
+    # PDFs don't handle exponent notation
+    return ("%.9f" % f).rstrip("0").rstrip(".")
+
+
+def _join(items, template):
+    if sum(map(len, items)) + len(items) <= MAX_LINE_LENGTH:
+        return template % " ".join(items)
+    return template % "\n".join(items)
+
+
+def _length(data):
+    if isinstance(data, memoryview):
+        return data.nbytes
+    return len(data)
+
+
+class FileStream:
+    """Stream data that stays in a file until it's written.
+
+    Can be used as ``PdfDict.stream`` instead of ``bytes``. ``ranges`` are
+    the (offset, length) pairs of the data in the file, by default the whole
+    file is used. The file must not be changed or removed before the PDF is
+    written.
+    """
+
+    def __init__(self, filename, ranges=None):
+        self.filename = filename
+        if ranges is None:
+            ranges = [(0, os.path.getsize(filename))]
+        self.ranges = tuple(ranges)
+        self.length = sum(length for _, length in self.ranges)
+
+    def __len__(self):
+        return self.length
+
+    def chunks(self):
+        with open(self.filename, "rb") as f:
+            for offset, remaining in self.ranges:
+                f.seek(offset)
+                while remaining > 0:
+                    data = f.read(min(remaining, COPY_BUFFER_SIZE))
+                    if not data:
+                        raise EOFError("Unexpected end of file: %s" %
+                                       self.filename)
+                    remaining -= len(data)
+                    yield data
+
+
+class StreamingPdfWriter:
+    """Writes pdfrw objects to a file as soon as they are complete.
+
+    Indirect objects are numbered when they are reserved or first
+    referenced. ``write`` serializes an object together with all new
+    indirect objects that are reachable from it, reserved objects are
+    only referenced. Objects without a stream are collected in compressed
+    object streams. ``close`` writes the cross-reference stream.
+    Stream data can be ``bytes``, any other bytes-like object or a
+    ``FileStream``, it's written without copying it in memory. ``str`` is
+    accepted for objects that are read with pdfrw.
+    The methods can be called from multiple threads.
+    """
+
+    def __init__(self, f, version=PDF_VERSION,
+                 objects_per_stream=OBJECTS_PER_STREAM):
+        self._f = f
+        self._lock = threading.Lock()
+        self._objects_per_stream = objects_per_stream
+        # Maps ids of objects to their object numbers. The objects are
+        # kept alive, so that the ids are not reused.
+        self._numbers = {}
+        self._objects = []
+        self._reserved = set()
+        # Entries of the cross-reference stream by object number:
+        # (1, offset) or (2, object stream number, index)
+        self._xref = [None]
+        self._pending = []
+        header = ("%%PDF-%s\n%%\xe2\xe3\xcf\xd3\n" % version).encode("latin-1")
+        self._f.write(header)
+        self._offset = len(header)
+
+    def _number(self, obj):
+        number = self._numbers.get(id(obj))
+        if number is None:
+            number = len(self._xref)
+            self._xref.append(None)
+            self._numbers[id(obj)] = number
+            self._objects.append(obj)
+        return number
+
+    def reserve(self, obj):
+        """Number ``obj`` so that it can be referenced before it's
+        written."""
+        with self._lock:
+            number = self._number(obj)
+            if self._xref[number] is None:
+                self._reserved.add(number)
+            return number
+
+    def write(self, obj):
+        with self._lock:
+            number = self._number(obj)
+            if self._xref[number] is not None:
+                return number
+            self._reserved.discard(number)
+            unwritten = [(number, obj)]
+            while unwritten:
+                self._write_object(*unwritten.pop(), unwritten)
+            return number
+
+    def _write_object(self, number, obj, unwritten):
+        def ref(value):
+            indirect = getattr(value, "indirect", False)
+            if isinstance(value, PdfDict) and value.stream is not None:
+                indirect = True
+            if not indirect:
+                return self._format(value, ref)
+            known = id(value) in self._numbers
+            value_number = self._number(value)
+            if not known:
+                unwritten.append((value_number, value))
+            return "%d 0 R" % value_number
+        if isinstance(obj, PdfDict) and obj.stream is not None:
+            stream = obj.stream
+            if isinstance(stream, str):
+                stream = stream.encode("latin-1")
+            elif not isinstance(stream, FileStream):
+                stream = memoryview(stream)
+            items = [(k, v) for k, v in obj.iteritems()
+                     if k != PdfName.Length]
+            data = "%s\nstream\n" % self._format_dict(
+                items + [(PdfName.Length, _length(stream))], ref)
+            self._write_raw(number, data.encode("latin-1"), stream,
+                            b"\nendstream")
+            return
+        self._xref[number] = (2, None, len(self._pending))
+        self._pending.append((number, self._format(obj, ref)))
+        if len(self._pending) >= self._objects_per_stream:
+            self._flush_object_stream()
+
+    def _write_raw(self, number, *chunks):
+        self._xref[number] = (1, self._offset)
+        for data in (b"%d 0 obj\n" % number, *chunks, b"\nendobj\n"):
+            if isinstance(data, FileStream):
+                for file_data in data.chunks():
+                    self._f.write(file_data)
+            else:
+                self._f.write(data)
+            self._offset += _length(data)
+
+    def _flush_object_stream(self):
+        if not self._pending:
+            return
+        number = len(self._xref)
+        self._xref.append(None)
+        index = []
+        objects = []
+        position = 0
+        for i, (object_number, data) in enumerate(self._pending):
+            self._xref[object_number] = (2, number, i)
+            index.append("%d %d" % (object_number, position))
+            data = data.encode("latin-1") + b"\n"
+            objects.append(data)
+            position += len(data)
+        first = " ".join(index).encode("latin-1") + b"\n"
+        stream = zlib.compress(first + b"".join(objects), 9)
+        self._pending = []
+        self._write_raw(number, b"<</Type /ObjStm /N %d /First %d "
+                                b"/Filter /FlateDecode /Length %d>>\n"
+                                b"stream\n" % (
+                                    len(objects), len(first), len(stream)),
+                        stream, b"\nendstream")
+
+    def _format_dict(self, items, ref):
+        return _join(["%s %s" % (getattr(k, "encoded", None) or k, ref(v))
+                      for k, v in items], "<<%s>>")
+
+    def _format(self, obj, ref):
+        if isinstance(obj, PdfDict):
+            return self._format_dict(obj.iteritems(), ref)
+        if isinstance(obj, dict):
+            return self._format_dict(obj.items(), ref)
+        if isinstance(obj, (list, tuple)):
+            if not isinstance(obj, PdfArray):
+                obj = PdfArray(obj)
+            return _join([ref(x) for x in obj], "[%s]")
+        # Objects with an indirect attribute know how to represent
+        # themselves (e.g. PdfName, PdfObject and PdfString)
+        if hasattr(obj, "indirect"):
+            return str(getattr(obj, "encoded", None) or obj)
+        if obj is None:
+            return "null"
+        if isinstance(obj, bool):
+            return "true" if obj else "false"
+        if isinstance(obj, float):
+            return _format_number(obj)
+        if isinstance(obj, (str, bytes)):
+            return PdfString.encode(obj)
+        return str(obj)
+
+    def close(self, root, document_id=None):
+        """Writes ``root`` and the cross-reference stream. The file is not
+        closed."""
+        root_number = self.write(root)
+        with self._lock:
+            if self._reserved:
+                raise ValueError("Reserved objects were not written: %s" %
+                                 ", ".join(map(str, sorted(self._reserved))))
+            self._flush_object_stream()
+            number = len(self._xref)
+            self._xref.append((1, self._offset))
+            offset_width = max(1, (self._offset.bit_length() + 7) // 8)
+            entries = [b"\0" + bytes(offset_width) + b"\xff\xff"]
+            for entry in self._xref[1:]:
+                if entry[0] == 1:
+                    entries.append(b"\1" + entry[1].to_bytes(
+                        offset_width, "big") + b"\0\0")
+                else:
+                    entries.append(b"\2" + entry[1].to_bytes(
+                        offset_width, "big") + entry[2].to_bytes(2, "big"))
+            stream = zlib.compress(b"".join(entries), 9)
+            trailer = ["/Type /XRef", "/Size %d" % len(self._xref),
+                       "/W [1 %d 2]" % offset_width,
+                       "/Root %d 0 R" % root_number,
+                       "/Filter /FlateDecode", "/Length %d" % len(stream)]
+            if document_id is not None:
+                trailer.append("/ID [%s %s]" % (document_id, document_id))
+            startxref = self._offset
+            self._write_raw(number, b"<<%s>>\nstream\n" % " ".join(
+                trailer).encode("latin-1"), stream, b"\nendstream")
+            self._f.write(b"startxref\n%d\n%%%%EOF\n" % startxref)
+            # The objects are not needed anymore
+            self._numbers.clear()
+            self._objects.clear()
@@ -16,6 +16,7 @@
 # Copyright 2015, 2017 Unrud <unrud@outlook.com>
 
 import asyncio
+import io
 import json
 import logging
 import os
@@ -27,10 +28,19 @@ from argparse import ArgumentParser
 from os import path
 
 from djpdf import hocr
-from djpdf.djpdf import (CONVERT_CMD, JOB_MEMORY, PARALLEL_JOBS,
-                         RESERVED_MEMORY, SRGB_ICC_RESOURCE,
-                         BigTemporaryDirectory, PdfBuilder)
-from djpdf.util import (AsyncCache, MemoryBoundedSemaphore, cli_set_verbosity,
+from djpdf.checkpoint import Checkpoint
+from djpdf.djpdf import (CONVERT_CMD, DEFAULT_JBIG2_CHUNK_SIZE,
+                         DEFAULT_THREADS, LINEARIZE_PDF, SRGB_ICC_RESOURCE,
+                         BigTemporaryDirectory, PdfBuilder, concatenate_pdfs)
+from djpdf.diskcache import DEFAULT_CACHE_SIZE, DiskCache
+from djpdf.imageinfo import (ImageInfoError, image_pixels,
+                             is_bilevel_image, is_plain_color_png,
+                             is_unchanged_compatible, read_image_info)
+from djpdf.ocrpool import HAS_TESSEROCR, OcrWorkerError, OcrWorkerPool
+from djpdf.scheduler import set_page
+from djpdf.util import (AsyncCache, MemoryBoundedSemaphore,
+                        cli_add_resource_arguments,
+                        cli_apply_resource_arguments, cli_set_verbosity,
                         cli_setup, format_number, run_command)
 
 if sys.version_info < (3, 9):
@@ -38,6 +48,14 @@ if sys.version_info < (3, 9):
 else:
     import importlib.resources as importlib_resources
 
+try:
+    import numpy
+    from PIL import Image
+except ImportError:
+    HAS_NUMPY = False
+else:
+    HAS_NUMPY = True
+
 DEFAULT_SETTINGS = {
     "dpi": "auto",
     "bg_color": (0xff, 0xff, 0xff),
@@ -57,6 +75,22 @@ DEFAULT_SETTINGS = {
 IDENTIFY_CMD = "identify"
 TESSERACT_CMD = "tesseract"
 PDF_DPI = 72
+BLACK = (0x00, 0x00, 0x00)
+WHITE = (0xff, 0xff, 0xff)
+# "imagemagick": One ImageMagick process per layer
+# "imagemagick-batch": One ImageMagick process for all layers of an image
+# "numpy": Decode the input image once and separate all layers in-process
+SEPARATION_ENGINES = ("imagemagick", "imagemagick-batch") + (
+    ("numpy",) if HAS_NUMPY else ())
+DEFAULT_SEPARATION_ENGINE = "imagemagick"
+# "tesseract": One tesseract process per page
+# "tesseract-tsv": Like "tesseract" with TSV output that is faster to
+#                  parse, but has no text angles and directions
+# "tesserocr": Persistent workers that keep the language data loaded,
+#              they stay resident until the job is finished
+OCR_ENGINES = ("tesseract", "tesseract-tsv") + (
+    ("tesserocr",) if HAS_TESSEROCR else ())
+DEFAULT_OCR_ENGINE = "tesseract"
 
 
 def find_ocr_languages():
@@ -72,10 +106,36 @@ def _color_to_hex(color):
     return "#%02x%02x%02x" % color
 
 
+def _pack_color(color):
+    return (color[0] << 16) + (color[1] << 8) + color[2]
+
+
+def _save_mask(mask, fname, dpi):
+    # Pixels in mask are black, everything else is white
+    Image.fromarray(~mask).save(fname, dpi=dpi)
+
+
+async def _image_pixels(filename):
+    # The header is read without blocking the event loop
+    return await asyncio.get_running_loop().run_in_executor(
+        None, image_pixels, filename)
+
+
 class RecipeFactory:
-    def __init__(self):
+    def __init__(self, disk_cache=None,
+                 separation_engine=DEFAULT_SEPARATION_ENGINE, ocr_pool=None,
+                 ocr_engine=DEFAULT_OCR_ENGINE):
+        if separation_engine not in SEPARATION_ENGINES:
+            raise ValueError("Unsupported separation engine: %s" %
+                             separation_engine)
+        if ocr_engine not in OCR_ENGINES:
+            raise ValueError("Unsupported OCR engine: %s" % ocr_engine)
         self._cleaners = []
-        self._cache = []
+        self._cache = {}
+        self.disk_cache = disk_cache
+        self.separation_engine = separation_engine
+        self.ocr_pool = ocr_pool
+        self.ocr_engine = ocr_engine
 
     def add_cleaner(self, callback):
         self._cleaners.append(callback)
@@ -86,12 +146,21 @@ class RecipeFactory:
         self._cleaners.clear()
 
     def _from_cache(self, obj):
-        try:
-            index = self._cache.index(obj)
-            obj = self._cache[index]
-        except ValueError:
-            self._cache.append(obj)
-        return obj
+        key = obj.cache_key()
+        cached_obj = self._cache.get(key)
+        if cached_obj is None or cached_obj.released:
+            # The temporary files of a released object are already removed
+            self._cache[key] = obj
+            return obj
+        # The duplicate is discarded
+        obj._release_dependencies()
+        return cached_obj
+
+    def _from_cache_with_input_image(self, obj):
+        cached_obj = self._from_cache(obj)
+        if cached_obj is obj:
+            obj._input_image.add_consumer(obj)
+        return cached_obj
 
     def make_input_image(self, page):
         obj = InputImage(self, page)
@@ -99,7 +168,7 @@ class RecipeFactory:
 
     def make_background_image(self, page):
         obj = BackgroundImage(self, page)
-        return self._from_cache(obj)
+        return self._from_cache_with_input_image(obj)
 
     def make_background(self, page):
         obj = Background(self, page)
@@ -107,7 +176,7 @@ class RecipeFactory:
 
     def make_foreground_image(self, color_index, page):
         obj = ForegroundImage(color_index, self, page)
-        return self._from_cache(obj)
+        return self._from_cache_with_input_image(obj)
 
     def make_foreground(self, color_index, page):
         obj = Foreground(color_index, self, page)
@@ -115,7 +184,7 @@ class RecipeFactory:
 
     def make_ocr_image(self, page):
         obj = OcrImage(self, page)
-        return self._from_cache(obj)
+        return self._from_cache_with_input_image(obj)
 
     def make_ocr(self, page):
         obj = Ocr(self, page)
@@ -129,16 +198,95 @@ class RecipeFactory:
 class BasePageObject:
     _factory = None
     _page = None
-    _temp_dir = None
+    _temp_dir_obj = None
     _cache = None
 
     def __init__(self, factory, page):
         self._factory = factory
         self._page = page
-        temp_dir = BigTemporaryDirectory(prefix="djpdf-")
-        self._temp_dir = temp_dir.name
-        factory.add_cleaner(temp_dir.cleanup)
         self._cache = AsyncCache()
+        self._cache_key = None
+        self._disk_cache_key = None
+        self._users = 0
+        self._dependencies = []
+        self.released = False
+
+    @property
+    def _temp_dir(self):
+        # Created when a stage writes output
+        if self._temp_dir_obj is None:
+            self._temp_dir_obj = BigTemporaryDirectory(prefix="djpdf-")
+            self._factory.add_cleaner(self._cleanup_temp_dir)
+        return self._temp_dir_obj.name
+
+    def _cleanup_temp_dir(self):
+        if self._temp_dir_obj is not None:
+            self._temp_dir_obj.cleanup()
+            self._temp_dir_obj = None
+
+    def retain(self):
+        if self.released:
+            raise ValueError("Object already released")
+        self._users += 1
+
+    def release(self):
+        # The temporary files are removed, when the last user is finished
+        if self._users <= 0:
+            raise ValueError("Object released too many times")
+        self._users -= 1
+        if self._users == 0:
+            self.released = True
+            self._release_dependencies()
+            self._cleanup_temp_dir()
+
+    def _depend(self, obj):
+        obj.retain()
+        self._dependencies.append(obj)
+        return obj
+
+    def _release_dependency(self, obj):
+        if any(dependency is obj for dependency in self._dependencies):
+            self._dependencies = [dependency for dependency in
+                                  self._dependencies if dependency is not obj]
+            obj.release()
+
+    def _release_dependencies(self):
+        dependencies, self._dependencies = self._dependencies, []
+        for dependency in dependencies:
+            dependency.release()
+
+    def cache_key(self):
+        # Hashable key, equal for objects that produce the same result
+        if self._cache_key is None:
+            self._cache_key = (type(self), *self._cache_key_parts())
+        return self._cache_key
+
+    def _cache_key_parts(self):
+        raise NotImplementedError
+
+    def __eq__(self, other):
+        if not isinstance(other, BasePageObject):
+            return False
+        return self.cache_key() == other.cache_key()
+
+    def __hash__(self):
+        return hash(self.cache_key())
+
+    def disk_cache_key(self):
+        if self._disk_cache_key is None:
+            self._disk_cache_key = self._factory.disk_cache.make_key(
+                type(self).__name__, *self._disk_cache_key_parts())
+        return self._disk_cache_key
+
+    def _disk_cache_key_parts(self):
+        # Everything that is part of the cache key and influences the
+        # result
+        raise NotImplementedError
+
+    def _in_disk_cache(self):
+        disk_cache = self._factory.disk_cache
+        return (disk_cache is not None and
+                disk_cache.lookup(self.disk_cache_key()) is not None)
 
 
 class BaseImageObject(BasePageObject):
@@ -150,13 +298,43 @@ class BaseImageObject(BasePageObject):
         self._size_cache = AsyncCache()
         self._dpi_cache = AsyncCache()
 
+    async def filename(self, psem):
+        return await self._cache.get(self._finished_filename(psem))
+
+    async def _finished_filename(self, psem):
+        fname = await self._disk_cached_filename(psem)
+        self._filename_finished(fname)
+        return fname
+
+    def _filename_finished(self, fname):
+        pass
+
+    async def _disk_cached_filename(self, psem):
+        disk_cache = self._factory.disk_cache
+        if disk_cache is None:
+            return await self._filename(psem)
+        key = self.disk_cache_key()
+        entry = disk_cache.lookup(key)
+        if entry is None:
+            fname = await self._filename(psem)
+            entry = disk_cache.store(
+                key, {"empty": fname is None},
+                {"image.png": fname} if fname is not None else {})
+        if entry.meta["empty"]:
+            return None
+        return entry.filename("image.png")
+
+    async def _identify_filename(self, psem):
+        return await self.filename(psem)
+
     async def size(self, psem):
         return await self._size_cache.get(self._size(psem))
 
     async def _size(self, psem):
+        fname = await self._identify_filename(psem)
         outs = await run_command([
-            IDENTIFY_CMD, "-format", "%w %h",
-            path.abspath(await self.filename(psem))], psem)
+            IDENTIFY_CMD, "-format", "%w %h", path.abspath(fname)], psem,
+            operation="size", pixels=await _image_pixels(fname))
         outs = outs.decode("ascii")
         outss = outs.split()
         w, h = int(outss[0]), int(outss[1])
@@ -166,9 +344,11 @@ class BaseImageObject(BasePageObject):
         return await self._dpi_cache.get(self._dpi(psem))
 
     async def _dpi(self, psem):
+        fname = await self._identify_filename(psem)
         outs = await run_command([
             IDENTIFY_CMD, "-units", "PixelsPerInch", "-format", "%x %y",
-            path.abspath(await self.filename(psem))], psem)
+            path.abspath(fname)], psem,
+            operation="dpi", pixels=await _image_pixels(fname))
         outs = outs.decode("ascii")
         outss = outs.split()
         if len(outss) == 2:
@@ -181,12 +361,24 @@ class BaseImageObject(BasePageObject):
             raise Exception("Can't extract dpi: %s" % outs)
         return x, y
 
-    @staticmethod
-    async def _is_plain_color_file(filename, color, psem):
+    @classmethod
+    async def _is_plain_color_file(cls, filename, color, psem):
+        try:
+            plain_color = is_plain_color_png(filename, color)
+        except ImageInfoError:
+            logging.debug("Can't read PNG file:\n%s" %
+                          traceback.format_exc())
+            plain_color = None
+        if plain_color is not None:
+            return plain_color
         outs = await run_command([
             CONVERT_CMD, "-format", "%c", path.abspath(filename),
-            "histogram:info:-"], psem)
-        outs = outs.decode("ascii")
+            "histogram:info:-"], psem,
+            operation="histogram", pixels=await _image_pixels(filename))
+        return cls._is_plain_color_histogram(outs.decode("ascii"), color)
+
+    @staticmethod
+    def _is_plain_color_histogram(outs, color):
         histogram_re = re.compile(r"\s*(?P<count>\d+(?:(?:\.\d+)?e\+\d+)?):\s+"
                                   r"\(\s*(?P<r>\d+),\s*(?P<g>\d+),"
                                   r"\s*(?P<b>\d+)\)")
@@ -204,17 +396,92 @@ class BaseImageObject(BasePageObject):
         return len(colors) == 1 and colors[0] == tuple(color)
 
 
+def _separate_layers_with_numpy(input_filename, consumers):
+    with Image.open(input_filename) as im:
+        dpi = im.info.get("dpi")
+        pixels = numpy.asarray(im.convert("RGB"))
+    packed = ((pixels[..., 0].astype(numpy.uint32) << 16) |
+              (pixels[..., 1].astype(numpy.uint32) << 8) |
+              pixels[..., 2])
+    return [consumer._separate(input_filename, pixels, packed, dpi)
+            for consumer in consumers]
+
+
 class InputImage(BaseImageObject):
-    def __eq__(self, other):
-        if not isinstance(other, InputImage):
-            return False
-        p = self._page
-        op = other._page
-        return (p["filename"] == op["filename"] and
-                p["bg_color"] == op["bg_color"])
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._consumers = []
+        self._separated = {}
+        self._separation_lock = asyncio.Lock()
+        self._bilevel = None
+        self._image_info_cache = AsyncCache()
+
+    def _cache_key_parts(self):
+        return (self._page["filename"], self._page["bg_color"])
+
+    def _disk_cache_key_parts(self):
+        return (self._factory.disk_cache.file_digest(self._page["filename"]),
+                self._page["bg_color"])
+
+    async def hash_file(self):
+        # The digest of the file is part of the disk cache keys of all
+        # stages. The disk cache remembers it, the file is read without
+        # blocking the event loop.
+        disk_cache = self._factory.disk_cache
+        if disk_cache is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, disk_cache.file_digest, self._page["filename"])
+
+    async def image_info(self):
+        # Read from the header of the original file, without waiting for
+        # the conversion. None if the format is not supported.
+        return await self._image_info_cache.get(self._image_info())
+
+    async def _image_info(self):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._read_image_info)
+
+    def _read_image_info(self):
+        try:
+            return read_image_info(self._page["filename"])
+        except ImageInfoError:
+            logging.debug("Can't read image header:\n%s" %
+                          traceback.format_exc())
+            return None
 
-    async def filename(self, psem):
-        return await self._cache.get(self._filename(psem))
+    async def pixels(self):
+        info = await self.image_info()
+        if info is None:
+            return None
+        return info.width * info.height
+
+    def is_bilevel(self):
+        # Black and white input images are used without converting them
+        if self._bilevel is None:
+            try:
+                self._bilevel = is_bilevel_image(self._page["filename"])
+            except OSError:
+                logging.debug("Can't read image header:\n%s" %
+                              traceback.format_exc())
+                self._bilevel = False
+        return self._bilevel
+
+    async def _identify_filename(self, psem):
+        if self.is_bilevel():
+            return self._page["filename"]
+        return await super()._identify_filename(psem)
+
+    async def _size(self, psem):
+        info = await self.image_info()
+        if info is None:
+            return await super()._size(psem)
+        return info.width, info.height
+
+    async def _dpi(self, psem):
+        info = await self.image_info()
+        if info is None or info.dpi is None:
+            return await super()._dpi(psem)
+        return info.dpi
 
     async def _filename(self, psem):
         fname = path.join(self._temp_dir, "image.png")
@@ -228,74 +495,262 @@ class InputImage(BaseImageObject):
                 "-alpha", "off",
                 "-type", "TrueColor",
                 path.abspath(self._page["filename"]),
-                path.abspath(fname)], psem)
+                path.abspath(fname)], psem,
+                operation="input", pixels=await self.pixels())
         return fname
 
+    def add_consumer(self, obj):
+        self._consumers.append(obj)
+
+    async def separated_filename(self, consumer, psem):
+        # The image is decoded once and the layers of all consumers that
+        # still need them are separated in the same pass
+        async with self._separation_lock:
+            if id(consumer) not in self._separated:
+                consumers = [consumer]
+                for c in self._consumers:
+                    if (c is not consumer and not c.released and
+                            id(c) not in self._separated and
+                            c._needs_separation() and
+                            not c._in_disk_cache()):
+                        consumers.append(c)
+                if self._factory.separation_engine == "numpy":
+                    input_filename = await self.filename(psem)
+                    async with psem:
+                        loop = asyncio.get_running_loop()
+                        fnames = await loop.run_in_executor(
+                            None, _separate_layers_with_numpy,
+                            input_filename, consumers)
+                else:
+                    fnames = await self._separate_layers_with_imagemagick(
+                        consumers, psem)
+                for c, fname in zip(consumers, fnames):
+                    self._separated[id(c)] = fname
+                    if c.released:
+                        # Released while the layers were separated
+                        c._cleanup_temp_dir()
+        return self._separated[id(consumer)]
+
+    async def _separate_layers_with_imagemagick(self, consumers, psem):
+        # One process writes the layers of all consumers from clones of
+        # the decoded input image
+        input_filename = await self.filename(psem)
+        cmd = [CONVERT_CMD, "-respect-parentheses",
+               path.abspath(input_filename)]
+        outputs = []
+        for consumer in consumers:
+            operations = consumer._convert_operations()
+            plain_color = consumer._plain_color()
+            cmd.extend(["(", "+clone"])
+            if operations is None:
+                fname = input_filename
+            else:
+                fname = path.join(consumer._temp_dir, "image.png")
+                cmd.extend([*operations, "-write", path.abspath(fname)])
+            histogram_fname = None
+            if plain_color is not None:
+                histogram_fname = path.join(consumer._temp_dir,
+                                            "histogram.txt")
+                cmd.extend(["-format", "%c", "-write",
+                            "histogram:info:" + path.abspath(histogram_fname)])
+            cmd.extend(["+delete", ")"])
+            outputs.append((fname, histogram_fname, plain_color))
+        cmd.append("null:")
+        # Each consumer works on a clone of the input image
+        pixels = await self.pixels()
+        if pixels is not None:
+            pixels *= len(consumers) + 1
+        await run_command(cmd, psem, operation="separate-layers",
+                          pixels=pixels)
+        fnames = []
+        for fname, histogram_fname, plain_color in outputs:
+            if histogram_fname is not None:
+                with open(histogram_fname) as f:
+                    if self._is_plain_color_histogram(f.read(), plain_color):
+                        fname = None
+            fnames.append(fname)
+        return fnames
+
+
+class SeparatedImage(BaseImageObject):
+    """Layer that is separated from the InputImage of the page"""
 
-class BackgroundImage(BaseImageObject):
     def __init__(self, *args):
         super().__init__(*args)
-        self._input_image = self._factory.make_input_image(self._page)
+        self._input_image = self._depend(
+            self._factory.make_input_image(self._page))
 
-    def __eq__(self, other):
-        if not isinstance(other, BackgroundImage):
-            return False
-        p = self._page
-        op = other._page
-        return (p["bg_resize"] == op["bg_resize"] and
-                (not p["fg_enabled"] and not op["fg_enabled"] or
-                 p["fg_enabled"] and op["fg_enabled"] and
-                 p["fg_colors"] == op["fg_colors"]) and
-                self._input_image == other._input_image)
+    def _convert_operations(self):
+        # ImageMagick operations that separate the layer or None if the
+        # input image is used unchanged
+        raise NotImplementedError
 
-    async def filename(self, psem):
-        return await self._cache.get(self._filename(psem))
+    def _plain_color(self):
+        # The layer is empty, if it only contains this color
+        return None
+
+    def _separate(self, input_filename, pixels, packed, dpi):
+        raise NotImplementedError
+
+    def _bilevel_layer(self):
+        # Layer of a black and white input image: "input" if it's the
+        # unchanged input image, "empty" if it's empty or None if it must
+        # be separated
+        return None
+
+    def _bilevel_shortcut(self):
+        if not self._input_image.is_bilevel():
+            return None
+        return self._bilevel_layer()
+
+    async def _disk_cached_filename(self, psem):
+        layer = self._bilevel_shortcut()
+        if layer is None:
+            return await super()._disk_cached_filename(psem)
+        # Neither the input image nor the layer are converted
+        self._release_dependency(self._input_image)
+        if layer == "empty":
+            return None
+        return path.abspath(self._page["filename"])
+
+    def _filename_finished(self, fname):
+        # The input image is only needed, if it's used unchanged
+        if (fname is None or self._factory.disk_cache is not None or
+                self._convert_operations() is not None):
+            self._release_dependency(self._input_image)
+
+    def _needs_separation(self):
+        return self._bilevel_shortcut() is None and (
+            self._convert_operations() is not None or
+            self._plain_color() is not None)
 
     async def _filename(self, psem):
-        if (self._page["fg_enabled"] and self._page["fg_colors"] or
-                self._page["bg_resize"] != 1):
-            fname = path.join(self._temp_dir, "image.png")
-            cmd = [CONVERT_CMD,
-                   "-fill", _color_to_hex(self._page["bg_color"])]
-            if self._page["fg_enabled"]:
-                for color in self._page["fg_colors"]:
-                    cmd.extend(["-opaque", _color_to_hex(color)])
-            cmd.extend(["-resize", format_number(self._page["bg_resize"], 2,
-                                                 percentage=True),
-                        path.abspath(await self._input_image.filename(psem)),
-                        path.abspath(fname)])
-            await run_command(cmd, psem)
-        else:
+        if not self._needs_separation():
+            return await self._input_image.filename(psem)
+        if self._factory.separation_engine != "imagemagick":
+            return await self._input_image.separated_filename(self, psem)
+        operations = self._convert_operations()
+        if operations is None:
             fname = await self._input_image.filename(psem)
-        if await self._is_plain_color_file(fname, self._page["bg_color"],
-                                           psem):
+        else:
+            fname = path.join(self._temp_dir, "image.png")
+            await run_command([
+                CONVERT_CMD, *operations,
+                path.abspath(await self._input_image.filename(psem)),
+                path.abspath(fname)], psem,
+                operation="separate",
+                pixels=await self._input_image.pixels())
+        plain_color = self._plain_color()
+        if (plain_color is not None and
+                await self._is_plain_color_file(fname, plain_color, psem)):
             return None
         return fname
 
 
+class BackgroundImage(SeparatedImage):
+    def _cache_key_parts(self):
+        p = self._page
+        return (p["bg_resize"], p["fg_colors"] if p["fg_enabled"] else None,
+                self._input_image)
+
+    def _disk_cache_key_parts(self):
+        return (self._page["bg_resize"],
+                self._page["fg_enabled"] and self._page["fg_colors"],
+                self._input_image.disk_cache_key())
+
+    def _convert_operations(self):
+        if not (self._page["fg_enabled"] and self._page["fg_colors"] or
+                self._page["bg_resize"] != 1):
+            return None
+        operations = ["-fill", _color_to_hex(self._page["bg_color"])]
+        if self._page["fg_enabled"]:
+            for color in self._page["fg_colors"]:
+                operations.extend(["-opaque", _color_to_hex(color)])
+        operations.extend(["-resize", format_number(self._page["bg_resize"], 2,
+                                                    percentage=True)])
+        return operations
+
+    def _plain_color(self):
+        return self._page["bg_color"]
+
+    def _bilevel_layer(self):
+        p = self._page
+        if (p["fg_enabled"] and BLACK in p["fg_colors"] and
+                p["bg_color"] == WHITE):
+            # Only white pixels remain, they have the background color
+            return "empty"
+        return None
+
+    def _separate(self, input_filename, pixels, packed, dpi):
+        bg_color = self._page["bg_color"]
+        fg_colors = self._page["fg_colors"] if self._page["fg_enabled"] else ()
+        if not fg_colors and self._page["bg_resize"] == 1:
+            if numpy.all(packed == _pack_color(bg_color)):
+                return None
+            return input_filename
+        if fg_colors:
+            pixels = pixels.copy()
+            pixels[numpy.isin(packed, list(map(_pack_color, fg_colors)))] = (
+                bg_color)
+        image = Image.fromarray(pixels)
+        if self._page["bg_resize"] != 1:
+            resize = float(format_number(self._page["bg_resize"], 2,
+                                         percentage=True).rstrip("%")) / 100
+            image = image.resize(
+                (max(1, int(image.width * resize + 0.5)),
+                 max(1, int(image.height * resize + 0.5))),
+                Image.LANCZOS)
+        if numpy.all(numpy.asarray(image) == bg_color):
+            return None
+        fname = path.join(self._temp_dir, "image.png")
+        image.save(fname, dpi=dpi)
+        return fname
+
+
 class Background(BasePageObject):
     def __init__(self, *args):
         super().__init__(*args)
-        self._background_image = self._factory.make_background_image(
-            self._page)
+        # Disabled layers are not separated from the input image
+        self._background_image = None
+        if self._page["bg_enabled"]:
+            self._background_image = self._depend(
+                self._factory.make_background_image(self._page))
 
-    def __eq__(self, other):
-        if not isinstance(other, Background):
-            return False
+    def _cache_key_parts(self):
         p = self._page
-        op = other._page
-        return (not p["bg_enabled"] and not op["bg_enabled"] or
-                p["bg_enabled"] and op["bg_enabled"] and
-                p["bg_compression"] == op["bg_compression"] and
-                p["bg_quality"] == op["bg_quality"] and
-                self._background_image == other._background_image)
+        if not p["bg_enabled"]:
+            return (False,)
+        return (True, p["bg_compression"], p["bg_quality"],
+                self._background_image)
 
     async def json(self, psem):
         return await self._cache.get(self._json(psem))
 
+    def _input_unchanged(self):
+        # The input file is embedded as it is, if the background is the
+        # unchanged input image and it's already compressed as requested
+        p = self._page
+        if (p["bg_compression"] not in ("jp2", "jpeg") or
+                p["bg_resize"] != 1 or p["fg_enabled"] and p["fg_colors"]):
+            return False
+        try:
+            return is_unchanged_compatible(p["filename"], p["bg_compression"])
+        except OSError:
+            logging.debug("Can't read image header:\n%s" %
+                          traceback.format_exc())
+            return False
+
     async def _json(self, psem):
-        if (not self._page["bg_enabled"] or
-                await self._background_image.filename(psem) is None):
+        if not self._page["bg_enabled"]:
+            return None
+        if self._input_unchanged():
+            self._release_dependencies()
+            return {
+                "compression": self._page["bg_compression"],
+                "filename": path.abspath(self._page["filename"])
+            }
+        if await self._background_image.filename(psem) is None:
+            self._release_dependencies()
             return None
         return {
             "compression": self._page["bg_compression"],
@@ -304,44 +759,51 @@ class Background(BasePageObject):
         }
 
 
-class ForegroundImage(BaseImageObject):
+class ForegroundImage(SeparatedImage):
     def __init__(self, color_index, *args):
-        super().__init__(*args)
         self._color_index = color_index
-        self._input_image = self._factory.make_input_image(self._page)
+        super().__init__(*args)
 
-    def __eq__(self, other):
-        if not isinstance(other, ForegroundImage):
-            return False
-        p = self._page
-        op = other._page
-        return (p["fg_colors"][self._color_index] ==
-                op["fg_colors"][other._color_index] and
-                self._input_image == other._input_image)
+    def _cache_key_parts(self):
+        return (self._page["fg_colors"][self._color_index],
+                self._input_image)
 
-    async def filename(self, psem):
-        return await self._cache.get(self._filename(psem))
+    def _disk_cache_key_parts(self):
+        return (self._page["fg_colors"][self._color_index],
+                self._input_image.disk_cache_key())
 
-    async def _filename(self, psem):
-        fname = path.join(self._temp_dir, "image.png")
+    def _convert_operations(self):
         color = self._page["fg_colors"][self._color_index]
-        cmd = [CONVERT_CMD]
         new_black = (0x00, 0x00, 0x00)
         if color != new_black:
             if color != (0x00, 0x00, 0x01):
                 new_black = (0x00, 0x00, 0x01)
             else:
                 new_black = (0x00, 0x00, 0x02)
-        cmd.extend(["-fill", _color_to_hex(new_black),
-                    "-opaque", "#000000",
-                    "-fill", "#000000",
-                    "-opaque", _color_to_hex(color),
-                    "-threshold", "0",
-                    path.abspath(await self._input_image.filename(psem)),
-                    path.abspath(fname)])
-        await run_command(cmd, psem)
-        if await self._is_plain_color_file(fname, (0xff, 0xff, 0xff), psem):
+        return ["-fill", _color_to_hex(new_black),
+                "-opaque", "#000000",
+                "-fill", "#000000",
+                "-opaque", _color_to_hex(color),
+                "-threshold", "0"]
+
+    def _plain_color(self):
+        return WHITE
+
+    def _bilevel_layer(self):
+        color = self._page["fg_colors"][self._color_index]
+        if color == BLACK:
+            return "input"
+        if color == WHITE:
             return None
+        return "empty"
+
+    def _separate(self, input_filename, pixels, packed, dpi):
+        mask = packed == _pack_color(
+            self._page["fg_colors"][self._color_index])
+        if not mask.any():
+            return None
+        fname = path.join(self._temp_dir, "image.png")
+        _save_mask(mask, fname, dpi)
         return fname
 
 
@@ -349,28 +811,27 @@ class Foreground(BasePageObject):
     def __init__(self, color_index, *args):
         super().__init__(*args)
         self._color_index = color_index
-        self._foreground_image = self._factory.make_foreground_image(
-            self._color_index, self._page)
+        self._foreground_image = None
+        if self._page["fg_enabled"]:
+            self._foreground_image = self._depend(
+                self._factory.make_foreground_image(self._color_index,
+                                                    self._page))
 
-    def __eq__(self, other):
-        if not isinstance(other, Foreground):
-            return False
+    def _cache_key_parts(self):
         p = self._page
-        op = other._page
-        return (not p["fg_enabled"] and not op["fg_enabled"] or
-                p["fg_enabled"] and op["fg_enabled"] and
-                p["fg_compression"] == op["fg_compression"] and
-                p["fg_jbig2_threshold"] == op["fg_jbig2_threshold"] and
-                p["fg_colors"][self._color_index] ==
-                op["fg_colors"][other._color_index] and
-                self._foreground_image == other._foreground_image)
+        if not p["fg_enabled"]:
+            return (False,)
+        return (True, p["fg_compression"], p["fg_jbig2_threshold"],
+                p["fg_colors"][self._color_index], self._foreground_image)
 
     async def json(self, psem):
         return await self._cache.get(self._json(psem))
 
     async def _json(self, psem):
-        if (not self._page["fg_enabled"] or
-                await self._foreground_image.filename(psem) is None):
+        if not self._page["fg_enabled"]:
+            return None
+        if await self._foreground_image.filename(psem) is None:
+            self._release_dependencies()
             return None
         color = self._page["fg_colors"][self._color_index]
         return {
@@ -381,116 +842,151 @@ class Foreground(BasePageObject):
         }
 
 
-class OcrImage(BaseImageObject):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self._input_image = self._factory.make_input_image(self._page)
-
-    def __eq__(self, other):
-        if not isinstance(other, OcrImage):
-            return False
-        p = self._page
-        op = other._page
-        return (p["ocr_colors"] == op["ocr_colors"] and
-                self._input_image == other._input_image)
+class OcrImage(SeparatedImage):
+    def _cache_key_parts(self):
+        return (self._page["ocr_colors"], self._input_image)
 
-    async def filename(self, psem):
-        return await self._cache.get(self._filename(psem))
+    def _disk_cache_key_parts(self):
+        return (self._page["ocr_colors"], self._input_image.disk_cache_key())
 
-    async def _filename(self, psem):
-        if self._page["ocr_colors"] != "all":
-            fname = path.join(self._temp_dir, "image.png")
+    def _convert_operations(self):
+        if self._page["ocr_colors"] == "all":
+            return None
 
-            def contains_color(color, cs):
-                color = tuple(color)
-                return any(map(lambda c: tuple(c) == color, cs))
-            new_black = (0x00, 0x00, 0x00)
-            if not contains_color(new_black, self._page["ocr_colors"]):
-                while (new_black == (0x00, 0x00, 0x00) or
-                        contains_color(new_black, self._page["ocr_colors"])):
-                    v = ((new_black[0] << 16) +
-                         (new_black[1] << 8) +
-                         (new_black[2] << 0))
-                    v += 1
-                    new_black = ((v >> 16) & 0xff, (v >> 8) & 0xff,
-                                 (v >> 0) & 0xff)
-            cmd = [CONVERT_CMD]
-            cmd.extend(["-fill", _color_to_hex(new_black),
-                        "-opaque", "#000000",
-                        "-fill", "#000000"])
-            for color in self._page["ocr_colors"]:
-                cmd.extend(["-opaque", _color_to_hex(color)])
-            cmd.extend(["-threshold", "0"])
-            cmd.extend([path.abspath(await self._input_image.filename(psem)),
-                        path.abspath(fname)])
-            await run_command(cmd, psem)
-        else:
-            fname = await self._input_image.filename(psem)
+        def contains_color(color, cs):
+            color = tuple(color)
+            return any(map(lambda c: tuple(c) == color, cs))
+        new_black = (0x00, 0x00, 0x00)
+        if not contains_color(new_black, self._page["ocr_colors"]):
+            while (new_black == (0x00, 0x00, 0x00) or
+                    contains_color(new_black, self._page["ocr_colors"])):
+                v = ((new_black[0] << 16) +
+                     (new_black[1] << 8) +
+                     (new_black[2] << 0))
+                v += 1
+                new_black = ((v >> 16) & 0xff, (v >> 8) & 0xff,
+                             (v >> 0) & 0xff)
+        operations = ["-fill", _color_to_hex(new_black),
+                      "-opaque", "#000000",
+                      "-fill", "#000000"]
+        for color in self._page["ocr_colors"]:
+            operations.extend(["-opaque", _color_to_hex(color)])
+        operations.extend(["-threshold", "0"])
+        return operations
+
+    def _bilevel_layer(self):
+        colors = self._page["ocr_colors"]
+        if colors == "all" or BLACK in colors and WHITE not in colors:
+            return "input"
+        return None
+
+    def _separate(self, input_filename, pixels, packed, dpi):
+        if self._page["ocr_colors"] == "all":
+            return input_filename
+        mask = numpy.isin(packed, list(map(_pack_color,
+                                           self._page["ocr_colors"])))
+        fname = path.join(self._temp_dir, "image.png")
+        _save_mask(mask, fname, dpi)
         return fname
 
 
 class Ocr(BasePageObject):
     def __init__(self, *args):
         super().__init__(*args)
-        self._input_image = self._factory.make_input_image(self._page)
-        self._ocr_image = self._factory.make_ocr_image(self._page)
-
-    def __eq__(self, other):
-        if not isinstance(other, Ocr):
-            return False
+        self._input_image = self._depend(
+            self._factory.make_input_image(self._page))
+        self._ocr_image = None
+        if self._page["ocr_enabled"]:
+            self._ocr_image = self._depend(
+                self._factory.make_ocr_image(self._page))
+
+    def _cache_key_parts(self):
         p = self._page
-        op = other._page
-        return (not p["ocr_enabled"] and not op["ocr_enabled"] or
-                p["ocr_enabled"] and op["ocr_enabled"] and
-                p["ocr_language"] == op["ocr_language"] and
-                self._ocr_image == other._ocr_image)
+        if not p["ocr_enabled"]:
+            return (False,)
+        return (True, p["ocr_language"], self._ocr_image)
+
+    def _disk_cache_key_parts(self):
+        # The engines can recognize different texts
+        return (self._factory.ocr_engine, self._page["ocr_language"],
+                self._ocr_image.disk_cache_key())
 
     async def texts(self, psem):
         return await self._cache.get(self._texts(psem))
 
     async def _texts(self, psem):
+        texts = await self._ocr_texts(psem)
+        # The result doesn't reference any files
+        self._release_dependencies()
+        return texts
+
+    async def _ocr_texts(self, psem):
         if not self._page["ocr_enabled"]:
             return None
         if self._page["dpi"] == "auto":
             dpi_x, _ = await self._input_image.dpi(psem)
         else:
             dpi_x = self._page["dpi"]
+        disk_cache = self._factory.disk_cache
+        if disk_cache is None:
+            return await self._run_ocr(dpi_x, psem)
+        key = disk_cache.make_key(self.disk_cache_key(), "%.0f" % dpi_x)
+        entry = disk_cache.lookup(key)
+        if entry is None:
+            entry = disk_cache.store(
+                key, {"texts": await self._run_ocr(dpi_x, psem)})
+        return entry.meta["texts"]
+
+    async def _run_ocr(self, dpi_x, psem):
+        ocr_pool = self._factory.ocr_pool
+        if ocr_pool is not None:
+            try:
+                hocr_text = await ocr_pool.hocr(
+                    path.abspath(await self._ocr_image.filename(psem)),
+                    round(dpi_x), self._page["ocr_language"], psem)
+            except OcrWorkerError:
+                logging.debug("Falling back to %s", TESSERACT_CMD)
+            else:
+                return hocr.extract_text(io.StringIO(hocr_text))
+        output_format = ("tsv" if self._factory.ocr_engine == "tesseract-tsv"
+                         else "hocr")
+        fname = await self._ocr_image.filename(psem)
         await run_command([
             TESSERACT_CMD, "-l", self._page["ocr_language"],
-            "--dpi", "%.0f" % dpi_x,
-            path.abspath(await self._ocr_image.filename(psem)),
-            path.abspath(path.join(self._temp_dir, "ocr")), "hocr"], psem)
-        return hocr.extract_text(path.join(self._temp_dir, "ocr.hocr"))
+            "--dpi", "%.0f" % dpi_x, path.abspath(fname),
+            path.abspath(path.join(self._temp_dir, "ocr")), output_format],
+            psem, operation="ocr", pixels=await _image_pixels(fname))
+        output_filename = path.join(self._temp_dir, "ocr." + output_format)
+        if output_format == "tsv":
+            return hocr.extract_text_tsv(output_filename)
+        return hocr.extract_text(output_filename)
 
 
 class Page(BasePageObject):
     def __init__(self, factory, page):
         page = self._check_and_sanitize_recipe(page)
         super().__init__(factory, page)
-        self._input_image = self._factory.make_input_image(self._page)
+        self._input_image = self._depend(
+            self._factory.make_input_image(self._page))
         self._foregrounds = []
         for color_index, _ in enumerate(page["fg_colors"]):
-            foreground = self._factory.make_foreground(color_index, self._page)
+            foreground = self._depend(
+                self._factory.make_foreground(color_index, self._page))
             self._foregrounds.append(foreground)
-        self._background = self._factory.make_background(self._page)
-        self._ocr = self._factory.make_ocr(self._page)
+        self._background = self._depend(
+            self._factory.make_background(self._page))
+        self._ocr = self._depend(self._factory.make_ocr(self._page))
 
-    def __eq__(self, other):
-        if not isinstance(other, Page):
-            return False
-        p = self._page
-        op = other._page
-        return (p["bg_color"] == op["bg_color"] and
-                p["dpi"] == op["dpi"] and
-                self._input_image == other._input_image and
-                self._foregrounds == other._foregrounds and
-                self._background == other._background and
-                self._ocr == other._ocr)
+    def _cache_key_parts(self):
+        return (self._page["bg_color"], self._page["dpi"], self._input_image,
+                tuple(self._foregrounds), self._background, self._ocr)
 
     async def json(self, psem):
         return await self._cache.get(self._json(psem))
 
     async def _json(self, psem):
+        await self._input_image.hash_file()
+
         # Prepare everything in parallel
         async def get_dpi(psem):
             if self._page["dpi"] == "auto":
@@ -503,6 +999,9 @@ class Page(BasePageObject):
                 asyncio.gather(*[fg.json(psem) for fg in self._foregrounds]),
                 self._input_image.size(psem),
                 get_dpi(psem))
+        # Only the images of foregrounds and background are still needed
+        self._release_dependency(self._input_image)
+        self._release_dependency(self._ocr)
         if texts is not None:
             for text in texts:
                 text["x"] *= (PDF_DPI / dpi_x)
@@ -563,13 +1062,71 @@ class Page(BasePageObject):
         return page
 
 
+async def _make_page_json(factory, page_index, page, psem, checkpoint):
+    # Returns the page object, that must be released when the page is
+    # written, or None if the page doesn't reference temporary files
+    set_page(page_index)
+    if checkpoint is not None:
+        page_json = checkpoint.load(page)
+        if page_json is not None:
+            return None, page_json
+    page_obj = factory.make_page(page)
+    page_obj.retain()
+    page_json = await page_obj.json(psem)
+    if checkpoint is not None:
+        page_json = checkpoint.store(page, page_json)
+        page_obj.release()
+        page_obj = None
+    return page_obj, page_json
+
+
+def _release_page_obj(page_obj):
+    if page_obj is not None:
+        page_obj.release()
+
+
 async def build_pdf(pages, pdf_filename, process_semaphore=None,
-                    progress_cb=None):
+                    progress_cb=None, disk_cache=None,
+                    separation_engine=DEFAULT_SEPARATION_ENGINE,
+                    page_window=None, ocr_engine=DEFAULT_OCR_ENGINE,
+                    checkpoint=None, threads=DEFAULT_THREADS,
+                    linearize=LINEARIZE_PDF,
+                    jbig2_chunk_size=DEFAULT_JBIG2_CHUNK_SIZE):
+    if ocr_engine not in OCR_ENGINES:
+        raise ValueError("Unsupported OCR engine: %s" % ocr_engine)
     if process_semaphore is None:
-        process_semaphore = MemoryBoundedSemaphore(
-            PARALLEL_JOBS, JOB_MEMORY, RESERVED_MEMORY)
-
-    factory = RecipeFactory()
+        process_semaphore = MemoryBoundedSemaphore()
+    builder_disk_cache = disk_cache
+    if checkpoint is not None:
+        # The input files are hashed without blocking the event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, checkpoint.start, pages)
+        if builder_disk_cache is None:
+            # Keep the encoded images of finished pages
+            builder_disk_cache = checkpoint.disk_cache
+    ocr_pool = None
+    if ocr_engine == "tesserocr":
+        ocr_pool = OcrWorkerPool(process_semaphore.jobs)
+
+    def make_factory():
+        return RecipeFactory(disk_cache, separation_engine, ocr_pool,
+                             ocr_engine)
+
+    if page_window is not None:
+        try:
+            await _build_pdf_streaming(
+                pages, pdf_filename, process_semaphore, progress_cb,
+                builder_disk_cache, make_factory, page_window, checkpoint,
+                threads, linearize, jbig2_chunk_size)
+        finally:
+            if ocr_pool is not None:
+                ocr_pool.close()
+            await process_semaphore.memory_profile.flush()
+        if checkpoint is not None:
+            checkpoint.finish()
+        return
+
+    factory = make_factory()
 
     finished_pages = 0
 
@@ -582,15 +1139,88 @@ async def build_pdf(pages, pdf_filename, process_semaphore=None,
         return res
 
     try:
-        djpdf_pages = await asyncio.gather(*[
-            progress_wrapper(factory.make_page(page).json(process_semaphore))
-            for page in pages])
-        pdf_builder = PdfBuilder({"pages": djpdf_pages})
-        return await pdf_builder.write(
+        results = await asyncio.gather(*[
+            progress_wrapper(_make_page_json(
+                factory, page_index, page, process_semaphore, checkpoint))
+            for page_index, page in enumerate(pages)])
+        page_objs = [page_obj for page_obj, _ in results]
+        djpdf_pages = [page_json for _, page_json in results]
+        pdf_builder = PdfBuilder({"pages": djpdf_pages}, builder_disk_cache,
+                                 threads, jbig2_chunk_size)
+        await pdf_builder.write(
             pdf_filename, process_semaphore,
-            lambda f: progress_cb(0.5 + f * 0.5) if progress_cb else None)
+            lambda f: progress_cb(0.5 + f * 0.5) if progress_cb else None,
+            linearize=linearize,
+            page_done_cb=lambda i: _release_page_obj(page_objs[i]))
     finally:
         factory.cleanup()
+        if ocr_pool is not None:
+            ocr_pool.close()
+        await process_semaphore.memory_profile.flush()
+    if checkpoint is not None:
+        checkpoint.finish()
+
+
+async def _build_pdf_streaming(pages, pdf_filename, process_semaphore,
+                               progress_cb, disk_cache, make_factory,
+                               page_window, checkpoint, threads, linearize,
+                               jbig2_chunk_size):
+    # At most page_window pages are processed at the same time. Pages are
+    # written in chunks to intermediate PDF files. The temporary files of
+    # a chunk are removed and its pages leave the window, before the
+    # intermediate files get concatenated.
+    if page_window < 1:
+        raise ValueError("page_window must be >= 1")
+    if not pages:
+        # There are no chunks to concatenate
+        pdf_builder = PdfBuilder({"pages": []}, disk_cache, threads,
+                                 jbig2_chunk_size)
+        await pdf_builder.write(pdf_filename, process_semaphore, progress_cb,
+                                linearize=linearize)
+        return
+    chunk_size = max(1, page_window // 2)
+    window_semaphore = asyncio.Semaphore(page_window)
+    finished_pages = 0
+
+    async def make_chunk(first_page_index, chunk, chunk_filename):
+        nonlocal finished_pages
+        # Pages of the chunk are ordered after the pages of earlier chunks
+        set_page(first_page_index)
+        factory = make_factory()
+        try:
+            async def make_page_json(page_index, page):
+                await window_semaphore.acquire()
+                return await _make_page_json(
+                    factory, page_index, page, process_semaphore, checkpoint)
+            page_objs, djpdf_pages = zip(*await asyncio.gather(
+                *[make_page_json(page_index, page)
+                  for page_index, page in enumerate(chunk)]))
+            pdf_builder = PdfBuilder({"pages": djpdf_pages}, disk_cache,
+                                     threads, jbig2_chunk_size)
+            await pdf_builder.write(
+                chunk_filename, process_semaphore, linearize=False,
+                page_done_cb=lambda i: _release_page_obj(page_objs[i]))
+        finally:
+            factory.cleanup()
+            for _ in chunk:
+                window_semaphore.release()
+        finished_pages += len(chunk)
+        if progress_cb:
+            progress_cb(finished_pages / len(pages) * 0.95)
+
+    with BigTemporaryDirectory(prefix="djpdf-") as temp_dir:
+        chunk_filenames = []
+        chunk_futures = []
+        for i in range(0, len(pages), chunk_size):
+            chunk_filename = path.join(temp_dir, "chunk.%d.pdf" % i)
+            chunk_filenames.append(chunk_filename)
+            chunk_futures.append(make_chunk(i, pages[i:i + chunk_size],
+                                            chunk_filename))
+        await asyncio.gather(*chunk_futures)
+        await concatenate_pdfs(chunk_filenames, pdf_filename,
+                               process_semaphore, linearize)
+        if progress_cb:
+            progress_cb(1)
 
 
 def main():
@@ -598,17 +1228,74 @@ def main():
     parser = ArgumentParser()
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
                         action="store_true")
+    parser.add_argument("--cache-dir", metavar="DIRECTORY",
+                        help="reuse results of previous runs from the "
+                             "persistent cache in DIRECTORY")
+    parser.add_argument("--cache-size", metavar="MIB", type=int,
+                        default=DEFAULT_CACHE_SIZE >> 20,
+                        help="maximum size of the persistent cache "
+                             "(default: %(default)d)")
+    parser.add_argument("--separation-engine", choices=SEPARATION_ENGINES,
+                        default=DEFAULT_SEPARATION_ENGINE,
+                        help="engine used to separate foreground, "
+                             "background and OCR layers "
+                             "(default: %(default)s)")
+    parser.add_argument("--ocr-engine", choices=OCR_ENGINES,
+                        default=DEFAULT_OCR_ENGINE,
+                        help="engine used for OCR (default: %(default)s)")
+    parser.add_argument("--threads", metavar="NUMBER", type=int,
+                        default=DEFAULT_THREADS,
+                        help="threads for parsing and compressing PDF data, "
+                             "0 disables them (default: %(default)d)")
+    parser.add_argument("--checkpoint-dir", metavar="DIRECTORY",
+                        help="store finished pages in DIRECTORY and skip "
+                             "them, when the same job is run again")
+    parser.add_argument("--page-window", metavar="PAGES", type=int,
+                        help="process at most PAGES pages at the same time "
+                             "and write finished pages to intermediate "
+                             "files. Memory and disk usage stay constant "
+                             "in the length of the document")
+    parser.add_argument("--no-linearize", action="store_true",
+                        help="write the PDF directly without optimizing it "
+                             "for fast web view")
+    parser.add_argument("--jbig2-chunk-size", metavar="IMAGES", type=int,
+                        default=DEFAULT_JBIG2_CHUNK_SIZE,
+                        help="lossy JBIG2 images that share one symbol "
+                             "dictionary and are encoded by one process. "
+                             "Some viewers (e.g. Poppler 0.36) can't show "
+                             "shared dictionaries, 1 disables sharing "
+                             "(default: %(default)d)")
+    cli_add_resource_arguments(parser)
     parser.add_argument("OUTFILE")
     args = parser.parse_args()
     cli_set_verbosity(args.verbose)
+    if args.threads < 0:
+        parser.error("argument --threads: must be >= 0")
+    if args.jbig2_chunk_size < 1:
+        parser.error("argument --jbig2-chunk-size: must be >= 1")
+    process_semaphore = cli_apply_resource_arguments(parser, args)
 
     def progress_cb(fraction):
         json.dump({"fraction": fraction}, sys.stdout)
         print()
         sys.stdout.flush()
     try:
+        disk_cache = None
+        if args.cache_dir is not None:
+            disk_cache = DiskCache(args.cache_dir, args.cache_size << 20)
+        checkpoint = None
+        if args.checkpoint_dir is not None:
+            checkpoint = Checkpoint(args.checkpoint_dir)
         recipe = json.load(sys.stdin)
-        asyncio.run(build_pdf(recipe, args.OUTFILE, progress_cb=progress_cb))
+        asyncio.run(build_pdf(recipe, args.OUTFILE, process_semaphore,
+                              progress_cb=progress_cb,
+                              disk_cache=disk_cache,
+                              separation_engine=args.separation_engine,
+                              page_window=args.page_window,
+                              ocr_engine=args.ocr_engine,
+                              checkpoint=checkpoint, threads=args.threads,
+                              linearize=not args.no_linearize,
+                              jbig2_chunk_size=args.jbig2_chunk_size))
     except Exception:
         logging.debug("Exception occurred:\n%s" % traceback.format_exc())
         logging.fatal("Operation failed")
@@ -17,6 +17,7 @@
 
 import asyncio
 import copy
+import itertools
 import logging
 import os
 import re
@@ -28,10 +29,21 @@ from importlib import metadata
 
 import webcolors
 
-from djpdf.djpdf import CONVERT_CMD, JBIG2_CMD, QPDF_CMD
-from djpdf.scans2pdf import (DEFAULT_SETTINGS, IDENTIFY_CMD, TESSERACT_CMD,
-                             build_pdf, find_ocr_languages)
-from djpdf.util import cli_set_verbosity, cli_setup, format_number
+from djpdf.checkpoint import Checkpoint
+from djpdf.distributed import build_pdf_distributed
+from djpdf.diskcache import DEFAULT_CACHE_SIZE, DiskCache
+from djpdf.djpdf import (CONVERT_CMD, DEFAULT_JBIG2_CHUNK_SIZE,
+                         DEFAULT_THREADS, JBIG2_CMD, QPDF_CMD)
+from djpdf.scans2pdf import (DEFAULT_OCR_ENGINE, DEFAULT_SEPARATION_ENGINE,
+                             DEFAULT_SETTINGS, IDENTIFY_CMD, OCR_ENGINES,
+                             SEPARATION_ENGINES, TESSERACT_CMD, build_pdf,
+                             find_ocr_languages)
+from djpdf.scheduler import DEFAULT_SCHEDULING_POLICY, SCHEDULING_POLICIES
+from djpdf.util import (DEFAULT_JOB_MEMORY, DEFAULT_RESERVED_MEMORY,
+                        JOB_MEMORY_ENV, JOBS_ENV, RESERVED_MEMORY_ENV,
+                        TEMP_DIR_ENV, MemoryBoundedSemaphore,
+                        cli_set_verbosity, cli_setup, format_number,
+                        set_big_temp_dir)
 
 VERSION = metadata.version("djpdf")
 
@@ -115,6 +127,78 @@ def type_dpi(var):
     return d
 
 
+SIZE_UNITS = ("B", "K", "M", "G", "T")
+# Sizes without unit are in MiB, like in the other programs of djpdf
+DEFAULT_SIZE_UNIT = "M"
+
+
+def type_size(var):
+    mobj = re.fullmatch(r"(?P<value>\d+)(?:(?P<unit>[KMGT])(?:i?B)?|B)?",
+                        var, re.IGNORECASE)
+    if not mobj:
+        raise ArgumentTypeError("invalid size value: '%s'" % var)
+    if mobj.group("unit") is not None:
+        unit = mobj.group("unit").upper()
+    elif var[-1:].upper() == "B":
+        unit = "B"
+    else:
+        unit = DEFAULT_SIZE_UNIT
+    return int(mobj.group("value")) << (10 * SIZE_UNITS.index(unit))
+
+
+def format_size(size):
+    unit_index = 0
+    while (unit_index + 1 < len(SIZE_UNITS) and size and
+           size % (1 << 10) == 0):
+        size >>= 10
+        unit_index += 1
+    return "%d%s" % (size, SIZE_UNITS[unit_index])
+
+
+def type_page_window(var):
+    try:
+        d = int(var)
+    except ValueError:
+        raise ArgumentTypeError("invalid int value: '%s'" % var)
+    if d < 1:
+        raise ArgumentTypeError("invalid page window value: '%s' "
+                                "(must be ≥ 1)" % var)
+    return d
+
+
+def type_jbig2_chunk_size(var):
+    try:
+        d = int(var)
+    except ValueError:
+        raise ArgumentTypeError("invalid int value: '%s'" % var)
+    if d < 1:
+        raise ArgumentTypeError("invalid chunk size: '%s' "
+                                "(must be ≥ 1)" % var)
+    return d
+
+
+def type_jobs(var):
+    try:
+        d = int(var)
+    except ValueError:
+        raise ArgumentTypeError("invalid int value: '%s'" % var)
+    if d < 1:
+        raise ArgumentTypeError("invalid jobs value: '%s' "
+                                "(must be ≥ 1)" % var)
+    return d
+
+
+def type_count(var):
+    try:
+        d = int(var)
+    except ValueError:
+        raise ArgumentTypeError("invalid int value: '%s'" % var)
+    if d < 0:
+        raise ArgumentTypeError("invalid count: '%s' "
+                                "(must be ≥ 0)" % var)
+    return d
+
+
 def type_bool(var):
     if var.lower() in ("yes", "y", "on", "true", "t", "1"):
         return True
@@ -334,15 +418,140 @@ def main():
                 else ",".join(map(lambda c: rgb_to_name_or_hex(c),
                                   df["ocr_colors"]))))
 
-    global_args = ("--vers", "-h", "--h", "-v", "--verb", "--ocr-li")
-    global_argv = list(filter(
-        lambda arg: any(
-            [arg.startswith(s) for s in global_args]),
-        sys.argv[1:]))
-    remaining_argv = list(filter(
-        lambda arg: not any(
-            [arg.startswith(s) for s in global_args]),
-        sys.argv[1:]))
+    parser.add_argument(
+        "--cache-dir", metavar="DIRECTORY",
+        help="reuse converted images, encoded images and OCR results of "
+             "previous runs from the persistent cache in DIRECTORY")
+    parser.add_argument(
+        "--cache-size", type=type_size, metavar="SIZE",
+        default=DEFAULT_CACHE_SIZE,
+        help="maximum size of the persistent cache. The least recently used "
+             "results are removed first. SIZE is in MiB without unit, like "
+             "--cache-size of djpdf-json and scans2pdf-json "
+             "(default: %s)" % format_size(DEFAULT_CACHE_SIZE))
+
+    parser.add_argument(
+        "--checkpoint-dir", metavar="DIRECTORY",
+        help="store every finished page in DIRECTORY. When the same "
+             "command is run again, e.g. after a crash, finished pages are "
+             "skipped. The directory must only be used for one job")
+
+    parser.add_argument(
+        "--spool-dir", metavar="DIRECTORY",
+        help="distribute the pages to workers that are started with "
+             "'scans2pdf-worker DIRECTORY'. DIRECTORY must be on a "
+             "filesystem that is shared with the workers. Finished pages "
+             "are kept in DIRECTORY and skipped, when the same command is "
+             "run again")
+    parser.add_argument(
+        "--local-workers", type=type_count, metavar="NUMBER", default=0,
+        help="start NUMBER workers on this host for --spool-dir. They "
+             "share --jobs, the memory options apply to each of them "
+             "(default: %(default)d)")
+
+    parser.add_argument(
+        "--separation-engine", choices=SEPARATION_ENGINES,
+        default=DEFAULT_SEPARATION_ENGINE,
+        help="engine used to separate the foreground, background and OCR "
+             "layers. 'imagemagick' runs one process per layer. "
+             "'imagemagick-batch' runs one process for all layers of an "
+             "input image. 'numpy' decodes each input image once and "
+             "separates all layers in-process "
+             "(default: %(default)s)")
+
+    parser.add_argument(
+        "--ocr-engine", choices=OCR_ENGINES, default=DEFAULT_OCR_ENGINE,
+        help="engine used for OCR. 'tesseract' runs one process per page. "
+             "'tesseract-tsv' reads the faster to parse TSV output of "
+             "tesseract, but loses the text angles and directions. "
+             "'tesserocr' keeps worker processes with the language data "
+             "loaded and falls back to 'tesseract' on errors "
+             "(default: %(default)s)")
+
+    parser.add_argument(
+        "--threads", type=type_count, metavar="NUMBER",
+        default=DEFAULT_THREADS,
+        help="threads for parsing and compressing PDF data, so that the "
+             "event loop stays free to start external programs. 0 runs "
+             "the work directly on the event loop "
+             "(default: %(default)d)")
+
+    parser.add_argument(
+        "--no-linearize", action="store_true",
+        help="write the PDF directly to OUTFILE without optimizing it for "
+             "fast web view. This avoids rewriting the whole document")
+
+    parser.add_argument(
+        "--jbig2-chunk-size", type=type_jbig2_chunk_size, metavar="PAGES",
+        default=DEFAULT_JBIG2_CHUNK_SIZE,
+        help="lossy JBIG2 foregrounds of PAGES consecutive pages share one "
+             "symbol dictionary and are encoded by one jbig2 process. "
+             "Larger chunks make smaller files, but viewers need more "
+             "memory and some (e.g. Poppler 0.36) can't show shared "
+             "dictionaries. 1 disables sharing (default: %(default)d)")
+
+    parser.add_argument(
+        "--jobs", type=type_jobs, metavar="NUMBER",
+        help="maximum number of external programs that run at the same "
+             "time (default: $%s or the number of CPUs)" % JOBS_ENV)
+
+    parser.add_argument(
+        "--job-memory", type=type_size, metavar="SIZE",
+        help="memory that must be available to start an external program, "
+             "when its memory can't be estimated. The memory limit of the "
+             "cgroup (e.g. of a container) is respected. SIZE is in MiB "
+             "without unit (e.g. 512 or 2G) "
+             "(default: $%s MiB or %s)" % (
+                 JOB_MEMORY_ENV, format_size(DEFAULT_JOB_MEMORY)))
+
+    parser.add_argument(
+        "--reserved-memory", type=type_size, metavar="SIZE",
+        help="memory that is left for other processes. SIZE is in MiB "
+             "without unit "
+             "(default: $%s MiB or %s)" % (
+                 RESERVED_MEMORY_ENV, format_size(DEFAULT_RESERVED_MEMORY)))
+
+    parser.add_argument(
+        "--scheduling-policy", choices=SCHEDULING_POLICIES,
+        default=DEFAULT_SCHEDULING_POLICY,
+        help="order in which waiting external programs are started. "
+             "critical-path starts programs that others depend on and long "
+             "ones first, page-order starts programs of earlier pages first "
+             "and fifo in the order in which they were requested "
+             "(default: %(default)s)")
+
+    parser.add_argument(
+        "--temp-dir", metavar="DIRECTORY",
+        help="directory for big temporary files "
+             "(default: $%s or /var/tmp)" % TEMP_DIR_ENV)
+
+    parser.add_argument(
+        "--page-window", type=type_page_window, metavar="PAGES",
+        help="process at most PAGES pages at the same time. Finished pages "
+             "are written to intermediate files and their temporary files "
+             "are removed, so that memory and disk usage stay constant in "
+             "the length of the document "
+             "(default: process all pages at once)")
+
+    global_args = ("--vers", "-h", "--h", "-v", "--verb", "--ocr-li",
+                   "--no-lin")
+    # global arguments that expect one argument
+    global_value_args = ("--cache-d", "--cache-s", "--check", "--spool",
+                         "--local", "--sep", "--ocr-e", "--thr", "--page-w",
+                         "--jbig2-c", "--jobs", "--job-m", "--res", "--sch",
+                         "--temp")
+    global_argv = []
+    remaining_argv = []
+    argv_iter = iter(sys.argv[1:])
+    for arg in argv_iter:
+        if any(arg.startswith(s) for s in global_args):
+            global_argv.append(arg)
+        elif any(arg.startswith(s) for s in global_value_args):
+            global_argv.append(arg)
+            if "=" not in arg:
+                global_argv.extend(itertools.islice(argv_iter, 1))
+        else:
+            remaining_argv.append(arg)
 
     # handle global arguments
     ns = parser.parse_args(global_argv)
@@ -352,6 +561,33 @@ def main():
         print("\n".join(ocr_languages))
         sys.exit(0)
 
+    disk_cache = None
+    if ns.cache_dir is not None:
+        disk_cache = DiskCache(ns.cache_dir, ns.cache_size)
+    separation_engine = ns.separation_engine
+    page_window = ns.page_window
+    checkpoint_dir = ns.checkpoint_dir
+    spool_dir = ns.spool_dir
+    threads = ns.threads
+    local_workers = ns.local_workers
+    linearize = not ns.no_linearize
+    jbig2_chunk_size = ns.jbig2_chunk_size
+    if ns.temp_dir is not None:
+        set_big_temp_dir(ns.temp_dir)
+    try:
+        process_semaphore = MemoryBoundedSemaphore(
+            ns.jobs, ns.job_memory, ns.reserved_memory,
+            scheduling_policy=ns.scheduling_policy)
+    except ValueError as e:
+        parser.error(str(e))
+    if spool_dir is not None and (page_window is not None or
+                                  checkpoint_dir is not None):
+        parser.error("argument --spool-dir: not allowed with argument "
+                     "--page-window or --checkpoint-dir")
+    if spool_dir is None and local_workers:
+        parser.error("argument --local-workers: requires --spool-dir")
+    ocr_engine = ns.ocr_engine
+
     infile_parser = ArgumentParser(usage=parser.usage, prog=parser.prog,
                                    parents=(parser,), add_help=False)
     infile_parser.add_argument("INFILE", type=type_infile)
@@ -389,7 +625,24 @@ def main():
     out_file = ns.OUTFILE
 
     try:
-        asyncio.run(build_pdf(pages, out_file))
+        if spool_dir is not None:
+            asyncio.run(build_pdf_distributed(
+                pages, out_file, spool_dir, process_semaphore,
+                local_workers=local_workers,
+                separation_engine=separation_engine, ocr_engine=ocr_engine,
+                linearize=linearize, jbig2_chunk_size=jbig2_chunk_size))
+            return
+        checkpoint = None
+        if checkpoint_dir is not None:
+            checkpoint = Checkpoint(checkpoint_dir)
+        asyncio.run(build_pdf(pages, out_file, process_semaphore,
+                              disk_cache=disk_cache,
+                              separation_engine=separation_engine,
+                              page_window=page_window,
+                              ocr_engine=ocr_engine,
+                              checkpoint=checkpoint, threads=threads,
+                              linearize=linearize,
+                              jbig2_chunk_size=jbig2_chunk_size))
     except Exception:
         logging.debug("Exception occurred:\n%s" % traceback.format_exc())
         logging.fatal("Operation failed")
@@ -0,0 +1,67 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import contextvars
+
+# critical-path: commands that others depend on first, then the longest
+# page-order: commands of earlier pages first, so that pages are finished
+#             in order
+# fifo: commands in the order in which they are started
+SCHEDULING_POLICIES = ("critical-path", "page-order", "fifo")
+DEFAULT_SCHEDULING_POLICY = "critical-path"
+# Stage in the pipeline of a page by the first word of the operation of
+# a command. The later stages depend on the results of the earlier ones.
+OPERATION_DEPTHS = {
+    "input": 0,
+    "size": 0,
+    "dpi": 0,
+    "separate": 1,
+    "histogram": 2,
+    "ocr": 2,
+    "threshold": 2,
+    "encode": 2,
+    "symbol": 3,
+    "generic": 3,
+    "linearize": 4,
+    "concatenate": 4,
+}
+UNKNOWN_DEPTH = 1
+
+# Indices of the page of the current task, outer lists of pages first
+# (e.g. the first page of a chunk and the page in the chunk)
+_page_path = contextvars.ContextVar("djpdf_page_path", default=())
+
+
+def set_page(page_index):
+    """Sets the page of the current task and of the tasks that it
+    creates."""
+    _page_path.set(_page_path.get() + (page_index,))
+
+
+def priority(policy, operation=None, cost=0):
+    """Returns the key by which waiting commands are sorted, smaller keys
+    are started first. ``cost`` is the estimated duration."""
+    if policy not in SCHEDULING_POLICIES:
+        raise ValueError("Unsupported scheduling policy: %s" % policy)
+    if policy == "fifo":
+        return ()
+    depth = UNKNOWN_DEPTH
+    if operation is not None:
+        depth = OPERATION_DEPTHS.get(operation.split("-")[0], UNKNOWN_DEPTH)
+    if policy == "page-order":
+        return (_page_path.get(), depth, -cost)
+    return (depth, -cost)
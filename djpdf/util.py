@@ -17,85 +17,342 @@
 
 import asyncio
 import contextlib
+import functools
+import heapq
+import itertools
 import logging
 import os
 import signal
 import sys
+import tempfile
 import warnings
+from os import path
 from subprocess import PIPE, CalledProcessError
 
 import colorama
 import psutil
 
+from djpdf import scheduler
+from djpdf.memoryprofile import MemoryProfile, peak_memory
+
+# Environment variables with the defaults of MemoryBoundedSemaphore and
+# BigTemporaryDirectory. Memory is in MiB.
+JOBS_ENV = "DJPDF_JOBS"
+JOB_MEMORY_ENV = "DJPDF_JOB_MEMORY"
+RESERVED_MEMORY_ENV = "DJPDF_RESERVED_MEMORY"
+TEMP_DIR_ENV = "DJPDF_TEMP_DIR"
+DEFAULT_JOB_MEMORY = 1 << 30
+DEFAULT_RESERVED_MEMORY = 1 << 30
+CGROUP_ROOT = "/sys/fs/cgroup"
+# Seconds between measurements of the memory of external programs
+PEAK_MEMORY_INTERVAL = 0.1
+# Seconds between checks of the available memory for waiting jobs
+DEFAULT_POLL_INTERVAL = 0.5
+
+
+def _env_int(name, default, minimum):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        result = int(value)
+    except ValueError:
+        result = None
+    if result is None or result < minimum:
+        raise ValueError("invalid value of %s: %r (must be an integer >= %d)"
+                         % (name, value, minimum))
+    return result
+
+
+def default_jobs():
+    return _env_int(JOBS_ENV, os.cpu_count() or 1, 1)
+
+
+def default_job_memory():
+    return _env_int(JOB_MEMORY_ENV, DEFAULT_JOB_MEMORY >> 20, 0) << 20
+
+
+def default_reserved_memory():
+    return _env_int(RESERVED_MEMORY_ENV, DEFAULT_RESERVED_MEMORY >> 20,
+                    0) << 20
+
+
+def _default_big_temp_dir():
+    directory = os.environ.get(TEMP_DIR_ENV)
+    if directory:
+        return directory
+    directory = tempfile.gettempdir()
+    if directory == "/tmp":
+        with contextlib.suppress(OSError):
+            with tempfile.NamedTemporaryFile(dir="/var/tmp"):
+                directory = "/var/tmp"
+    return directory
+
+
+big_temp_dir = _default_big_temp_dir()
+
+
+def set_big_temp_dir(directory):
+    global big_temp_dir
+    big_temp_dir = directory
+
+
+def BigTemporaryDirectory(*args, dir=None, **kwargs):
+    if dir is None:
+        dir = big_temp_dir
+    return tempfile.TemporaryDirectory(*args, dir=dir, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _cgroup_memory_files():
+    # Returns the directory of the memory cgroup of this process and the
+    # names of the limit, usage and statistics files and of the inactive
+    # page cache statistic, or None
+    try:
+        with open("/proc/self/cgroup") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return None
+    candidates = []
+    for line in lines:
+        _, controllers, cgroup_path = line.split(":", 2)
+        cgroup_path = cgroup_path.lstrip("/")
+        if "memory" in controllers.split(","):
+            # cgroup v1 is used before v2 on hybrid systems
+            root = path.join(CGROUP_ROOT, "memory")
+            candidates.insert(0, (root, cgroup_path, (
+                "memory.limit_in_bytes", "memory.usage_in_bytes",
+                "memory.stat", "total_inactive_file")))
+        elif not controllers:
+            candidates.append((CGROUP_ROOT, cgroup_path, (
+                "memory.max", "memory.current", "memory.stat",
+                "inactive_file")))
+    for root, cgroup_path, names in candidates:
+        # Inside of containers the cgroup of the process is the root
+        for directory in (path.join(root, cgroup_path), root):
+            if path.isfile(path.join(directory, names[0])):
+                return directory, names
+    return None
+
+
+def _cgroup_memory():
+    # Returns the limit and the used memory of the memory cgroup or None
+    # if it's not limited
+    files = _cgroup_memory_files()
+    if files is None:
+        return None
+    directory, (limit_name, usage_name, stat_name, inactive_name) = files
+    try:
+        with open(path.join(directory, limit_name)) as f:
+            limit = f.read().strip()
+        if limit == "max":
+            return None
+        limit = int(limit)
+        with open(path.join(directory, usage_name)) as f:
+            usage = int(f.read())
+        inactive = 0
+        with open(path.join(directory, stat_name)) as f:
+            for line in f:
+                key, value = line.split()
+                if key == inactive_name:
+                    inactive = int(value)
+    except (OSError, ValueError):
+        return None
+    # cgroup v1 reports a huge number, when it's not limited
+    if limit >= psutil.virtual_memory().total:
+        return None
+    # Inactive page cache is reclaimed before processes are killed
+    return limit, max(0, usage - inactive)
+
+
+def available_memory():
+    """Memory that can be used without swapping, within the limit of the
+    memory cgroup (e.g. of a container)."""
+    memory = psutil.virtual_memory().available
+    cgroup_memory = _cgroup_memory()
+    if cgroup_memory is not None:
+        limit, used = cgroup_memory
+        memory = min(memory, limit - used)
+    return max(0, memory)
+
 
 class MemoryBoundedSemaphore():
+    """Limits the number of jobs that run at the same time.
 
-    def __init__(self, value, job_memory, reserved_memory, *, loop=None):
+    Each job reserves the memory it's expected to use, ``job_memory`` if
+    it's unknown. Jobs are only started, when their memory is available
+    in addition to ``reserved_memory``. A job that needs more memory than
+    is available waits until it's the only job. Waiting jobs are started
+    by their priority (see ``scheduler.priority``) and in order, when a
+    job is released and every ``poll_interval`` seconds, because memory
+    can be freed by other processes (None disables it).
+    The defaults are read from the environment.
+    ``memory_profile`` is the ``MemoryProfile`` that ``run_command`` uses
+    to estimate the memory and the duration of commands, by default the
+    profile file of the user.
+    """
+
+    def __init__(self, value=None, job_memory=None, reserved_memory=None, *,
+                 memory_profile=None, poll_interval=DEFAULT_POLL_INTERVAL,
+                 scheduling_policy=scheduler.DEFAULT_SCHEDULING_POLICY,
+                 loop=None):
+        if value is None:
+            value = default_jobs()
+        if job_memory is None:
+            job_memory = default_job_memory()
+        if reserved_memory is None:
+            reserved_memory = default_reserved_memory()
         if value < 0:
             raise ValueError("value must be >= 0")
         if job_memory < 0:
             raise ValueError("job_memory must be >= 0")
         if reserved_memory < 0:
             raise ValueError("reserved_memory must be >= 0")
+        if poll_interval is not None and poll_interval <= 0:
+            raise ValueError("poll_interval must be > 0")
+        if scheduling_policy not in scheduler.SCHEDULING_POLICIES:
+            raise ValueError("Unsupported scheduling policy: %s" %
+                             scheduling_policy)
+        if memory_profile is None:
+            memory_profile = MemoryProfile.default()
         self._value = self._bound_value = value
         self._job_memory = job_memory
         self._reserved_memory = reserved_memory
+        self._poll_interval = poll_interval
+        self._poll_handle = None
+        self.memory_profile = memory_profile
+        self.scheduling_policy = scheduling_policy
+        # Memory that is reserved by running jobs
+        self._used_memory = 0
+        # Heap of (priority, sequence number, future, memory), cancelled
+        # futures are removed when they reach the front
         self._waiters = []
-        self._pids = set()
-        if loop is not None:
-            self._loop = loop
-        else:
-            self._loop = asyncio.get_event_loop()
-
-    def _wake_up_next(self, count=1):
-        while count > 0 and self._waiters:
-            waiter = self._waiters.pop(0)
-            if not waiter.done():
-                waiter.set_result(None)
-                count -= 1
-
-    def _available_jobs(self):
-        available_memory = psutil.virtual_memory().free
-        available_memory -= self._reserved_memory
-        available_memory -= self._job_memory * (
-            self._bound_value - self._value)
-        for pid in self._pids:
+        self._sequence = itertools.count()
+        # Maps PIDs to the psutil.Process (None if it exited) and the
+        # memory that is reserved for the process
+        self._pids = {}
+        # The running loop is used by default, so that the semaphore can be
+        # created before the loop
+        self._loop = loop
+
+    @property
+    def jobs(self):
+        return self._bound_value
+
+    def settings(self, parts=1):
+        """Arguments for semaphores of ``parts`` other processes that share
+        the jobs of this one. The memory settings apply to each of them."""
+        return {"value": max(1, self._bound_value // parts),
+                "job_memory": self._job_memory,
+                "reserved_memory": self._reserved_memory,
+                "poll_interval": self._poll_interval,
+                "scheduling_policy": self.scheduling_policy}
+
+    def _free_memory(self):
+        memory = available_memory()
+        memory -= self._reserved_memory
+        memory -= self._used_memory
+        # Memory that running processes already use is part of their
+        # reservation
+        for process, pid_memory in self._pids.values():
+            if process is None:
+                continue
             with contextlib.suppress(psutil.NoSuchProcess):
-                process_memory = psutil.Process(pid).memory_info().rss
-                available_memory += min(self._job_memory, process_memory)
-        available_memory = max(0, available_memory)
-        jobs = available_memory // self._job_memory
-        if self._value == self._bound_value:
-            # Allow at least one job, when low on memory
-            jobs = max(1, jobs)
-        return min(self._value, jobs)
-
-    async def acquire(self):
-        while self._available_jobs() == 0:
-            waiter = self._loop.create_future()
-            self._waiters.append(waiter)
-            try:
-                await waiter
-            except BaseException:
-                waiter.cancel()
-                if not waiter.cancelled() and self._available_jobs() > 0:
-                    self._wake_up_next()
-                raise
+                memory += min(pid_memory, process.memory_info().rss)
+        return memory
+
+    def _fits(self, memory):
+        if self._value == 0:
+            return False
+        # Allow at least one job, when low on memory
+        return (self._value == self._bound_value or
+                memory <= self._free_memory())
+
+    def _take(self, memory):
         self._value -= 1
+        self._used_memory += memory
+
+    def _wake_up_next(self):
+        free_memory = None
+        while self._waiters and self._value > 0:
+            _, _, waiter, memory = self._waiters[0]
+            if waiter.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self._value < self._bound_value:
+                if free_memory is None:
+                    free_memory = self._free_memory()
+                # Later jobs don't overtake the first one, so that big jobs
+                # get their memory eventually
+                if memory > free_memory:
+                    break
+                free_memory -= memory
+            heapq.heappop(self._waiters)
+            self._take(memory)
+            waiter.set_result(None)
+
+    def _poll(self):
+        self._poll_handle = None
+        self._wake_up_next()
+        self._schedule_poll()
 
-    def release(self):
+    def _schedule_poll(self):
+        if (self._poll_interval is None or self._poll_handle is not None or
+                not self._waiters):
+            return
+        loop = self._loop or asyncio.get_running_loop()
+        self._poll_handle = loop.call_later(self._poll_interval, self._poll)
+
+    async def acquire(self, memory=None, priority=None):
+        """Waits until a job that uses ``memory`` bytes can be started.
+        The same value must be passed to ``release``."""
+        if memory is None:
+            memory = self._job_memory
+        if priority is None:
+            priority = scheduler.priority(self.scheduling_policy)
+        if not self._waiters and self._fits(memory):
+            self._take(memory)
+            return
+        loop = self._loop or asyncio.get_running_loop()
+        waiter = loop.create_future()
+        heapq.heappush(self._waiters,
+                       (priority, next(self._sequence), waiter, memory))
+        self._schedule_poll()
+        try:
+            await waiter
+        except BaseException:
+            if waiter.done() and not waiter.cancelled():
+                # The job was started, when the task was cancelled
+                self.release(memory)
+            else:
+                waiter.cancel()
+                self._wake_up_next()
+            raise
+
+    def release(self, memory=None):
+        if memory is None:
+            memory = self._job_memory
         if self._value >= self._bound_value:
             raise ValueError("Semaphore released too many times")
         self._value += 1
-        self._wake_up_next(self._available_jobs())
+        self._used_memory -= memory
+        self._wake_up_next()
+        if not self._waiters and self._poll_handle is not None:
+            self._poll_handle.cancel()
+            self._poll_handle = None
 
-    def add_pid(self, pid):
+    def add_pid(self, pid, memory=None):
         if pid in self._pids:
             raise ValueError("PID already exists")
-        self._pids.add(pid)
+        try:
+            process = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            process = None
+        self._pids[pid] = (process,
+                           self._job_memory if memory is None else memory)
 
     def remove_pid(self, pid):
-        self._pids.remove(pid)
+        del self._pids[pid]
 
     async def __aenter__(self):
         await self.acquire()
@@ -139,27 +396,56 @@ def format_number(f, decimal_places, percentage=False,
     return s
 
 
-async def run_command(args, process_semaphore, cwd=None):
+async def _watch_peak_memory(pid, peaks):
+    # Appends the peak memory of the process until the task is cancelled
+    while True:
+        memory = peak_memory(pid)
+        if memory is not None:
+            peaks.append(memory)
+        await asyncio.sleep(PEAK_MEMORY_INTERVAL)
+
+
+async def run_command(args, process_semaphore, cwd=None, operation=None,
+                      pixels=None):
+    """Runs the program with the arguments ``args`` and returns its output.
+
+    ``operation`` and the number of ``pixels`` that the program processes
+    are used to estimate its memory and duration with the
+    ``memory_profile`` of the semaphore and to schedule it.
+    """
     logging.debug("Running command: %s", args)
     env = {
         **os.environ,
         "MAGICK_THREAD_LIMIT": "1",
         "OMP_THREAD_LIMIT": "1"
     }
-    async with process_semaphore:
+    memory_profile = process_semaphore.memory_profile
+    memory = memory_profile.estimate(args[0], operation, pixels)
+    priority = scheduler.priority(
+        process_semaphore.scheduling_policy, operation,
+        memory_profile.estimate_duration(args[0], operation, pixels))
+    peaks = []
+    await process_semaphore.acquire(memory, priority)
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    try:
         try:
             proc = await asyncio.create_subprocess_exec(
                 *args, stdout=PIPE, stderr=PIPE, env=env, cwd=cwd)
         except (FileNotFoundError, PermissionError) as e:
             logging.error("Program not found: %s" % args[0])
             raise Exception("Program not found: %s" % args[0]) from e
-        process_semaphore.add_pid(proc.pid)
+        process_semaphore.add_pid(proc.pid, memory)
+        watcher = asyncio.ensure_future(_watch_peak_memory(proc.pid, peaks))
         try:
             outs, errs = await proc.communicate()
         finally:
+            watcher.cancel()
             with contextlib.suppress(ProcessLookupError):
                 proc.kill()
             process_semaphore.remove_pid(proc.pid)
+    finally:
+        process_semaphore.release(memory)
     errs = errs.decode(sys.stderr.encoding, sys.stderr.errors)
     if errs:
         logging.debug(errs)
@@ -167,6 +453,9 @@ async def run_command(args, process_semaphore, cwd=None):
         logging.error("Command '%s' returned non-zero exit status %d",
                       args, proc.returncode)
         raise CalledProcessError(proc.returncode, args, None)
+    memory_profile.record(args[0], operation, pixels,
+                          max(peaks) if peaks else None,
+                          loop.time() - start_time)
     return outs
 
 
@@ -222,3 +511,53 @@ def cli_set_verbosity(verbose):
     else:
         logging.getLogger().setLevel(logging.WARNING)
         warnings.simplefilter("ignore")
+
+
+def cli_add_resource_arguments(parser):
+    # The defaults are read from the environment
+    parser.add_argument("--jobs", metavar="NUMBER", type=int,
+                        help="maximum number of external programs that run "
+                             "at the same time (default: $%s or the number "
+                             "of CPUs)" % JOBS_ENV)
+    parser.add_argument("--job-memory", metavar="MIB", type=int,
+                        help="memory that must be available to start an "
+                             "external program, when its memory can't be "
+                             "estimated (default: $%s or %d)" % (
+                                 JOB_MEMORY_ENV, DEFAULT_JOB_MEMORY >> 20))
+    parser.add_argument("--reserved-memory", metavar="MIB", type=int,
+                        help="memory that is left for other processes "
+                             "(default: $%s or %d)" % (
+                                 RESERVED_MEMORY_ENV,
+                                 DEFAULT_RESERVED_MEMORY >> 20))
+    parser.add_argument("--scheduling-policy",
+                        choices=scheduler.SCHEDULING_POLICIES,
+                        default=scheduler.DEFAULT_SCHEDULING_POLICY,
+                        help="order in which waiting external programs are "
+                             "started: programs that others depend on and "
+                             "long ones first, programs of earlier pages "
+                             "first or in the order in which they were "
+                             "requested (default: %(default)s)")
+    parser.add_argument("--temp-dir", metavar="DIRECTORY",
+                        help="directory for big temporary files (default: "
+                             "$%s or /var/tmp)" % TEMP_DIR_ENV)
+
+
+def cli_apply_resource_arguments(parser, args):
+    # Returns the MemoryBoundedSemaphore for the arguments
+    for name, value, minimum in [("--jobs", args.jobs, 1),
+                                 ("--job-memory", args.job_memory, 0),
+                                 ("--reserved-memory", args.reserved_memory,
+                                  0)]:
+        if value is not None and value < minimum:
+            parser.error("argument %s: must be >= %d" % (name, minimum))
+    if args.temp_dir is not None:
+        set_big_temp_dir(args.temp_dir)
+    try:
+        return MemoryBoundedSemaphore(
+            args.jobs,
+            None if args.job_memory is None else args.job_memory << 20,
+            None if args.reserved_memory is None else
+            args.reserved_memory << 20,
+            scheduling_policy=args.scheduling_policy)
+    except ValueError as e:
+        parser.error(str(e))
@@ -9,7 +9,9 @@ setup(
     entry_points={"console_scripts": ["scans2pdf = djpdf.scans2pdfcli:main",
                                       "scans2pdf-json = djpdf.scans2pdf:main",
                                       "djpdf-json = djpdf.djpdf:main",
-                                      "hocr-json = djpdf.hocr:main"]},
+                                      "hocr-json = djpdf.hocr:main",
+                                      "scans2pdf-worker = "
+                                      "djpdf.distributed:main"]},
     python_requires=">=3.8",
     install_requires=["webcolors", "colorama", "pdfrw", "psutil",
                       "python-xmp-toolkit",
@@ -0,0 +1,88 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import json
+import os
+import sys
+
+import pytest
+
+# Writes JBIG2 page information segments and logs its arguments
+FAKE_JBIG2 = """#!%(python)s
+import json, os, struct, sys
+with open(%(log)r, "a") as f:
+    f.write(json.dumps(sys.argv[1:]) + "\\n")
+inputs = [a for a in sys.argv[1:] if os.path.isfile(a)]
+segment = b"\\0" * 11 + struct.pack(">IIII", 40, 20, 300, 300)
+if "-s" in sys.argv:
+    for i, _ in enumerate(inputs):
+        with open("output.%%04d" %% i, "wb") as f:
+            f.write(segment)
+    with open("output.sym", "wb") as f:
+        f.write(b"SYMBOLS")
+else:
+    sys.stdout.buffer.write(segment)
+"""
+
+
+class FakeJbig2:
+    def __init__(self, log_filename):
+        self._log_filename = log_filename
+
+    def calls(self):
+        if not os.path.exists(self._log_filename):
+            return []
+        with open(self._log_filename) as f:
+            return [json.loads(line) for line in f]
+
+
+@pytest.fixture(autouse=True)
+def no_memory_profile(monkeypatch):
+    # Don't learn from the fake programs
+    monkeypatch.setenv("DJPDF_MEMORY_PROFILE", "")
+
+
+@pytest.fixture
+def fake_jbig2(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log_filename = str(tmp_path / "jbig2.log")
+    program = bin_dir / "jbig2"
+    program.write_text(FAKE_JBIG2 % {"python": sys.executable,
+                                     "log": log_filename})
+    program.chmod(0o755)
+    monkeypatch.setenv("PATH", os.pathsep.join([str(bin_dir),
+                                                os.environ["PATH"]]))
+    return FakeJbig2(log_filename)
+
+
+@pytest.fixture
+def make_pbm(tmp_path):
+    # Writes black and white images with a black rectangle
+    def make_pbm(name, width=40, height=20):
+        rows = []
+        for y in range(height):
+            row = bytearray((width + 7) // 8)
+            if height // 4 <= y < height * 3 // 4:
+                for x in range(width // 4, width * 3 // 4):
+                    row[x // 8] |= 0x80 >> (x % 8)
+            rows.append(bytes(row))
+        filename = str(tmp_path / name)
+        with open(filename, "wb") as f:
+            f.write(b"P4\n%d %d\n" % (width, height) + b"".join(rows))
+        return filename
+    return make_pbm
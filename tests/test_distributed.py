@@ -0,0 +1,101 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip("libxmp")
+
+from pdfrw import PdfReader  # noqa: E402
+
+from djpdf.diskcache import DiskCache  # noqa: E402
+from djpdf.distributed import (PageFailedError,  # noqa: E402
+                               build_pdf_distributed, run_worker)
+from djpdf.scans2pdf import DEFAULT_SETTINGS  # noqa: E402
+from djpdf.util import MemoryBoundedSemaphore  # noqa: E402
+
+
+def test_build_pdf_distributed(tmp_path, fake_jbig2, make_pbm):
+    # Black and white pages are used without ImageMagick, only jbig2 runs
+    pages = [{**DEFAULT_SETTINGS,
+              "filename": make_pbm("page%d.pbm" % i, width=40 + 8 * i),
+              "dpi": 300, "ocr_enabled": False}
+             for i in range(2)]
+    spool_dir = str(tmp_path / "spool")
+    pdf_filename = str(tmp_path / "out.pdf")
+    psem = MemoryBoundedSemaphore(2, 0, 0)
+    # Encoded image of an earlier job
+    stale_key = DiskCache.make_key("stale")
+    DiskCache(os.path.join(spool_dir, "cache")).store(stale_key, {})
+
+    async def build():
+        worker = asyncio.ensure_future(run_worker(
+            spool_dir, psem, poll_interval=0.01))
+        try:
+            await asyncio.wait_for(build_pdf_distributed(
+                pages, pdf_filename, spool_dir, psem, poll_interval=0.01,
+                linearize=False), 60)
+        finally:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+    asyncio.run(build())
+    assert len(PdfReader(pdf_filename).pages) == 2
+    assert os.listdir(os.path.join(spool_dir, "failed")) == []
+    # The worker encoded the foregrounds, they were not encoded again
+    assert len(fake_jbig2.calls()) == len(pages)
+    disk_cache = DiskCache(os.path.join(spool_dir, "cache"))
+    assert disk_cache.lookup(stale_key) is None
+    assert len(os.listdir(os.path.join(spool_dir, "cache"))) > 0
+
+
+def test_encoding_error(tmp_path, monkeypatch, make_pbm):
+    # Pages are only finished, when their images are encoded
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    program = bin_dir / "jbig2"
+    program.write_text("#!/bin/sh\nexit 1\n")
+    program.chmod(0o755)
+    monkeypatch.setenv("PATH", os.pathsep.join([str(bin_dir),
+                                                os.environ["PATH"]]))
+    pages = [{**DEFAULT_SETTINGS, "filename": make_pbm("page.pbm"),
+              "dpi": 300, "ocr_enabled": False, "fg_jbig2_threshold": 1}]
+    spool_dir = str(tmp_path / "spool")
+    psem = MemoryBoundedSemaphore(2, 0, 0)
+
+    async def build():
+        worker = asyncio.ensure_future(run_worker(
+            spool_dir, psem, poll_interval=0.01))
+        try:
+            await asyncio.wait_for(build_pdf_distributed(
+                pages, str(tmp_path / "out.pdf"), spool_dir, psem,
+                poll_interval=0.01, linearize=False), 60)
+        finally:
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+    with pytest.raises(PageFailedError):
+        asyncio.run(build())
+
+
+def test_local_worker_settings():
+    # Local workers share the jobs of the coordinator
+    psem = MemoryBoundedSemaphore(5, 1 << 20, 0, scheduling_policy="fifo")
+    worker_psem = MemoryBoundedSemaphore(**psem.settings(2))
+    assert worker_psem.jobs == 2
+    assert worker_psem.scheduling_policy == "fifo"
+    assert MemoryBoundedSemaphore(**psem.settings(8)).jobs == 1
@@ -0,0 +1,38 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import io
+
+from djpdf import hocr
+
+HOCR = b"""<html><body><div class="ocr_page">
+<span class="ocr_line" title="bbox 0 0 100 20; textangle 0">
+<span class="ocrx_word" title="bbox 2 3 42 18">Hello</span>
+<span class="ocrx_word" title="bbox 50 3 98 18"><strong>World</strong></span>
+</span></div></body></html>"""
+TSV = "\n".join("\t".join(row) for row in [
+    hocr.TSV_COLUMNS,
+    ("4", "1", "1", "1", "1", "0", "0", "0", "100", "20", "-1", ""),
+    ("5", "1", "1", "1", "1", "1", "2", "3", "40", "15", "96", "Hello"),
+    ("5", "1", "1", "1", "1", "2", "50", "3", "48", "15", "95", "World"),
+    ("5", "1", "1", "1", "1", "3", "99", "3", "1", "15", "10", " ")]) + "\n"
+
+
+def test_tsv_matches_hocr():
+    texts = hocr.extract_text(io.BytesIO(HOCR))
+    assert [text["text"] for text in texts] == ["Hello", "World"]
+    assert hocr.extract_text_tsv(io.StringIO(TSV)) == texts
@@ -0,0 +1,64 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import struct
+import zlib
+
+from djpdf.imageinfo import is_plain_color_png
+
+RED = (0xff, 0x00, 0x00)
+WHITE = (0xff, 0xff, 0xff)
+
+
+def _write_png(filename, color_type, rows, chunks=()):
+    # 8-bit PNG with unfiltered rows and additional chunks before IDAT
+    def chunk(chunk_type, data):
+        return (struct.pack(">I", len(data)) + chunk_type + data +
+                struct.pack(">I", zlib.crc32(chunk_type + data)))
+    channels = 3 if color_type == 2 else 1
+    width = len(rows[0]) // channels
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, len(rows), 8,
+                                           color_type, 0, 0, 0)))
+        for chunk_type, data in chunks:
+            f.write(chunk(chunk_type, data))
+        f.write(chunk(b"IDAT", zlib.compress(
+            b"".join(b"\0" + row for row in rows))))
+        f.write(chunk(b"IEND", b""))
+
+
+def test_plain_palette(tmp_path):
+    filename = str(tmp_path / "image.png")
+    _write_png(filename, 3, [b"\0" * 4] * 3, [(b"PLTE", bytes(WHITE))])
+    assert is_plain_color_png(filename, WHITE) is True
+    assert is_plain_color_png(filename, RED) is False
+
+
+def test_suggested_palette(tmp_path):
+    # PLTE of truecolor images doesn't describe the pixels
+    filename = str(tmp_path / "image.png")
+    _write_png(filename, 2, [bytes(RED) * 4] * 3, [(b"PLTE", bytes(WHITE))])
+    assert is_plain_color_png(filename, WHITE) is False
+    assert is_plain_color_png(filename, RED) is True
+
+
+def test_transparency(tmp_path):
+    filename = str(tmp_path / "image.png")
+    _write_png(filename, 3, [b"\0" * 4] * 3,
+               [(b"PLTE", bytes(WHITE)), (b"tRNS", b"\0")])
+    assert is_plain_color_png(filename, WHITE) is None
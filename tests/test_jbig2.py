@@ -0,0 +1,69 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import asyncio
+
+import pytest
+
+pytest.importorskip("libxmp")
+
+from pdfrw import PdfName, PdfReader  # noqa: E402
+
+from djpdf.djpdf import build_pdf  # noqa: E402
+from djpdf.util import MemoryBoundedSemaphore  # noqa: E402
+
+PAGES = 5
+
+
+def _jbig2_globals(pdf_filename):
+    # JBIG2Globals of the image on each page
+    result = []
+    for page in PdfReader(pdf_filename).pages:
+        images = [xobject for xobject in page.Resources.XObject.values()
+                  if xobject.Filter == [PdfName.JBIG2Decode]]
+        assert len(images) == 1
+        result.append(images[0].DecodeParms[0].JBIG2Globals)
+    return result
+
+
+@pytest.mark.parametrize("chunk_size,chunks", [
+    (1, [[0], [1], [2], [3], [4]]),
+    (2, [[0, 1], [2, 3], [4]])])
+def test_chunks(tmp_path, fake_jbig2, make_pbm, chunk_size, chunks):
+    filenames = [make_pbm("page%d.pbm" % i) for i in range(PAGES)]
+    recipe = {"pages": [
+        {"width": 40 * 72 / 300, "height": 20 * 72 / 300,
+         "foreground": [{"filename": filename, "compression": "jbig2",
+                         "jbig2_threshold": 0.85}]}
+        for filename in filenames]}
+    pdf_filename = str(tmp_path / "out.pdf")
+    asyncio.run(build_pdf(recipe, pdf_filename,
+                          MemoryBoundedSemaphore(2, 0, 0), linearize=False,
+                          jbig2_chunk_size=chunk_size))
+    # One jbig2 process per chunk with the images of the chunk in order
+    calls = fake_jbig2.calls()
+    assert len(calls) == len(chunks)
+    assert sorted([filenames.index(arg) for arg in call if arg in filenames]
+                  for call in calls) == chunks
+    # The images of a chunk share one symbol dictionary
+    jbig2_globals = _jbig2_globals(pdf_filename)
+    assert all(obj is not None for obj in jbig2_globals)
+    for chunk in chunks:
+        assert all(jbig2_globals[i] is jbig2_globals[chunk[0]]
+                   for i in chunk)
+    assert len({id(jbig2_globals[chunk[0]]) for chunk in chunks}) == len(
+        chunks)
@@ -0,0 +1,47 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import asyncio
+import os
+
+from djpdf.memoryprofile import MemoryProfile
+
+
+def test_flush(tmp_path):
+    filename = str(tmp_path / "profile.json")
+    profile = MemoryProfile(filename)
+    profile.record("convert", "separate", 1000, 64 << 20, 1)
+    # Measurements are only written by flush
+    assert not os.path.exists(filename)
+    asyncio.run(profile.flush())
+    assert MemoryProfile(filename).estimate(
+        "convert", "separate", 1000) == profile.estimate(
+            "convert", "separate", 1000)
+
+
+def test_merge(tmp_path):
+    # Processes that use the same profile keep the estimates of each other
+    filename = str(tmp_path / "profile.json")
+    profile1 = MemoryProfile(filename)
+    profile2 = MemoryProfile(filename)
+    profile1.record("convert", "separate", None, 64 << 20)
+    profile2.record("jbig2", "encode", None, 16 << 20)
+    asyncio.run(profile1.flush())
+    asyncio.run(profile2.flush())
+    profile = MemoryProfile(filename)
+    assert profile.estimate("convert", "separate") is not None
+    assert profile.estimate("jbig2", "encode") is not None
@@ -0,0 +1,101 @@
+#    This file is part of djpdf.
+#
+#    djpdf is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    djpdf is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with djpdf.  If not, see <http://www.gnu.org/licenses/>.
+
+# Copyright 2026 Unrud <unrud@outlook.com>
+
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("libxmp")
+
+from pdfrw import PdfReader  # noqa: E402
+
+from djpdf.scans2pdf import (DEFAULT_SETTINGS, BackgroundImage,  # noqa: E402
+                             ForegroundImage, OcrImage, RecipeFactory,
+                             build_pdf)
+from djpdf.util import MemoryBoundedSemaphore  # noqa: E402
+
+# Writes the output files of ImageMagick commands and logs the arguments.
+# Histograms contain one color.
+FAKE_CONVERT = """#!%(python)s
+import json, sys
+with open(%(log)r, "a") as f:
+    f.write(json.dumps(sys.argv[1:]) + "\\n")
+args = sys.argv[1:]
+outputs = [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == "-write"]
+for output in outputs + [args[-1]]:
+    if output.startswith("histogram:info:"):
+        with open(output[len("histogram:info:"):], "w") as f:
+            f.write("   10: (0,0,0) #000000 black\\n")
+    elif output != "null:":
+        open(output, "wb").close()
+"""
+
+
+@pytest.mark.parametrize("page_window", [None, 2])
+def test_no_pages(tmp_path, page_window):
+    pdf_filename = str(tmp_path / "out.pdf")
+    asyncio.run(build_pdf([], pdf_filename, MemoryBoundedSemaphore(2, 0, 0),
+                          page_window=page_window, linearize=False))
+    assert len(PdfReader(pdf_filename).pages) == 0
+
+
+@pytest.mark.parametrize("layer,image_type", [
+    ("bg_enabled", BackgroundImage), ("fg_enabled", ForegroundImage),
+    ("ocr_enabled", OcrImage)])
+def test_disabled_layers(tmp_path, layer, image_type):
+    # Layers are only separated from the input image, when they are used
+    page = {**DEFAULT_SETTINGS, "filename": str(tmp_path / "page.png"),
+            layer: False}
+    factory = RecipeFactory(separation_engine="imagemagick-batch")
+    page_obj = factory.make_page(page)
+    consumers = page_obj._input_image._consumers
+    assert len(consumers) == 2
+    assert not any(isinstance(c, image_type) for c in consumers)
+
+
+def test_disabled_layers_batch(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log_filename = str(tmp_path / "convert.log")
+    program = bin_dir / "convert"
+    program.write_text(FAKE_CONVERT % {"python": sys.executable,
+                                       "log": log_filename})
+    program.chmod(0o755)
+    monkeypatch.setenv("PATH", os.pathsep.join([str(bin_dir),
+                                                os.environ["PATH"]]))
+    filename = str(tmp_path / "page.ppm")
+    with open(filename, "wb") as f:
+        f.write(b"P6\n4 4\n255\n" + b"\x80" * 48)
+    page = {**DEFAULT_SETTINGS, "filename": filename, "dpi": 300,
+            "fg_enabled": False}
+    factory = RecipeFactory(separation_engine="imagemagick-batch")
+    try:
+        page_obj = factory.make_page(page)
+        consumers = page_obj._input_image._consumers
+        asyncio.run(page_obj._input_image.separated_filename(
+            consumers[0], MemoryBoundedSemaphore(2, 0, 0)))
+    finally:
+        factory.cleanup()
+    with open(log_filename) as f:
+        calls = [json.loads(line) for line in f]
+    batch_calls = [args for args in calls if "-respect-parentheses" in args]
+    # Background and OCR layer
+    assert len(batch_calls) == 1
+    assert batch_calls[0].count("+clone") == 2